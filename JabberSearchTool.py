@@ -17,18 +17,33 @@ from dateutil.tz import tz
 import shlex
 import sys
 import traceback
-
-from jabberArchiveTools import jabberArchiveTools
+import itertools
+import io
+import threading
+
+from jabberArchiveTools import jabberArchiveTools, asyncArchiveTools, searchCancelled, localTimeConverter
+from jabberMirror import archiveMirror
+from jabberTextIndex import textIndex
+from jabberWatchlist import watchlistMatcher, readWatchlist, scanMessages
+import jabberSQLiteBackend
 from jabberSearchSecrets import key, IV, ODBC
 
 """
 Functions:
     - dump user names - show users
     - dump chatroom names - show chatrooms
+    - details of one user/chatroom - show jid username/chatroom
     - get recipients for user - show recipients username/chatroom
     - get chatrooms from user - show chatrooms username (also show chatrooms user1,user2,etc..)
     - get messages between users - get conversation user1,user2
     - get messages in chat room - get discussion chatroom
+    - message counts over time - get activity username/chatroom
+    - who talked to whom - get graph [username/chatroom]
+    - find messages by their text - search text "some phrase" word prefix* [username/chatroom]
+    - find messages with any of a list of terms - scan watchlist termsfile [username/chatroom]
+    - copy new archive rows into the local mirror - sync
+    - run a command in the background - bg command (interactive)
+    - background jobs - jobs, cancel id, collect id (interactive)
     - exit (end interactive)
 
 Options
@@ -45,9 +60,66 @@ Options
     --noPause
     --ignore_row_warning
     --row_warning_threshold
+    --row_count_mode
+    --jidDirectory
+    --shards
+    --workers
+    --stats
+    --bucket
+    --jobs
+    --resultCache
+    --resultCacheMB
+    --mirror
+    --hops
+    --textIndex
+    --top
 """
 
 
+class commandOptions:
+    # the parsed options for the command being run (the global args)
+    # a background job sees the options it was started with, even after the next command has changed them
+
+    def __init__(self, namespace):
+        self.__dict__["namespace"] = namespace
+        self.__dict__["local"] = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(getattr(self.local, "namespace", None) or self.namespace, name)
+
+    def replace(self, namespace):
+        self.__dict__["namespace"] = namespace
+
+    def current(self):
+        return getattr(self.local, "namespace", None) or self.namespace
+
+class threadOutput:
+    # stands in for sys.stdout so anything a background job prints goes to that job's buffer instead of the prompt
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def target(self):
+        return getattr(self.local, "buffer", None) or self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+# set up in interactive mode
+backgroundTools = None
+jobStdout = None
+jobOutput = {}
+# opened by the first search text
+textSearchIndex = None
+
+
 
 def showUsers(re_object, jabberSearchInstance):
     allusers = jabberSearchInstance.getAllUserNames()
@@ -67,6 +139,24 @@ def showChatrooms(re_object, jabberSearchInstance):
         print(room)
     return True
 
+def showJid(re_object, jabberSearchInstance):
+    jid = re_object.groups()[0]
+    info = jabberSearchInstance.getJidInfo(jid)
+    if not info:
+        print("{} not found in archive".format(jid))
+        return True
+    new_tz = pytz.timezone(args.timezone)
+    timefmt = "%Y-%m-%d %H:%M:%S"
+    first = pytz.utc.localize(info["first_sent_date"]).astimezone(new_tz)
+    last = pytz.utc.localize(info["last_sent_date"]).astimezone(new_tz)
+    print(info["jid"])
+    print("  First message: {}".format(first.strftime(timefmt)))
+    print("  Last message: {}".format(last.strftime(timefmt)))
+    print("  Messages sent: {}".format(info["messages_sent"]))
+    print("  Messages received: {}".format(info["messages_received"]))
+    print("  Resources: {}".format(", ".join(info["resources"])))
+    return True
+
 def getRecipients(re_object, jabberSearchInstance):
     user = re_object.groups()[0]
     recipients = []
@@ -99,6 +189,21 @@ def getChatrooms(re_object, jabberSearchInstance):
 
     return True
 
+def peekMessages(messages):
+    # messages is a generator from jabberArchiveTools, so we can't use len() on it
+    # returns False if there are no messages, otherwise an iterator with the first message put back
+    # pulling the first message also runs the query, so a row count ValueError is raised here
+    first = next(messages, None)
+    if first is None:
+        return False
+    return itertools.chain([first], messages)
+
+def outputColumns():
+    # the column projection the chosen output needs, so nothing else is fetched or decrypted
+    if args.outputFilename and args.outputType == "html":
+        return "html"
+    return "text"
+
 def getConversation(re_object, jabberSearchInstance):
     user1 = re_object.groups()[0]
     user2 = re_object.groups()[1]
@@ -112,11 +217,11 @@ def getConversation(re_object, jabberSearchInstance):
     #logger.debug("s: {}, e: {}".format(startTime, endTime))
 
     try:
-        messages = jabberSearchInstance.getMessagesBetweenUsers(user1, user2, startTime=startTime, endTime=endTime, ignore_row_count=args.ignore_row_warning)
-        if len(messages) == 0:
+        messages = peekMessages(jabberSearchInstance.iterMessagesBetweenUsers(user1, user2, startTime=startTime, endTime=endTime,
+                                                                              ignore_row_count=args.ignore_row_warning, columns=outputColumns()))
+        if not messages:
             print("No conversation found for the search parameters")
             return True
-        logger.debug("num msg: {}".format(len(messages)))
         if args.outputFilename:
             if args.outputType == "text":
                 jabberSearchInstance.makeMessageDump(messages, filename=args.outputFilename, timezone=args.timezone)
@@ -130,7 +235,7 @@ def getConversation(re_object, jabberSearchInstance):
         else:
             jabberSearchInstance.makeMessageDump(messages, timezone=args.timezone)
     except ValueError as badnews:
-        print("Your search will return {} rows.  Either reduce the time frame with -s and -e, or specify --ignore_row_warning".format(badnews))
+        print("Your search will return at least {} rows.  Either reduce the time frame with -s and -e, or specify --ignore_row_warning".format(badnews))
 
     return True
 
@@ -146,11 +251,11 @@ def getDiscussion(re_object, jabberSearchInstance):
     logger.debug("s: {}, e: {}".format(startTime, endTime))
 
     try:
-        messages = jabberSearchInstance.getChatRoomLog(chatroom, startTime=startTime, endTime=endTime, ignore_row_count=args.ignore_row_warning)
-        if len(messages) == 0:
+        messages = peekMessages(jabberSearchInstance.iterChatRoomLog(chatroom, startTime=startTime, endTime=endTime,
+                                                                     ignore_row_count=args.ignore_row_warning, columns=outputColumns()))
+        if not messages:
             print("No discussion found for the search parameters")
             return True
-        logger.debug("num msg: {}".format(len(messages)))
         if args.outputFilename:
             if args.outputType == "text":
                 jabberSearchInstance.makeChatroomDump(messages, filename=args.outputFilename, timezone=args.timezone)
@@ -165,11 +270,285 @@ def getDiscussion(re_object, jabberSearchInstance):
         else:
             jabberSearchInstance.makeChatroomDump(messages, timezone=args.timezone)
     except ValueError as badnews:
-        print("Your search will return {} rows.  Either reduce the time frame with -s and -e, or specify --ignore_row_warning".format(badnews))
+        print("Your search will return at least {} rows.  Either reduce the time frame with -s and -e, or specify --ignore_row_warning".format(badnews))
 
     return True
 
 
+def getActivity(re_object, jabberSearchInstance):
+    jid = re_object.groups()[0]
+    startTime = False
+    if args.startTime:
+        startTime = fixTimezoneForSearchParameters(args.startTime[-1])
+    endTime = False
+    if args.endTime:
+        endTime = fixTimezoneForSearchParameters(args.endTime[-1])
+
+    activity = jabberSearchInstance.getActivity(jid, startTime=startTime, endTime=endTime, bucket=args.bucket, timezone=args.timezone)
+    if not activity:
+        print("No activity found for the search parameters")
+        return True
+    timefmt = "%Y-%m-%d %H:%M" if args.bucket == "hour" else "%Y-%m-%d"
+    if args.outputFilename:
+        with open(args.outputFilename, "w") as f:
+            f.write("start|sent|received\n")
+            for bucket in activity:
+                f.write("{}|{}|{}\n".format(bucket["start"].strftime(timefmt), bucket["sent"], bucket["received"]))
+        print("Activity saved to {}".format(args.outputFilename))
+        return True
+    # bar chart scaled to the busiest bucket
+    busiest = max(bucket["sent"] + bucket["received"] for bucket in activity)
+    print("{} ({} per {}, sent/received)".format(jid, args.timezone, args.bucket))
+    for bucket in activity:
+        total = bucket["sent"] + bucket["received"]
+        bar = "#" * max(1, round(50 * total / busiest)) if total else ""
+        print("{}  {:>6} {:>6}  {}".format(bucket["start"].strftime(timefmt), bucket["sent"], bucket["received"], bar))
+    return True
+
+def getGraph(re_object, jabberSearchInstance):
+    jid = re_object.groups()[0].strip() or False
+    startTime = False
+    if args.startTime:
+        startTime = fixTimezoneForSearchParameters(args.startTime[-1])
+    endTime = False
+    if args.endTime:
+        endTime = fixTimezoneForSearchParameters(args.endTime[-1])
+
+    edges = jabberSearchInstance.getContactGraph(jid, startTime=startTime, endTime=endTime, hops=args.hops)
+    if not edges:
+        print("No messages found for the search parameters")
+        return True
+    if args.outputFilename:
+        mode = "graphml" if args.outputFilename.lower().endswith(".graphml") else "csv"
+        jabberSearchInstance.makeGraphFile(edges, args.outputFilename, mode=mode, timezone=args.timezone)
+        print("{} edges saved to {} ({})".format(len(edges), args.outputFilename, mode))
+        return True
+    new_tz = pytz.timezone(args.timezone)
+    timefmt = "%Y-%m-%d"
+    for edge in edges:
+        first = pytz.utc.localize(edge["first"]).astimezone(new_tz).strftime(timefmt)
+        last = pytz.utc.localize(edge["last"]).astimezone(new_tz).strftime(timefmt)
+        print("{:>8}  {} to {}  {} -> {} ({})".format(edge["messages"], first, last, edge["source"], edge["target"], edge["kind"]))
+    print("{} edges".format(len(edges)))
+    return True
+
+def openTextIndex(jabberSearchInstance):
+    # the index file is only opened the first time search text is used, without --textIndex it is in memory
+    global textSearchIndex
+    if textSearchIndex is None:
+        textSearchIndex = textIndex(args.textIndex or ":memory:", jabberSearchInstance.table, jabberSearchInstance.key_fingerprint)
+    return textSearchIndex
+
+def searchText(re_object, jabberSearchInstance):
+    parts = shlex.split(re_object.groups()[0])
+    jid = False
+    if len(parts) > 1 and "@" in parts[-1]:
+        # only look at messages to or from this user or chatroom
+        jid = parts.pop()
+    startTime = False
+    if args.startTime:
+        startTime = fixTimezoneForSearchParameters(args.startTime[-1])
+    endTime = False
+    if args.endTime:
+        endTime = fixTimezoneForSearchParameters(args.endTime[-1])
+
+    index = openTextIndex(jabberSearchInstance)
+    if not index.status()["watermark"]:
+        if args.textIndex:
+            print("Building the text index {}, the first time reads every message in the archive".format(args.textIndex))
+        else:
+            print("Building the text index in memory, which reads every message in the archive (--textIndex keeps it between sessions)")
+    added = index.update(jabberSearchInstance)
+    if added:
+        print("{} new messages added to the text index".format(added))
+    results = index.search(jabberSearchInstance, parts, startTime=startTime, endTime=endTime, jid=jid, limit=args.top)
+    if not results:
+        print("No messages found for the search parameters")
+        return True
+    converter = localTimeConverter(args.timezone)
+    if args.outputFilename:
+        with open(args.outputFilename, "w") as f:
+            f.write("sent|from|to|score|message\n")
+            for result in results:
+                f.write("{}|{}|{}|{:.2f}|{}\n".format(converter.convert(result["sent_date"]).strftime("%Y-%m-%d %H:%M:%S"),
+                                                     result["from_jid"], result["to_jid"], result["score"], result["body_string"]))
+        print("{} messages saved to {}".format(len(results), args.outputFilename))
+        return True
+    for result in results:
+        sent = converter.convert(result["sent_date"]).strftime("%Y-%m-%d %H:%M:%S")
+        if result["to_jid"] and result["from_jid"].startswith(result["to_jid"] + "/"):
+            # chatroom message, the from_jid has the room and the sender
+            print("({}) {}: {}\n".format(sent, result["from_jid"], result["body_string"]))
+        else:
+            print("({}) {} -> {}: {}\n".format(sent, result["from_jid"], result["to_jid"], result["body_string"]))
+    print("{} best matches shown in time order (at most --top {})".format(len(results), args.top))
+    return True
+
+def scanWatchlist(re_object, jabberSearchInstance):
+    parts = shlex.split(re_object.groups()[0])
+    watchlistFile = parts[0]
+    jid = parts[1] if len(parts) > 1 else False
+    startTime = False
+    if args.startTime:
+        startTime = fixTimezoneForSearchParameters(args.startTime[-1])
+    endTime = False
+    if args.endTime:
+        endTime = fixTimezoneForSearchParameters(args.endTime[-1])
+
+    try:
+        terms = readWatchlist(watchlistFile)
+    except OSError as badnews:
+        print("Unable to read the watchlist {}: {}".format(watchlistFile, badnews))
+        return True
+    matcher = watchlistMatcher(terms)
+    if not matcher.terms:
+        print("No terms in the watchlist {}".format(watchlistFile))
+        return True
+    if not jid:
+        messages = jabberSearchInstance.iterAllMessages(startTime=startTime, endTime=endTime, ignore_row_count=args.ignore_row_warning, columns="text")
+    elif "@conference" in jid:
+        messages = jabberSearchInstance.iterChatRoomLog(jid, startTime=startTime, endTime=endTime, ignore_row_count=args.ignore_row_warning, columns="text")
+    else:
+        # one to one messages and chatroom posts, like search text's user
+        messages = jabberSearchInstance.iterMessagesSentByUser(jid, startTime=startTime, endTime=endTime, ignore_row_count=args.ignore_row_warning, columns="text")
+    converter = localTimeConverter(args.timezone)
+    termCounts = {}
+    f = None
+    try:
+        if args.outputFilename:
+            f = open(args.outputFilename, "w")
+            f.write("sent|term|count|sender|recipient|room|context\n")
+        for hit in scanMessages(messages, matcher):
+            termCounts[hit["term"]] = termCounts.get(hit["term"], 0) + 1
+            sent = converter.convert(hit["sent_date"]).strftime("%Y-%m-%d %H:%M:%S")
+            if f:
+                f.write("{}|{}|{}|{}|{}|{}|{}\n".format(sent, hit["term"], hit["count"], hit["sender"], hit["recipient"] or "",
+                                                      hit["room"] or "", hit["context"]))
+            elif hit["room"]:
+                print("({}) [{}] {} in {}: {}".format(sent, hit["term"], hit["sender"], hit["room"], hit["context"]))
+            else:
+                print("({}) [{}] {} -> {}: {}".format(sent, hit["term"], hit["sender"], hit["recipient"], hit["context"]))
+    except ValueError as badnews:
+        print("Your search will return at least {} rows.  Either reduce the time frame with -s and -e, or specify --ignore_row_warning".format(badnews))
+        return True
+    finally:
+        if f:
+            f.close()
+    if not termCounts:
+        print("None of the {} terms were found for the search parameters".format(len(matcher.terms)))
+        return True
+    if args.outputFilename:
+        print("Hits saved to {}".format(args.outputFilename))
+    print("Messages found for {} of {} terms:".format(len(termCounts), len(matcher.terms)))
+    for term, count in sorted(termCounts.items(), key=lambda item: -item[1]):
+        print("{:>8}  {}".format(count, term))
+    return True
+
+def syncMirror(re_object, jabberSearchInstance):
+    if not args.mirror:
+        print("sync needs --mirror, the local file to copy the archive into")
+        return True
+    if not args.ODBCConnectionString:
+        print("sync needs --ODBCConnectionString to copy from")
+        return True
+    source = pyodbc.connect(args.ODBCConnectionString)
+    try:
+        copied = archiveMirror(args.mirror, source, table=args.tableName).sync()
+    finally:
+        source.close()
+    status = archiveMirror(args.mirror, table=args.tableName).status()
+    print("{} rows copied to {}, it now has {} rows up to {} (UTC)".format(copied, args.mirror, status["rows"], status["watermark"]))
+    # decrypt the new jids into the jid directory too, jabberSearchInstance is on the mirror
+    jids = jabberSearchInstance.refreshJidDirectory(force=True).bareJids()
+    print("{} users and chatrooms in the jid directory".format(len(jids)))
+    return True
+
+def runBackgroundCommand(jabberSearchInstance, commandString, options, buffer):
+    # runs in a background job thread with its own jabberArchiveTools clone, printing into buffer
+    args.local.namespace = options
+    jobStdout.local.buffer = buffer
+    try:
+        jabberSearchInstance.kwargs["query_shards"] = options.shards
+        jabberSearchInstance.stats.enabled = options.stats
+        if not routeCommand(commandString, commandRe_dictionary, jabberSearchInstance):
+            print("Unrecognized command '{}'".format(commandString))
+        if options.stats:
+            print(jabberSearchInstance.stats.report())
+    finally:
+        args.local.namespace = None
+        jobStdout.local.buffer = None
+
+def startBackgroundCommand(re_object, jabberSearchInstance):
+    commandString = re_object.groups()[0]
+    if backgroundTools is None:
+        print("Background jobs are only available in interactive mode (-i)")
+        return True
+    buffer = io.StringIO()
+    job = backgroundTools.submit(runBackgroundCommand, commandString, args.current(), buffer, description=commandString)
+    jobOutput[job.job_id] = buffer
+    print("Started job {}: {}".format(job.job_id, commandString))
+    return True
+
+def findJob(job_id):
+    job = None
+    if backgroundTools is not None:
+        job = backgroundTools.getJob(int(job_id))
+    if job is None:
+        print("No job {} (see jobs)".format(job_id))
+    return job
+
+def showJobs(re_object, jabberSearchInstance):
+    jobs = []
+    if backgroundTools is not None:
+        jobs = backgroundTools.listJobs()
+    if len(jobs) == 0:
+        print("No background jobs")
+        return True
+    for job in jobs:
+        print("{:>4}  {:<10} {:>8.1f}s  {}".format(job.job_id, job.status(), job.elapsed(), job.description))
+    return True
+
+def cancelJob(re_object, jabberSearchInstance):
+    job = findJob(re_object.groups()[0])
+    if job is None:
+        return True
+    if job.done():
+        print("Job {} has already finished, collect {} to see it".format(job.job_id, job.job_id))
+        return True
+    job.cancel()
+    print("Cancelling job {}".format(job.job_id))
+    return True
+
+def collectJob(re_object, jabberSearchInstance):
+    # waits for the job if it is still running, prints its output and forgets it
+    job = findJob(re_object.groups()[0])
+    if job is None:
+        return True
+    if not job.done():
+        print("Waiting for job {} ({}), Ctrl-C to stop waiting".format(job.job_id, job.description))
+    try:
+        job.result()
+    except KeyboardInterrupt:
+        print("Job {} is still {}".format(job.job_id, job.status()))
+        return True
+    except searchCancelled:
+        pass
+    except ValueError as badnews:
+        print("Your search will return at least {} rows.  Either reduce the time frame with -s and -e, or specify --ignore_row_warning".format(badnews))
+    except Exception as badnews:
+        print("Job {} failed: {}".format(job.job_id, badnews))
+    print("Job {} ({}) {} after {:.1f}s".format(job.job_id, job.description, job.status(), job.elapsed()))
+    sys.stdout.write(jobOutput.pop(job.job_id).getvalue())
+    backgroundTools.forgetJob(job.job_id)
+    return True
+
+def announceFinishedJobs(announced):
+    # one line per background job that finished since the last prompt
+    for job in backgroundTools.listJobs():
+        if job.done() and job.job_id not in announced:
+            announced.add(job.job_id)
+            print("Job {} ({}) {}, collect {} to see it".format(job.job_id, job.description, job.status(), job.job_id))
+
 def fixTimezoneForSearchParameters(time_in):
     # Jabber archive is in UTC, these search parameters will likely be in the timezone specified in the arguments
     # need to correct them for UTC
@@ -198,10 +577,24 @@ def routeCommand(userinput, re_dictionary, jabberSearchInstance):
 commandRe_dictionary = {
                         "show users":showUsers,
                         "show chatrooms":showChatrooms,
+                        "show jid (.+)":showJid,
                         "get recipients (.+)":getRecipients,
                         "get chatrooms (.+)":getChatrooms,
                         "get conversation (.+) (.+)":getConversation,
-                        "get discussion (.+)":getDiscussion
+                        "get discussion (.+)":getDiscussion,
+                        "get activity (.+)":getActivity,
+                        "get graph ?(.*)":getGraph,
+                        "search text (.+)":searchText,
+                        "scan watchlist (.+)":scanWatchlist,
+                        "sync":syncMirror
+                        }
+
+# only run at the prompt, not in background jobs
+jobCommandRe_dictionary = {
+                        "bg (.+)":startBackgroundCommand,
+                        "jobs":showJobs,
+                        "cancel (\\d+)":cancelJob,
+                        "collect (\\d+)":collectJob
                         }
 
 if __name__ == "__main__":
@@ -251,52 +644,117 @@ if __name__ == "__main__":
                         help="If set, this tool will immediately exit on completion")
     parser.add_argument("--row_warning_threshold", type=int, default=500,
                         help="This is the result size threshold, anything over this will trigger a warning to narrow search parameters (or set --ignore_row_warning)")
+    parser.add_argument("--row_count_mode", type=str, default="bounded", choices=["bounded", "exact", "estimate"],
+                        help="How --row_warning_threshold is checked: bounded reads at most threshold+1 rows of the search, exact counts all rows first (slow, scans twice), estimate uses the SQL Server query plan estimate")
     parser.add_argument("-I", "--ignore_row_warning", action="store_true",
                         help="If set, this will generate results regardless of how large the result set is")
+    parser.add_argument("--jidDirectory", type=str, default=None,
+                        help="File to keep the directory of users and chatrooms in between sessions (it is only refreshed with new messages).  It has the user and chatroom names in plain text, keep it as safe as the archive.  Without it the directory is only kept for the session")
+    parser.add_argument("--mirror", type=str, default=None,
+                        help="Local SQLite mirror of the archive (see sync).  If set, every search runs on the mirror instead of the DB server")
+    parser.add_argument("--resultCache", type=str, default=None,
+                        help="Directory to keep conversation and discussion results in (encrypted), so searching the same past time frame again doesn't go back to the DB server (set at startup only)")
+    parser.add_argument("--resultCacheMB", type=int, default=512,
+                        help="Most MB kept in --resultCache, the least recently used results are deleted past this")
+    parser.add_argument("--hops", type=int, default=1,
+                        help="How far get graph goes out from the user or chatroom: 1 is its own contacts and chatrooms, 2 adds theirs, and so on")
+    parser.add_argument("--textIndex", type=str, default=None,
+                        help="File to keep the word index search text uses (it is only updated with new messages).  It has message words in plain text, keep it as safe as the archive.  Without it the index is only kept in memory for the session")
+    parser.add_argument("--top", type=int, default=50,
+                        help="Most messages search text shows, the best matches are kept")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="Split conversation and discussion searches into this many time slices, each run on its own DB connection at the same time")
+    parser.add_argument("--bucket", type=str, default="day", choices=["hour", "day", "week"],
+                        help="Time bucket for get activity, in the --timezone time")
+    parser.add_argument("--stats", action="store_true",
+                        help="After each command, print how long was spent in each phase (query, fetch, decrypt, filter, dedup, render) and row/byte counts")
+    parser.add_argument("--jobs", type=int, default=2,
+                        help="Number of background jobs (bg) that can run at the same time in interactive mode, each on its own DB connection (set at startup only)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Number of extra processes used to decrypt conversation and discussion results (set at startup only).  0 decrypts in this process")
 
     command_help = "Available command options are:\n"
     command_help += "show users - Get a list of all valid users in archive\n"
     command_help += "show chatrooms - Get a list of all group chat rooms in the archive\n"
+    command_help += "show jid [username or chatroom] - Show first/last message times, message counts and resources for this user or chatroom\n"
     command_help += "get recipients [username or chatroom] - Get a list of the recipients a user sent to, or all users in a chatroom\n"
     command_help += "get chatrooms [username or user1,user2,..] - Get a list of chatrooms for this user.  If multiple users are given (separated by a comma), then will list the rooms where these users were active together\n"
     command_help += "get conversation [user1 user2] - Generates the conversation between these two users.  If no --outputFilename, prints to screen.  If --outputFilename then outputs to file name\n"
     command_help += "get discussion [chatroom] - Generates the group discussion in this chatroom.  If no --outputFilename, prints to screen.  If --outputFilename then outputs to file name\n"
+    command_help += "get activity [username or chatroom] - Message counts per --bucket (hour, day or week) between -s and -e, without reading any messages.  If --outputFilename then saves them | delimited\n"
+    command_help += "get graph [username or chatroom] - Lists who sent messages to whom between -s and -e (one to one, posted in a chatroom, chatroom member) with message counts, without reading any messages.  With a user or chatroom only its edges, and --hops more steps out.  --outputFilename saves them as CSV (GraphML if it ends in .graphml)\n"
+    command_help += "search text [words] [username or chatroom] - Finds the messages with all these words between -s and -e, only the chatroom's messages, or the user's one to one messages and chatroom posts, if one is given.  Quote a phrase (\"lunch order\") to match the words together and end a word with * to match words starting with it.  Shows the --top best matches in time order, --outputFilename saves them | delimited\n"
+    command_help += "scan watchlist [file] [username or chatroom] - Reads every message between -s and -e once, and shows each one with any of the terms in the file (one per line) with its sender, room, time and the text around it.  With a user only what they sent is read (their one to one messages and their chatroom posts, each post once), with a chatroom only its discussion.  --outputFilename saves the hits | delimited\n"
+    command_help += "sync - Copies the archive rows that are new since the last sync into the --mirror file (needs --ODBCConnectionString), and updates the jid directory\n"
+    command_help += "bg [command] - Interactive only.  Runs the command in the background with the current options, so the next command can be typed while it runs\n"
+    command_help += "jobs - Interactive only.  Lists the background jobs\n"
+    command_help += "cancel [job] - Interactive only.  Stops a background job (its query is cancelled on the server)\n"
+    command_help += "collect [job] - Interactive only.  Waits for a background job if it is still running and shows what it printed\n"
     command_help += "exit - Closes this Jabber archive search session\n"
-    command_help += "In interactive mode, you can also specify options -s,-e,-t,-o,-O, and -I\n"
+    command_help += "In interactive mode, you can also specify options -s,-e,-t,-o,-O,-I,--shards,--stats,--bucket,--hops and --top\n"
 
     parser.add_argument("command", nargs="+", help=command_help)
 
     # initial argument parse
-    args = parser.parse_args()
+    args = commandOptions(parser.parse_args())
 
     try:
         # start DB connection
-        if not args.ODBCConnectionString:
-            sys.exit("Please provide a valid ODBC connection string with --ODBCConnectionString")
-
-        cnxn = pyodbc.connect(args.ODBCConnectionString)
+        if args.mirror:
+            # searches run on the local mirror, the DB server is only used by sync
+            mirrorFile = args.mirror
+            cnxn = jabberSQLiteBackend.connect(mirrorFile)
+            connectionFactory = lambda: jabberSQLiteBackend.connect(mirrorFile)
+            sqlDialect = "sqlite"
+            if not archiveMirror(mirrorFile, table=args.tableName).status() and args.command[0] != "sync":
+                print("The mirror {} is empty, run sync first".format(mirrorFile))
+        else:
+            if not args.ODBCConnectionString:
+                sys.exit("Please provide a valid ODBC connection string with --ODBCConnectionString")
+            connectionString = args.ODBCConnectionString
+            cnxn = pyodbc.connect(connectionString)
+            connectionFactory = lambda: pyodbc.connect(connectionString)
+            sqlDialect = "mssql"
         # Start jabs session
         jabberConfig = {
                         "pyodbc_connection":cnxn,
+                        "sql_dialect":sqlDialect,
                         "table":args.tableName,
                         "AES_key_hex":args.key,
                         "AES_IV_hex":args.IV,
                         "row_count_alert_threshold":args.row_warning_threshold,
+                        "row_count_mode":args.row_count_mode,
+                        "jid_directory_file":args.jidDirectory or False,
+                        "pyodbc_connection_factory":connectionFactory,
+                        "decrypt_workers":args.workers,
+                        "result_cache_dir":args.resultCache or False,
+                        "result_cache_max_bytes":args.resultCacheMB * 1024 * 1024,
                         }
         jabs = jabberArchiveTools(**jabberConfig)
+        if args.interactive:
+            backgroundTools = asyncArchiveTools(jabs, max_workers=args.jobs)
+            jobStdout = threadOutput(sys.stdout)
+            sys.stdout = jobStdout
+        announced = set()
 
         # begin the loop
         while True:
             nextcommand = ""
-            commandString = [str(i) for i in args.command]
+            # quoted phrases (search text) are quoted again so they stay together
+            commandString = [shlex.quote(str(i)) if re.search("\\s", str(i)) else str(i) for i in args.command]
             commandString = " ".join(commandString)
             print("Processing command {}".format(commandString))
 
             if args.command[0] == "exit":
                 break
-            if not routeCommand(commandString, commandRe_dictionary, jabs):
+            jabs.kwargs["query_shards"] = args.shards
+            jabs.stats.enabled = args.stats
+            jabs.resetStats()
+            if not routeCommand(commandString, dict(commandRe_dictionary, **jobCommandRe_dictionary), jabs):
                 print("Unrecognized command '{}'".format(commandString))
                 print(command_help)
+            if args.stats:
+                print(jabs.stats.report())
             if args.interactive:
                 existingOptions = ["-i"]
                 if args.startTime is not None:
@@ -305,7 +763,10 @@ if __name__ == "__main__":
                     existingOptions.append(f"-e{args.endTime[-1]}")
                 if args.ignore_row_warning:
                     existingOptions.append("-I")
+                if args.stats:
+                    existingOptions.append("--stats")
                 nextcommand = ""
+                announceFinishedJobs(announced)
                 print("Options active for next command: "+" ".join(existingOptions))
                 nextcommand = input("> ")
                 nextcommand_list = existingOptions
@@ -320,12 +781,21 @@ if __name__ == "__main__":
                 wait = input("Press enter to exit")
                 break
 
-            args = parser.parse_args(nextcommand_list)
+            args.replace(parser.parse_args(nextcommand_list))
+
+        if backgroundTools is not None:
+            # cancels anything still running
+            backgroundTools.close()
+        if textSearchIndex is not None:
+            textSearchIndex.close()
+        jabs.close()
 
     except Exception as badnews:
         #raise badnews
         tracemsg = traceback.format_exc()
         print("Unable to complete search: {}".format(badnews))
         print(tracemsg)
+        if backgroundTools is not None:
+            backgroundTools.close()
         if not args.noPause:
             wait = input("Press enter to exit")
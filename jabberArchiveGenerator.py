@@ -0,0 +1,236 @@
+# standard packages
+import logging
+logger = logging.getLogger('jabberArchiveGenerator')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+formatter = logging.Formatter('%(name)s:%(levelname)s:%(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+import argparse
+import base64
+import json
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from Crypto.Cipher import AES
+
+"""
+Builds a synthetic, encrypted Jabber archive (jm table) in a local SQLite file, for testing and benchmarking
+jabberArchiveTools without access to the real SQL Server (see jabberSQLiteBackend and jabberBenchmark)
+
+What it makes:
+    - users chatting one to one, and chatrooms that copy every message to each member
+    - jabber_XXXX resources on the jids that change when a user logs in again
+    - chatrooms resending their recent history to a user that joins (same message ids again)
+    - to_jid, from_jid, body_string and message_string AES-256-CBC encrypted with one key and IV, base64 encoded
+    - the key, IV, users and chatrooms are kept in a jm_synthetic table so the benchmark can find them
+
+Rows are written in batches as they are made, so tens of millions of rows only need disk space
+
+Example:
+    python jabberArchiveGenerator.py --db synthetic.db --rows 1000000
+"""
+
+words = ["the", "vault", "is", "full", "lunch", "meeting", "moved", "to", "three", "can", "you", "check", "server",
+         "logs", "ticket", "closed", "deploy", "tonight", "ok", "thanks", "build", "failed", "again", "who", "has",
+         "the", "keys", "for", "lab", "backup", "finished", "disk", "space", "HD", "patch", "tuesday", "call", "me"]
+
+
+class archiveGenerator:
+
+    def __init__(self, **kwargs):
+        dictionaryOfDefaultKwargs = {
+                                        "users":200,
+                                        "rooms":20,
+                                        "room_size":(3, 25),        # members per room, min and max
+                                        "room_message_share":0.5,   # share of messages sent to a room
+                                        "join_share":0.02,          # chance a room message is preceded by someone (re)joining
+                                        "replay_messages":10,       # history resent to a user joining a room
+                                        "relogin_share":0.01,       # chance a user gets a new jabber_XXXX resource
+                                        "empty_body_share":0.05,    # messages without a body (typing notices and the like)
+                                        "domain":"example.org",
+                                        "conference":"conference-1-standaloneclusterab12c.example.org",
+                                        "start":datetime(2020, 1, 1),
+                                        "seed":1,
+                                        "AES_key_hex":None,         # random if not given
+                                        "AES_IV_hex":None,
+                                        "batch_size":10000,         # rows per insert
+                                    }
+        for arg in dictionaryOfDefaultKwargs:
+            if arg not in kwargs:
+                kwargs[arg] = dictionaryOfDefaultKwargs[arg]
+        self.kwargs = kwargs
+        self.random = random.Random(kwargs["seed"])
+        if not kwargs["AES_key_hex"]:
+            kwargs["AES_key_hex"] = "%064x" % self.random.getrandbits(256)
+        if not kwargs["AES_IV_hex"]:
+            kwargs["AES_IV_hex"] = "%032x" % self.random.getrandbits(128)
+        self.AES_key = bytes.fromhex(kwargs["AES_key_hex"])
+        self.AES_IV = bytes.fromhex(kwargs["AES_IV_hex"])
+        # jids repeat on most rows, so their ciphertext is kept
+        self.jid_cache = {}
+
+        self.users = ["{}.{}{}@{}".format(self.random.choice(["alex", "sam", "kim", "lee", "pat", "jo", "chris", "dana"]),
+                                          self.random.choice(["smith", "nguyen", "garcia", "ito", "brown", "khan", "moreau"]),
+                                          index, kwargs["domain"]) for index in range(kwargs["users"])]
+        self.resources = dict((user, self.newResource()) for user in self.users)
+        self.rooms = {}
+        for index in range(kwargs["rooms"]):
+            room = "{}{}@{}".format(self.random.choice(["ops", "itsec", "dev", "io", "lab"]), self.random.getrandbits(40), kwargs["conference"])
+            size = min(len(self.users), self.random.randint(*kwargs["room_size"]))
+            self.rooms[room] = self.random.sample(self.users, size)
+        self.history = dict((room, []) for room in self.rooms)
+        self.message_count = 0
+        # one to one message counts, so the benchmark can pick a pair that actually talk
+        self.pair_counts = {}
+
+    def newResource(self):
+        return "jabber_{}".format(self.random.randint(1000, 9999))
+
+    def encrypt(self, p_text):
+        p_bytes = p_text.encode("utf-8")
+        pad = 16 - len(p_bytes) % 16
+        p_bytes += bytes([pad]) * pad
+        return base64.b64encode(AES.new(self.AES_key, AES.MODE_CBC, self.AES_IV).encrypt(p_bytes)).decode("utf-8")
+
+    def encryptJid(self, jid):
+        c_text = self.jid_cache.get(jid)
+        if c_text is None:
+            c_text = self.encrypt(jid)
+            self.jid_cache[jid] = c_text
+        return c_text
+
+    def fullJid(self, user):
+        if self.random.random() < self.kwargs["relogin_share"]:
+            self.resources[user] = self.newResource()
+        return "{}/{}".format(user, self.resources[user])
+
+    def newMessage(self, from_jid):
+        # returns (message id, body, message_string template with {to} left in)
+        self.message_count += 1
+        message_id = "{:08x}:{:04x}:{:04x}:{:04x}:{:012x}".format(self.random.getrandbits(32), self.random.getrandbits(16),
+                                                                   self.random.getrandbits(16), self.random.getrandbits(16),
+                                                                   self.random.getrandbits(48))
+        body = None
+        if self.random.random() >= self.kwargs["empty_body_share"]:
+            body = " ".join(self.random.choice(words) for index in range(self.random.randint(1, 30)))
+            body += " {}".format(self.message_count)
+        message = "<message from='{}' id='{}' to='{{to}}' type='chat'>".format(from_jid, message_id)
+        if body:
+            message += "<body>{0}</body><html xmlns='http://jabber.org/protocol/xhtml-im'><body xmlns='http://www.w3.org/1999/xhtml'>{0}</body></html>".format(body)
+        message += "</message>"
+        return message_id, body, message
+
+    def makeRow(self, to_jid, from_jid, sent_date, msg_id, body, message):
+        message = message.replace("{to}", to_jid)
+        c_body = None
+        if body:
+            c_body = self.encrypt(body)
+        return (self.encryptJid(to_jid), self.encryptJid(from_jid), sent_date.strftime("%Y-%m-%d %H:%M:%S"), None, None,
+                msg_id, len(body or ""), len(message), c_body, self.encrypt(message), None)
+
+    def iterRows(self, rows):
+        # yields about this many rows (a room message can go a few over), oldest first
+        sent_date = self.kwargs["start"]
+        written = 0
+        while written < rows:
+            sent_date += timedelta(seconds=self.random.randint(1, 120))
+            if self.random.random() < self.kwargs["room_message_share"]:
+                room = self.random.choice(list(self.rooms))
+                members = self.rooms[room]
+                if self.random.random() < self.kwargs["join_share"]:
+                    # someone (re)joins and gets the recent history again, same ids as the originals
+                    joiner = self.random.choice(members)
+                    to_jid = self.fullJid(joiner)
+                    for msg_id, from_jid, body, message in self.history[room]:
+                        yield self.makeRow(to_jid, from_jid, sent_date, msg_id, body, message)
+                        written += 1
+                sender = self.random.choice(members)
+                # the archive keeps chatroom messages as from room/user@domain/resource
+                from_jid = "{}/{}/{}".format(room, sender, self.resources[sender])
+                message_id, body, message = self.newMessage(from_jid)
+                message = message.replace("type='chat'", "type='groupchat'")
+                for member in members:
+                    yield self.makeRow(self.fullJid(member), from_jid, sent_date, self.message_count, body, message)
+                    written += 1
+                self.history[room].append((self.message_count, from_jid, body, message))
+                del self.history[room][:-self.kwargs["replay_messages"]]
+            else:
+                sender, recipient = self.random.sample(self.users, 2)
+                pair = tuple(sorted([sender, recipient]))
+                self.pair_counts[pair] = self.pair_counts.get(pair, 0) + 1
+                from_jid = self.fullJid(sender)
+                message_id, body, message = self.newMessage(from_jid)
+                yield self.makeRow(self.fullJid(recipient), from_jid, sent_date, self.message_count, body, message)
+                written += 1
+
+    def generate(self, filename, rows):
+        # (re)creates the jm table in filename with about rows rows, returns the number written
+        connection = sqlite3.connect(filename)
+        connection.execute("drop table if exists jm")
+        connection.execute("drop table if exists jm_synthetic")
+        connection.execute("create table jm (to_jid text, from_jid text, sent_date text, subject text, thread_id text, msg_id integer, "
+                           "body_len integer, message_len integer, body_string text, message_string text, history_flag text)")
+        started = time.time()
+        written = 0
+        batch = []
+        for row in self.iterRows(rows):
+            batch.append(row)
+            if len(batch) >= self.kwargs["batch_size"]:
+                connection.executemany("insert into jm values (?,?,?,?,?,?,?,?,?,?,?)", batch)
+                written += len(batch)
+                batch = []
+                if written % (self.kwargs["batch_size"] * 100) == 0:
+                    logger.info("{} rows, {:.0f} rows/s".format(written, written / (time.time() - started)))
+        if batch:
+            connection.executemany("insert into jm values (?,?,?,?,?,?,?,?,?,?,?)", batch)
+            written += len(batch)
+        # the archive server has indexes like these
+        connection.execute("create index jm_to_jid on jm (to_jid, sent_date)")
+        connection.execute("create index jm_from_jid on jm (from_jid, sent_date)")
+        connection.execute("create index jm_sent_date on jm (sent_date)")
+        connection.execute("create table jm_synthetic (name text primary key, value text)")
+        meta = {
+            "AES_key_hex":self.kwargs["AES_key_hex"],
+            "AES_IV_hex":self.kwargs["AES_IV_hex"],
+            "rows":written,
+            "seed":self.kwargs["seed"],
+            "users":self.users,
+            "rooms":self.rooms,
+            "busiest_pair":max(self.pair_counts, key=self.pair_counts.get) if self.pair_counts else self.users[:2],
+            "start":self.kwargs["start"].strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        connection.executemany("insert into jm_synthetic values (?,?)", [(name, json.dumps(value)) for name, value in meta.items()])
+        connection.commit()
+        connection.close()
+        logger.info("{} rows written to {} in {:.1f}s".format(written, filename, time.time() - started))
+        return written
+
+
+def readSyntheticInfo(filename):
+    # returns the jm_synthetic details (key, IV, users, rooms...) of a generated archive
+    connection = sqlite3.connect(filename)
+    try:
+        return dict((name, json.loads(value)) for name, value in connection.execute("select name, value from jm_synthetic"))
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds a synthetic encrypted Jabber archive in a SQLite file")
+    parser.add_argument("--db", type=str, default="synthetic.db", help="SQLite file to write (the jm table is replaced)")
+    parser.add_argument("--rows", type=int, default=100000, help="About how many rows to make")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rooms", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--key", type=str, default=None, help="Hex AES key, random if not given")
+    parser.add_argument("--IV", type=str, default=None, help="Hex AES IV, random if not given")
+    args = parser.parse_args()
+
+    if os.path.dirname(args.db) and not os.path.isdir(os.path.dirname(args.db)):
+        parser.error("No directory for {}".format(args.db))
+    generator = archiveGenerator(users=args.users, rooms=args.rooms, seed=args.seed, AES_key_hex=args.key, AES_IV_hex=args.IV)
+    generator.generate(args.db, args.rows)
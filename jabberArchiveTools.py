@@ -7,17 +7,152 @@ formatter = logging.Formatter('%(name)s:%(levelname)s:%(message)s')
 ch.setFormatter(formatter)
 logger.addHandler(ch)
 
+import asyncio
 import base64
+import binascii
+import copy
+import functools
+import hmac
+import inspect
 import hashlib
 from Crypto.Cipher import AES
 import pyodbc
 import pytz
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
+import sys
+import os
+import json
+import time
+import heapq
+import itertools
+import queue
+import threading
+import contextlib
+import csv
+import zlib
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from xml.sax.saxutils import quoteattr
+
+# numpy is optional, it just speeds up the XOR step of batch decryption
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 # some code adapted from: https://www.quickprogrammingtips.com/python/aes-256-encryption-and-decryption-in-python.html
 
+# pulls the HTML part out of a message_string, compiled once since it runs on every exported message
+html_re = re.compile(r"(<html.+<\/html>)")
+# this re to get the message ID from <message from='chat558881748317483@conference-3-standaloneclusterff6b8.mpiphp.org/xxx@mpiphp.org/jabber_12137' id='f0734db9:6121:408b:a890:1e2987242cb4' to='n ..
+message_id_re = re.compile(" id='(.+?)' ")
+# same thing for decrypted bytes, used by the dedup to find the id without decoding (or decrypting) the whole message
+message_id_bytes_re = re.compile(b" id='(.+?)' ")
+search_time_re = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$")
+
+# -- Decryption
+# These are plain functions (not jabberArchiveTools methods) so the process pool workers can use them too
+
+def unpadBytes(bytes_to_clean):
+    s = bytes_to_clean
+    return s[:-ord(s[len(s) - 1:])]
+
+def decryptString(AES_key, AES_IV, c_text):
+    if isinstance(c_text, bytes) or isinstance(c_text, bytearray):
+        c_text = c_text.encode("utf-8")
+    cipher = AES.new(AES_key, AES.MODE_CBC, AES_IV)
+    c_text_bytes = base64.b64decode(c_text)
+    p_text = cipher.decrypt(c_text_bytes)
+    p_text = unpadBytes(p_text)
+    return p_text.decode("utf-8")
+
+def decryptPrefix(AES_key, AES_IV, c_text, max_bytes):
+    # decrypts only the first max_bytes (rounded up to whole blocks) of a base64 value, returns bytes
+    # CBC blocks only depend on the cipher block before them, so the start of a message can be read on its own
+    # padding is not removed, if the value is shorter than max_bytes it is just decrypted whole
+    blocks = (max_bytes + 15) // 16
+    b64_chars = ((blocks * 16 + 2) // 3) * 4
+    c_bytes = binascii.a2b_base64(c_text[:b64_chars])
+    c_bytes = c_bytes[:len(c_bytes) - len(c_bytes) % 16]
+    cipher = AES.new(AES_key, AES.MODE_CBC, AES_IV)
+    return cipher.decrypt(c_bytes)
+
+def xorBytes(a_bytes, b_bytes):
+    # a_bytes and b_bytes are the same length and a multiple of the AES block size
+    if numpy is not None:
+        a_array = numpy.frombuffer(a_bytes, dtype=numpy.uint64)
+        b_array = numpy.frombuffer(b_bytes, dtype=numpy.uint64)
+        return numpy.bitwise_xor(a_array, b_array).tobytes()
+    return (int.from_bytes(a_bytes, "little") ^ int.from_bytes(b_bytes, "little")).to_bytes(len(a_bytes), "little")
+
+def decryptBatch(AES_key, AES_IV, c_texts):
+    # decrypts a list of base64 values, gives exactly what decryptString would for each one
+    # null or empty values are passed through untouched
+    # CBC decryption is ECB decryption XOR'd with the previous cipher block (the IV for the first block)
+    # and every value uses the same key and IV, so the whole list can go through AES in one call
+    p_texts = list(c_texts)
+    indexes = [index for index, c_text in enumerate(c_texts) if c_text]
+    if not indexes:
+        return p_texts
+    # each value carries its own base64 padding, so they have to be decoded separately
+    all_c_bytes = [binascii.a2b_base64(c_texts[index]) for index in indexes]
+    try:
+        ecb = AES.new(AES_key, AES.MODE_ECB)
+        decrypted = ecb.decrypt(b"".join(all_c_bytes))
+    except ValueError:
+        # something in here isn't a whole number of blocks, let decryptString sort out each value
+        for index in indexes:
+            p_texts[index] = decryptString(AES_key, AES_IV, c_texts[index])
+        return p_texts
+    chain = b"".join([AES_IV + c_bytes[:-16] for c_bytes in all_c_bytes])
+    p_bytes = xorBytes(decrypted, chain)
+    offset = 0
+    for index, c_bytes in zip(indexes, all_c_bytes):
+        end = offset + len(c_bytes)
+        p_texts[index] = unpadBytes(p_bytes[offset:end]).decode("utf-8")
+        offset = end
+    return p_texts
+
+# -- Process pool workers
+# These run in other processes, initDecryptWorker gives each one the key and IV once when it starts
+
+decryptWorkerKeys = {"AES_key":False, "AES_IV":False}
+
+def initDecryptWorker(AES_key, AES_IV):
+    decryptWorkerKeys["AES_key"] = AES_key
+    decryptWorkerKeys["AES_IV"] = AES_IV
+
+def decodeRowsInWorker(columns, encrypted_indexes, rows):
+    # decrypts a batch of raw row tuples, then pulls out the HTML part and the message id of message_string
+    # returns a list of (values, html, message id) in the same order as rows
+    AES_key = decryptWorkerKeys["AES_key"]
+    AES_IV = decryptWorkerKeys["AES_IV"]
+    allvalues = [list(row) for row in rows]
+    if AES_key:
+        for index in encrypted_indexes:
+            decrypted = decryptBatch(AES_key, AES_IV, [values[index] for values in allvalues])
+            for values, colval in zip(allvalues, decrypted):
+                values[index] = colval
+    message_index = None
+    if "message_string" in columns:
+        message_index = columns.index("message_string")
+    results = []
+    for values in allvalues:
+        html = False
+        message_id = None
+        if message_index is not None and values[message_index]:
+            m = html_re.search(values[message_index])
+            if m:
+                html = m.group()
+            m = message_id_re.search(values[message_index])
+            if m:
+                message_id = m.group(1)
+        results.append((values, html, message_id))
+    return results
+
 
 def checkMandatoryKwargs(listOfMandatoryKwargs, kwargDict):
     for arg in listOfMandatoryKwargs:
@@ -34,6 +169,853 @@ def checkKwargsWithDefaults(dictionaryOfDefaultKwargs, kwargDict):
             kwargDict[arg] = dictionaryOfDefaultKwargs[arg]
     return kwargDict
 
+def isConnectionError(badnews):
+    # True for pyodbc errors that mean the connection itself is gone (SQLSTATE class 08 is connection exceptions)
+    if isinstance(badnews, (pyodbc.OperationalError, pyodbc.InterfaceError)):
+        return True
+    return isinstance(badnews, pyodbc.Error) and len(badnews.args) > 0 and str(badnews.args[0]).startswith("08")
+
+def parseSearchTime(value):
+    # search times are strings like 2021-02-19T17:11:00 (UTC) or datetimes, False/None for no limit
+    # the format is strict, anything else is a SyntaxError before it gets near a query
+    if not value:
+        return False
+    if isinstance(value, datetime):
+        return value
+    if not search_time_re.match(value):
+        raise SyntaxError("Times must be like 2021-02-19T17:11:00 (YYYY-MM-DDTHH:MM:SS)")
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+class searchCancelled(Exception):
+    # raised in a search that was stopped with jabberArchiveTools.cancel (or archiveJob.cancel)
+    pass
+
+# columns each kind of caller reads, for the columns parameter of the message queries (see jabberArchiveTools.planColumns)
+# "all" is select *, anything not selected isn't fetched or decrypted
+column_projections = {
+    "all":None,
+    "text":["sent_date", "from_jid", "to_jid", "body_string"],        # makeMessageDump / makeChatroomDump
+    "html":["sent_date", "from_jid", "to_jid", "message_string"],     # makeChatLogFile / makeChatroomLogFile
+    "membership":["to_jid"],
+}
+
+# start of the result cache window for searches without a start time (see jabberArchiveTools.iterCachedSearch)
+result_cache_epoch = datetime(1900, 1, 1)
+
+# the few bits of SQL that differ between the archive server and a local SQLite copy (see jabberSQLiteBackend)
+sql_dialects = {
+    # 15 minute slots since 1970, fine enough for every timezone offset (some are on the half or quarter hour)
+    "mssql":{"epoch_slot":"(datediff(minute, '19700101', sent_date) / 15)",
+             # message bodies can be nvarchar(max), which is grouped on by its hash
+             "body_hash":"hashbytes('SHA2_256', body_string)"},
+    "sqlite":{"epoch_slot":"(cast(strftime('%s', sent_date) as integer) / 900)",
+              "body_hash":"body_string"},
+}
+
+def makeQueryTemplates(table, dialect="mssql"):
+    # SQL text for every query, built once per table name
+    # user conditions and time bounds go in with ? parameters, so the text (and the server's cached plan) is reused between calls
+    epoch_slot = sql_dialects[dialect]["epoch_slot"]
+    body_hash = sql_dialects[dialect]["body_hash"]
+    return {
+        "messages":"select {} from " + table + " where {} {} order by sent_date",
+        "count":"select count(*) from " + table + " where {} {}",
+        "distinct":"select distinct({}) from " + table,
+        "distinct_where":"select distinct({}) from " + table + " where {}",
+        "distinct_pairs_where":"select distinct {}, {} from " + table + " where {}",
+        "jid_counts":"select {0}, count(*), min(sent_date), max(sent_date) from " + table + "{1} group by {0}",
+        # a chatroom resends its history to a new member all at the join time, distinct times counts that once
+        "jid_pair_counts":"select from_jid, to_jid, count(*), min(sent_date), max(sent_date), count(distinct sent_date) from " + table + " where {} {} group by from_jid, to_jid",
+        # messages per jid and 15 minute slot, for a user's one to one messages (a chatroom's posts go through activity_posted)
+        "activity_sent":"select from_jid, " + epoch_slot + ", count(*) from " + table + " where {} {} group by from_jid, " + epoch_slot,
+        "activity_received":"select to_jid, " + epoch_slot + ", count(*) from " + table + " where {} {} group by to_jid, " + epoch_slot,
+        # messages posted in a chatroom per slot, each (sender, body) counted once at the first time it is seen, so
+        # the copies to every member and the history resent to a member who joins are left out (body_string is
+        # deterministic ciphertext, the same text encrypts the same)
+        "activity_posted":"select from_jid, " + epoch_slot + ", count(*) from (select from_jid, min(sent_date) as sent_date from " + table +
+                          " where {} {} and body_string is not null group by from_jid, " + body_hash + ") posts group by from_jid, " + epoch_slot,
+    }
+
+activity_buckets = {"hour":3600, "day":86400, "week":7*86400}
+activity_slot_seconds = 900
+
+def rebucketActivity(slotCounts, bucket="day", timezone="UTC"):
+    """
+    slotCounts is {UTC 15 minute slots since 1970:[sent, received]}
+    Returns [{"start":naive local datetime, "sent":n, "received":n}, ...] per local hour, day or week (weeks start on Monday),
+    oldest first, buckets without messages are left out
+    With NumPy the buckets are summed with bincount instead of a dictionary update per slot
+    """
+    if bucket not in activity_buckets:
+        raise SyntaxError("Activity bucket must be one of {}".format(", ".join(activity_buckets)))
+    bucket_seconds = activity_buckets[bucket]
+    # 1970-01-01 was a Thursday, weeks are counted from Monday 1970-01-05
+    anchor = 4 * 86400 if bucket == "week" else 0
+    tz = pytz.timezone(timezone)
+    epoch = datetime(1970, 1, 1)
+    if not slotCounts:
+        return []
+    # the keys are distinct slots, each gets the offset its UTC time has in the zone
+    local_seconds = []
+    for slot in slotCounts:
+        utc_time = pytz.utc.localize(epoch + timedelta(seconds=slot * activity_slot_seconds))
+        local_seconds.append(slot * activity_slot_seconds + int(utc_time.astimezone(tz).utcoffset().total_seconds()))
+    if numpy is None:
+        buckets = {}
+        for seconds, counts in zip(local_seconds, slotCounts.values()):
+            key = (seconds - anchor) // bucket_seconds
+            total = buckets.setdefault(key, [0, 0])
+            total[0] += counts[0]
+            total[1] += counts[1]
+        return [{"start":epoch + timedelta(seconds=key * bucket_seconds + anchor), "sent":total[0], "received":total[1]}
+                for key, total in sorted(buckets.items())]
+
+    counts = numpy.array(list(slotCounts.values()), dtype=numpy.int64).reshape(-1, 2)
+    keys = (numpy.array(local_seconds, dtype=numpy.int64) - anchor) // bucket_seconds
+    unique_keys, inverse = numpy.unique(keys, return_inverse=True)
+    sent = numpy.bincount(inverse, weights=counts[:, 0], minlength=len(unique_keys))
+    received = numpy.bincount(inverse, weights=counts[:, 1], minlength=len(unique_keys))
+    return [{"start":epoch + timedelta(seconds=int(key) * bucket_seconds + anchor), "sent":int(sentCount), "received":int(receivedCount)}
+            for key, sentCount, receivedCount in zip(unique_keys, sent, received)]
+
+class boundedCache:
+    # LRU dictionary of str -> str bounded by entry count and by the total characters of keys + values
+    # Used to memoize decryption (and encryption) since the archive key and IV never change,
+    # so the same ciphertext always decrypts to the same plaintext
+    # Locked so sharded queries can decode in worker threads
+
+    def __init__(self, max_entries=10000, max_bytes=16*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # returns None on a miss
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def countHits(self, hits):
+        # for lookups answered without the cache (like repeats within one batch)
+        with self.lock:
+            self.hits += hits
+
+    def put(self, key, value):
+        size = len(key) + len(value)
+        with self.lock:
+            if size > self.max_bytes or key in self.entries:
+                return
+            self.entries[key] = value
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                oldkey, oldvalue = self.entries.popitem(last=False)
+                self.bytes -= len(oldkey) + len(oldvalue)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {"hits":self.hits, "misses":self.misses, "evictions":self.evictions,
+                "entries":len(self.entries), "bytes":self.bytes}
+
+class searchStats:
+    """
+    Counters and timers for where searches spend their time, see jabberArchiveTools.getStats
+    Phases are in seconds: row_count (exact/estimate checks), query (execute), fetch (fetchmany), decrypt (AES and the caches),
+    filter (jid checks), dedup (chatroom message ids), render (exporters), cache (reading and writing the result cache)
+    Shards and the process pool run phases at the same time, so the phases can add up to more than the elapsed time
+    rows_filtered_out of rows_jid_checked are the rows the server matched on a jid prefix that were someone else's
+
+    Instrumented code does started = stats.clock() ... stats.add(phase, started, counter=n)
+    When enabled is False, clock() and add() return straight away, so that is all it costs
+    """
+    phases = ("row_count", "query", "fetch", "decrypt", "filter", "dedup", "render", "cache")
+    counters = ("queries", "rows_fetched", "rows_jid_checked", "rows_filtered_out", "rows_deduped", "rows_written",
+                "values_decrypted", "bytes_decrypted", "bytes_written", "rows_from_cache", "rows_cached")
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.seconds = dict.fromkeys(self.phases, 0.0)
+            self.counts = dict.fromkeys(self.counters, 0)
+            self.started = time.perf_counter()
+
+    def clock(self):
+        if not self.enabled:
+            return 0
+        return time.perf_counter()
+
+    def add(self, phase, started, **counts):
+        if not self.enabled:
+            return
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.seconds[phase] += elapsed
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def asDict(self):
+        with self.lock:
+            return {"enabled":self.enabled, "elapsed":time.perf_counter() - self.started,
+                    "seconds":dict(self.seconds), "counts":dict(self.counts)}
+
+    def report(self):
+        # readable version of asDict
+        stats = self.asDict()
+        lines = ["Elapsed {:.3f}s".format(stats["elapsed"])]
+        for phase in self.phases:
+            lines.append("  {:<10} {:10.3f}s".format(phase, stats["seconds"][phase]))
+        for name in self.counters:
+            lines.append("  {:<18} {}".format(name, stats["counts"][name]))
+        if stats["counts"]["rows_jid_checked"]:
+            # rows the server sent for a jid condition that turned out to be another user
+            lines.append("  jid false positives {:.2%}".format(stats["counts"]["rows_filtered_out"] / stats["counts"]["rows_jid_checked"]))
+        return "\n".join(lines)
+
+class localTimeConverter:
+    # Converts the UTC sent_date of messages to a local timezone for the exporters
+    # Timezone offsets only change on quarter-hour boundaries, so the pytz lookup is done once per
+    # 15 minute window and every other message in that window is just shifted by the cached offset
+
+    WINDOW_SECONDS = 900
+
+    def __init__(self, timezone, max_windows=100000):
+        self.tz = pytz.timezone(timezone)
+        self.max_windows = max_windows
+        self.windows = {}
+
+    def convert(self, utc_time):
+        # same result as datetime.fromtimestamp(utc_time.timestamp(), tz=self.tz)
+        timestamp = utc_time.timestamp()
+        if utc_time.tzinfo is None:
+            # naive times are treated as local by timestamp(), nothing to cache
+            return datetime.fromtimestamp(timestamp, tz=self.tz)
+        window = int(timestamp // self.WINDOW_SECONDS)
+        found = self.windows.get(window)
+        if found is None:
+            local_time = datetime.fromtimestamp(timestamp, tz=self.tz)
+            if len(self.windows) >= self.max_windows:
+                self.windows.clear()
+            self.windows[window] = (local_time.utcoffset() - utc_time.utcoffset(), local_time.tzinfo)
+            return local_time
+        offset, tzinfo = found
+        return (utc_time + offset).replace(tzinfo=tzinfo)
+
+class bufferedLineWriter:
+    # Collects output lines and writes them out in large chunks
+    # Used for stdout, where each print() call would otherwise be a separate write
+
+    def __init__(self, stream, max_lines=1000):
+        self.stream = stream
+        self.max_lines = max_lines
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.stream.write("".join(self.lines))
+            self.lines = []
+        self.stream.flush()
+
+    def close(self):
+        # only flushes, the stream belongs to someone else
+        self.flush()
+
+class jidDirectory:
+    """
+    Local directory of every jid in the archive so show users/show chatrooms don't have to scan the whole table
+    Entries are keyed on the jid exactly as it is stored in the archive (the ciphertext when encrypted):
+        stored jid: [plaintext jid, first sent_date, last sent_date, messages sent, messages received]
+    The watermark is the newest sent_date seen, refreshes only read rows newer than it
+    Rows written to the archive later with an older sent_date than the watermark won't be picked up
+    The file is plain JSON and holds decrypted user names, treat it like the archive itself
+    Clones of a jabberArchiveTools share one directory, lock is held while it is refreshed or scanned
+    """
+
+    VERSION = 1
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+    def __init__(self, filename=False, table="jm", key_fingerprint=""):
+        self.filename = filename
+        self.table = table
+        self.key_fingerprint = key_fingerprint
+        self.entries = {}
+        self.watermark = None
+        # time.time() of the last refresh in this session
+        self.refreshed = None
+        # bare jid -> list of stored jids, rebuilt when entries change
+        self.bare_index = None
+        self.lock = threading.RLock()
+        if self.filename and os.path.exists(self.filename):
+            self.load()
+
+    def load(self):
+        with open(self.filename, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        if saved.get("version") != self.VERSION or saved.get("table") != self.table or saved.get("key") != self.key_fingerprint:
+            # built against something else, start over
+            logger.info("Jid directory {} does not match this archive, rebuilding it".format(self.filename))
+            return
+        self.entries = {}
+        for stored_jid, entry in saved["entries"].items():
+            entry[1] = datetime.strptime(entry[1], self.TIME_FORMAT)
+            entry[2] = datetime.strptime(entry[2], self.TIME_FORMAT)
+            self.entries[stored_jid] = entry
+        if saved["watermark"]:
+            self.watermark = datetime.strptime(saved["watermark"], self.TIME_FORMAT)
+        self.bare_index = None
+
+    def save(self):
+        if not self.filename:
+            return
+        entries = {}
+        for stored_jid, entry in self.entries.items():
+            entries[stored_jid] = [entry[0], entry[1].strftime(self.TIME_FORMAT), entry[2].strftime(self.TIME_FORMAT), entry[3], entry[4]]
+        watermark = None
+        if self.watermark is not None:
+            watermark = self.watermark.strftime(self.TIME_FORMAT)
+        tempname = self.filename + ".tmp"
+        with open(tempname, "w", encoding="utf-8") as f:
+            json.dump({"version":self.VERSION, "table":self.table, "key":self.key_fingerprint,
+                       "watermark":watermark, "entries":entries}, f)
+        os.replace(tempname, self.filename)
+
+    def addCounts(self, stored_jid, plain_jid, count, first, last, received=False):
+        # adds a group by result for one jid, received is True for to_jid counts
+        entry = self.entries.get(stored_jid)
+        if entry is None:
+            entry = [plain_jid, first, last, 0, 0]
+            self.entries[stored_jid] = entry
+            self.bare_index = None
+        entry[1] = min(entry[1], first)
+        entry[2] = max(entry[2], last)
+        if received:
+            entry[4] += count
+        else:
+            entry[3] += count
+        if self.watermark is None or last > self.watermark:
+            self.watermark = last
+
+    def findStoredJids(self, username):
+        # stored jids of every resource variant of a user, the same ones makeJidPrefix matches: a bare jid matches
+        # itself and username/..., not other users whose jids just start the same.  Anything else is taken as a prefix
+        with self.lock:
+            if "@" in username and "/" not in username:
+                prefix = username + "/"
+                return [stored_jid for stored_jid, entry in self.entries.items() if entry[0] == username or entry[0].startswith(prefix)]
+            return [stored_jid for stored_jid, entry in self.entries.items() if entry[0].startswith(username)]
+
+    def getBareIndex(self):
+        with self.lock:
+            if self.bare_index is None:
+                bare_index = {}
+                for stored_jid, entry in self.entries.items():
+                    bare_index.setdefault(entry[0].split("/")[0], []).append(stored_jid)
+                self.bare_index = bare_index
+            return self.bare_index
+
+    def bareJids(self):
+        # sorted list of all jids with the resource suffix removed
+        bare = list(self.getBareIndex().keys())
+        bare.sort()
+        return bare
+
+    def getJidInfo(self, bare_jid):
+        # everything known about this bare jid, or False if it isn't in the directory
+        stored_jids = self.getBareIndex().get(bare_jid)
+        if not stored_jids:
+            return False
+        entries = [self.entries[stored_jid] for stored_jid in stored_jids]
+        resources = [entry[0][len(bare_jid)+1:] for entry in entries if "/" in entry[0]]
+        resources.sort()
+        return {
+                "jid":bare_jid,
+                "resources":resources,
+                "first_sent_date":min(entry[1] for entry in entries),
+                "last_sent_date":max(entry[2] for entry in entries),
+                "messages_sent":sum(entry[3] for entry in entries),
+                "messages_received":sum(entry[4] for entry in entries),
+                }
+
+class resultCache:
+    """
+    Encrypted on-disk cache of search results, for time windows that are over (archive rows for the past don't change)
+    Results are kept per scope (the search, its users and the columns) as segments: half open [start, end) UTC windows
+    holding every result row of that scope in them.  A search is answered from the segments it overlaps and only the
+    gaps between them go to the server, which then become new segments (see jabberArchiveTools.iterCachedSearch)
+    Segments are zlib compressed JSON lines encrypted with AES-GCM, so a changed file is caught too.  They are written
+    as the rows come in (see segmentWriter), and lazy columns that were never read keep their archive ciphertext.
+    The index is encrypted the same way and scopes are named by an HMAC, so user names aren't readable in it either
+    Once the segments add up to more than max_bytes the least recently used ones are deleted
+    """
+
+    VERSION = 2
+    TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+    def __init__(self, directory, key, max_bytes=512*1024*1024):
+        self.directory = directory
+        self.key = key
+        self.max_bytes = max_bytes
+        # scope id -> list of segments sorted by start, a segment is [start, end, filename, bytes, last used]
+        self.scopes = {}
+        self.lock = threading.RLock()
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+
+    def seal(self, data):
+        # nonce + tag + AES-GCM ciphertext of the compressed data
+        nonce = os.urandom(12)
+        c_bytes, tag = AES.new(self.key, AES.MODE_GCM, nonce=nonce).encrypt_and_digest(zlib.compress(data))
+        return nonce + tag + c_bytes
+
+    def unseal(self, sealed):
+        # raises ValueError if the file was changed or made with another key
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=sealed[:12])
+        return zlib.decompress(cipher.decrypt_and_verify(sealed[28:], sealed[12:28]))
+
+    def writeFile(self, filename, data):
+        tempname = os.path.join(self.directory, filename + ".tmp")
+        with open(tempname, "wb") as f:
+            f.write(self.seal(data))
+        os.replace(tempname, os.path.join(self.directory, filename))
+
+    def readFile(self, filename):
+        with open(os.path.join(self.directory, filename), "rb") as f:
+            return self.unseal(f.read())
+
+    def scopeId(self, scope):
+        # scope is anything JSON can take, like (table, method, users, columns)
+        return hmac.new(self.key, json.dumps(scope).encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def load(self):
+        try:
+            saved = json.loads(self.readFile("index"))
+        except FileNotFoundError:
+            return
+        except (ValueError, zlib.error):
+            logger.info("Result cache index in {} can't be read with this key, starting over".format(self.directory))
+            return
+        if saved.get("version") != self.VERSION:
+            # segments from an older version can't be read, they are deleted instead of lingering past max_bytes
+            for segments in saved.get("scopes", {}).values():
+                for segment in segments:
+                    try:
+                        os.remove(os.path.join(self.directory, segment[2]))
+                    except (OSError, IndexError, TypeError):
+                        pass
+            return
+        for scope_id, segments in saved["scopes"].items():
+            self.scopes[scope_id] = [[datetime.strptime(start, self.TIME_FORMAT), datetime.strptime(end, self.TIME_FORMAT),
+                                      filename, size, used] for start, end, filename, size, used in segments]
+
+    def save(self):
+        scopes = {}
+        for scope_id, segments in self.scopes.items():
+            scopes[scope_id] = [[start.strftime(self.TIME_FORMAT), end.strftime(self.TIME_FORMAT), filename, size, used]
+                                for start, end, filename, size, used in segments]
+        self.writeFile("index", json.dumps({"version":self.VERSION, "scopes":scopes}).encode("utf-8"))
+
+    def segments(self, scope_id):
+        with self.lock:
+            return list(self.scopes.get(scope_id, []))
+
+    def readSegment(self, scope_id, segment):
+        # the rows of a segment as a list of (columns, [(pending, values), ...]), see segmentWriter.add
+        # None if its file is gone or damaged (the segment is dropped)
+        try:
+            rows = []
+            for line in self.readFile(segment[2]).splitlines():
+                item = json.loads(line, object_hook=decodeCachedValue)
+                if isinstance(item, dict):
+                    rows.append((item["columns"], []))
+                else:
+                    rows[-1][1].append((item[0], item[1:]))
+        except (OSError, ValueError, KeyError, IndexError, zlib.error):
+            with self.lock:
+                evicted = segment not in self.scopes.get(scope_id, [])
+            if not evicted:
+                logger.info("Dropping unreadable result cache segment {}".format(segment[2]))
+                self.dropSegment(scope_id, segment)
+            return None
+        with self.lock:
+            segment[4] = time.time()
+        return rows
+
+    def newSegment(self):
+        # a segmentWriter for the rows of a new segment, addSegment or discard it when they are all written
+        return segmentWriter(self)
+
+    def addSegment(self, scope_id, start, end, writer):
+        # keeps the rows written with writer as the complete results for [start, end), unless another search got there first
+        writer.finish()
+        filename = writer.filename
+        with self.lock:
+            segments = self.scopes.setdefault(scope_id, [])
+            if any(other[0] < end and start < other[1] for other in segments):
+                if not segments:
+                    del self.scopes[scope_id]
+                writer.discard()
+                return False
+            os.replace(writer.tempname, os.path.join(self.directory, filename))
+            segments.append([start, end, filename, os.path.getsize(os.path.join(self.directory, filename)), time.time()])
+            segments.sort(key=lambda segment: segment[0])
+            self.evict()
+            self.save()
+        return True
+
+    def dropSegment(self, scope_id, segment):
+        with self.lock:
+            segments = self.scopes.get(scope_id, [])
+            if segment in segments:
+                segments.remove(segment)
+                if not segments:
+                    del self.scopes[scope_id]
+                self.save()
+        try:
+            os.remove(os.path.join(self.directory, segment[2]))
+        except OSError:
+            pass
+
+    def evict(self):
+        # deletes least recently used segments until they fit in max_bytes
+        with self.lock:
+            allSegments = [(segment[4], scope_id, segment) for scope_id, segments in self.scopes.items() for segment in segments]
+            total = sum(segment[3] for used, scope_id, segment in allSegments)
+            allSegments.sort(key=lambda item: item[0])
+            for used, scope_id, segment in allSegments:
+                if total <= self.max_bytes:
+                    break
+                total -= segment[3]
+                self.scopes[scope_id].remove(segment)
+                if not self.scopes[scope_id]:
+                    del self.scopes[scope_id]
+                try:
+                    os.remove(os.path.join(self.directory, segment[2]))
+                except OSError:
+                    pass
+
+    def touch(self):
+        # keeps the last used times of the segments just read
+        with self.lock:
+            self.save()
+
+    def clear(self):
+        with self.lock:
+            for segments in self.scopes.values():
+                for segment in segments:
+                    try:
+                        os.remove(os.path.join(self.directory, segment[2]))
+                    except OSError:
+                        pass
+            self.scopes = {}
+            self.save()
+
+    def stats(self):
+        with self.lock:
+            return {"scopes":len(self.scopes), "segments":sum(len(segments) for segments in self.scopes.values()),
+                    "bytes":sum(segment[3] for segments in self.scopes.values() for segment in segments)}
+
+class segmentWriter:
+    # Writes a result cache segment while its rows are still coming in, each row is compressed and encrypted into
+    # a temporary file as it is added so a big window isn't held in memory.  The file ends up the same as writeFile
+    # would make it (nonce + tag + AES-GCM ciphertext), the tag is filled in by finish()
+    # The rows are JSON lines: {"columns":[...]} and then [pending, value, value...] for each row with those columns,
+    # pending being the messageRecord bitmask of the values that are still the archive's ciphertext
+
+    def __init__(self, cache):
+        self.filename = os.urandom(16).hex()
+        self.tempname = os.path.join(cache.directory, self.filename + ".tmp")
+        nonce = os.urandom(12)
+        self.cipher = AES.new(cache.key, AES.MODE_GCM, nonce=nonce)
+        self.compressor = zlib.compressobj()
+        self.file = open(self.tempname, "wb")
+        self.file.write(nonce + bytes(16))
+        self.columns = None
+        self.rows = 0
+
+    def add(self, columns, values, pending=0):
+        lines = []
+        if columns != self.columns:
+            self.columns = columns
+            lines.append(json.dumps({"columns":columns}))
+        lines.append(json.dumps([pending] + list(values), default=encodeCachedValue, separators=(",", ":")))
+        self.write(("\n".join(lines) + "\n").encode("utf-8"))
+        self.rows += 1
+
+    def addRow(self, row):
+        # a processed row, messageRecords are written without decrypting their lazy columns
+        if isinstance(row, messageRecord):
+            self.add(row.decoder.columns, row.values, row.pending)
+        else:
+            columns = list(row.keys())
+            self.add(columns, [row[column] for column in columns])
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.file.write(self.cipher.encrypt(compressed))
+
+    def finish(self):
+        self.file.write(self.cipher.encrypt(self.compressor.flush()))
+        self.file.seek(12)
+        self.file.write(self.cipher.digest())
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.tempname)
+        except OSError:
+            pass
+
+def encodeCachedValue(value):
+    # json.dumps default for the result cache, sent_date and the like (processed rows have it in UTC)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            return {"$utc":value.astimezone(pytz.utc).strftime(resultCache.TIME_FORMAT)}
+        return {"$datetime":value.strftime(resultCache.TIME_FORMAT)}
+    raise TypeError("Can't cache a {}".format(type(value).__name__))
+
+def decodeCachedValue(value):
+    if "$utc" in value:
+        return datetime.strptime(value["$utc"], resultCache.TIME_FORMAT).replace(tzinfo=pytz.utc)
+    if "$datetime" in value:
+        return datetime.strptime(value["$datetime"], resultCache.TIME_FORMAT)
+    return value
+
+class connectionPool:
+    # Hands out extra pyodbc connections for work that runs alongside the main cursor (like query shards)
+    # Connections are made on demand with the factory and kept for reuse, up to max_idle of them
+    # A connection that has sat idle longer than health_check_seconds is pinged before it is handed out,
+    # and replaced with a new one if the ping fails
+
+    def __init__(self, connection_factory, max_idle=8, health_check_seconds=30, health_check_query="select 1"):
+        self.connection_factory = connection_factory
+        self.max_idle = max_idle
+        self.health_check_seconds = health_check_seconds
+        self.health_check_query = health_check_query
+        self.idle = []      # (connection, time it was released)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                connection, released = self.idle.pop()
+            if time.time() - released < self.health_check_seconds or self.isHealthy(connection):
+                return connection
+            logger.info("Dropping a pooled connection that failed its health check")
+            self.discard(connection)
+        return self.connection_factory()
+
+    def isHealthy(self, connection):
+        try:
+            cursor = connection.cursor()
+            cursor.execute(self.health_check_query)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def release(self, connection, broken=False):
+        # broken connections (see isConnectionError) are closed instead of going back in the pool
+        if not broken:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append((connection, time.time()))
+                    return
+        self.discard(connection)
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @contextlib.contextmanager
+    def cursor(self):
+        # with pool.cursor() as cursor: runs on a pooled connection, which is thrown away if it broke
+        connection = self.acquire()
+        broken = False
+        try:
+            yield connection.cursor()
+        except pyodbc.Error as badnews:
+            broken = isConnectionError(badnews)
+            raise
+        finally:
+            self.release(connection, broken)
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for connection, released in idle:
+            self.discard(connection)
+
+class messageRecord(Mapping):
+    """
+    One processed row, read like the dictionary processRow used to return (msg["body_string"], "to_jid" in msg, .items() ...)
+    Lazy columns keep their ciphertext until they are first read, then the plaintext replaces it
+    pending is a bitmask of the column indexes still encrypted
+    """
+    __slots__ = ("decoder", "values", "pending")
+
+    def __init__(self, decoder, values, pending=0):
+        self.decoder = decoder
+        self.values = values
+        self.pending = pending
+
+    def __getitem__(self, key):
+        index = self.decoder.column_indexes[key]
+        if self.pending >> index & 1:
+            self.values[index] = self.decoder.decrypt_function(self.values[index], key)
+            self.pending &= ~(1 << index)
+        return self.values[index]
+
+    def __iter__(self):
+        return iter(self.decoder.columns)
+
+    def __len__(self):
+        return len(self.decoder.columns)
+
+    def __contains__(self, key):
+        return key in self.decoder.column_indexes
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def ciphertext(self, key):
+        # the stored ciphertext of key if it hasn't been decrypted yet, otherwise None
+        index = self.decoder.column_indexes[key]
+        if self.pending >> index & 1:
+            return self.values[index]
+        return None
+
+    def __reduce__(self):
+        # pickles (and copies) as a plain decrypted dictionary, the decoder can't go along
+        return (dict, (dict(self),))
+
+class messageDeduplicator:
+    """
+    Streaming de-duplication on message ids, for chat rooms that resend their history when someone joins
+    Only a fixed size hash of each id is kept.  With window_seconds, ids are forgotten once they are that much older
+    than the newest message seen (messages have to come in sent_date order), which bounds memory since the
+    resends come soon after the original.  Without it every id is kept, which is exact
+    """
+
+    def __init__(self, window_seconds=False, digest_size=16):
+        self.window = None
+        if window_seconds:
+            self.window = timedelta(seconds=window_seconds)
+        self.digest_size = digest_size
+        self.seen = set()
+        self.order = deque()    # (sent_date, hash) oldest first, only used with a window
+
+    def isNew(self, message_id, sent_date=None):
+        # message_id is bytes, returns True the first time it is seen (within the window)
+        digest = hashlib.blake2b(message_id, digest_size=self.digest_size).digest()
+        if self.window is not None and sent_date is not None:
+            oldest = sent_date - self.window
+            while self.order and self.order[0][0] < oldest:
+                self.seen.discard(self.order.popleft()[1])
+        if digest in self.seen:
+            return False
+        self.seen.add(digest)
+        if self.window is not None and sent_date is not None:
+            self.order.append((sent_date, digest))
+        return True
+
+class rowDecoder:
+    # Compiled once per query from cursor.description, then used on every row of the result
+    # Column positions, which columns need decrypting and the UTC tz are all worked out up front
+    # so decoding a row is just a loop over the encrypted positions
+    # Encrypted columns in lazy_columns are left for messageRecord to decrypt when (if) they are read
+
+    def __init__(self, description, decrypt_function=False, encrypted_columns=[], batch_decrypt_function=False, lazy_columns=[]):
+        self.description = description
+        self.columns = [column[0] for column in description]
+        self.column_indexes = dict((col, index) for index, col in reversed(list(enumerate(self.columns))))
+        self.decrypt_function = decrypt_function
+        self.batch_decrypt_function = batch_decrypt_function
+        # decrypt functions are called with (value, column) so each column can use its own cache
+        self.encrypted_indexes = ()
+        if decrypt_function:
+            self.encrypted_indexes = tuple((index, col) for index, col in enumerate(self.columns) if col in encrypted_columns)
+        self.eager_indexes = tuple((index, col) for index, col in self.encrypted_indexes if col not in lazy_columns)
+        self.lazy_indexes = tuple(index for index, col in self.encrypted_indexes if col in lazy_columns)
+        self.sent_date_index = None
+        if "sent_date" in self.columns:
+            self.sent_date_index = self.columns.index("sent_date")
+        self.utc = pytz.utc
+
+    def decodeRow(self, row):
+        # returns a messageRecord of this row, decrypted as needed
+        values = list(row)
+        decrypt = self.decrypt_function
+        for index, col in self.eager_indexes:
+            colval = values[index]
+            # might be null or none
+            if colval:
+                values[index] = decrypt(colval, col)
+        return self.makeRecord(values)
+
+    def decodeBatch(self, rows):
+        # returns a list of messageRecords for a fetchmany batch
+        # in batch mode each eager encrypted column is decrypted for the whole batch at once
+        if not self.batch_decrypt_function or not self.eager_indexes:
+            return [self.decodeRow(row) for row in rows]
+        allvalues = [list(row) for row in rows]
+        for index, col in self.eager_indexes:
+            decrypted = self.batch_decrypt_function([values[index] for values in allvalues], col)
+            for values, colval in zip(allvalues, decrypted):
+                values[index] = colval
+        return [self.makeRecord(values) for values in allvalues]
+
+    def makePipelineRecord(self, values, html, message_id):
+        # record for a row decoded by decodeRowsInWorker, the HTML and message id it found are kept
+        # as message_html and message_id so the exporters and chatroom dedup don't have to redo them
+        # the workers have already decrypted everything, so this is a plain dictionary
+        if self.sent_date_index is not None and values[self.sent_date_index] is not None:
+            values[self.sent_date_index] = values[self.sent_date_index].replace(tzinfo=self.utc)
+        record = dict(zip(self.columns, values))
+        if "message_string" in record:
+            record["message_html"] = html
+            record["message_id"] = message_id
+        return record
+
+    def makeRecord(self, values):
+        if self.sent_date_index is not None and values[self.sent_date_index] is not None:
+            values[self.sent_date_index] = values[self.sent_date_index].replace(tzinfo=self.utc)
+        pending = 0
+        for index in self.lazy_indexes:
+            # might be null or none
+            if values[index]:
+                pending |= 1 << index
+        return messageRecord(self, values, pending)
+
 class jabberArchiveTools:
 
     def __init__(self, **kwargs):
@@ -43,19 +1025,96 @@ class jabberArchiveTools:
         self.cursor = self.kwargs["pyodbc_connection"].cursor()
         dictionaryOfDefaultKwargs = {
                                         "table":"jm",           # Table where the messages are
+                                        "sql_dialect":"mssql",  # mssql for the archive server, sqlite for a local copy (see jabberSQLiteBackend)
                                         "AES_key_hex":False,    # Must supply if jabber archive is encrypted
                                         "AES_IV_hex":False,     # Must supply if jabber archive is encrypted
                                         "row_count_alert_threshold":100,
-                                        "encrypted_columns": ["to_jid", "from_jid", "body_string", "message_string"] # These columns must be processed
+                                        # how the row count threshold is checked for message queries:
+                                        #   bounded - read up to threshold + 1 rows of the real query, no extra query
+                                        #   exact - run a count(*) of the query first (scans everything twice)
+                                        #   estimate - ask SQL Server for its estimated row count from the query plan (statistics, no scan)
+                                        "row_count_mode":"bounded",
+                                        "fetch_batch_size":1000,  # rows pulled per fetchmany when streaming results
+                                        "batch_decrypt":True,     # decrypt each fetchmany batch together instead of one value at a time
+                                        # encrypted columns only decrypted when a record's value is first read (the jids are always
+                                        # read for filtering, so they are decrypted up front with the batch)
+                                        "lazy_decrypt_columns":["body_string", "message_string"],
+                                        "dedup_window_seconds":False,   # chatroom logs forget message ids this much older than the newest message, False keeps them all
+                                        "dedup_prefix_bytes":512,       # how much of a still encrypted message_string is decrypted to look for its id
+                                        "collect_stats":False,          # time each phase of the searches (see getStats), can be changed with stats.enabled
+                                        "encrypted_columns": ["to_jid", "from_jid", "body_string", "message_string"], # These columns must be processed
+                                        # LRU memo of ciphertext -> plaintext per column, a column left out is not cached
+                                        # jids repeat on nearly every row, bodies repeat when chatrooms resend on join
+                                        "decrypt_cache_policy": {
+                                                                    "to_jid":{"max_entries":50000, "max_bytes":16*1024*1024},
+                                                                    "from_jid":{"max_entries":50000, "max_bytes":16*1024*1024},
+                                                                    "body_string":{"max_entries":20000, "max_bytes":32*1024*1024},
+                                                                    "message_string":{"max_entries":5000, "max_bytes":32*1024*1024},
+                                                                },
+                                        # LRU memo of plaintext -> ciphertext for query parameters, False to turn off
+                                        "encrypt_cache_policy": {"max_entries":1000, "max_bytes":1024*1024},
+                                        "export_buffer_size":1024*1024, # write buffer for the exporters
+                                        "jid_directory_file":False,     # JSON file to keep the jid directory in between sessions, False keeps it in memory
+                                        "jid_directory_refresh_seconds":300, # how stale the jid directory can get before it is refreshed
+                                        "exact_jid_lookup":True,        # once there is a jid directory, match known users on their exact stored jids instead of a prefix LIKE
+                                        "in_list_batch_size":100,       # stored jids per IN (...) list
+                                        "in_list_max_params":500,       # more stored jids than this for one user and the prefix LIKE is used instead
+                                        "max_query_params":2000,        # most ? parameters put in one query (SQL Server allows 2100)
+                                        "pyodbc_connection_factory":False, # callable returning a new connection, needed for query_shards and reconnecting
+                                        "pool_health_check_seconds":30, # pooled connections idle longer than this are pinged before reuse
+                                        "query_shards":1,               # split message queries with a start and end time into this many time shards run in parallel
+                                        "shard_prefetch_batches":8,     # decoded batches each shard can get ahead of the merge
+                                        "decrypt_workers":0,            # processes used to decrypt and parse message query results, 0 does it all in this process
+                                        # encrypted on-disk cache of message search results for past time windows (see resultCache), False to turn off
+                                        "result_cache_dir":False,
+                                        "result_cache_max_bytes":512*1024*1024, # least recently used results are deleted past this
+                                        "result_cache_settle_seconds":3600,     # rows newer than this may still be arriving, so they aren't cached
+                                        "result_cache_max_rows":200000,         # a window with more rows than this is fetched but not cached
+                                        "result_cache_key_hex":False,           # key for the cache, by default one is derived from AES_key_hex
                                     }
         self.kwargs = checkKwargsWithDefaults(dictionaryOfDefaultKwargs, self.kwargs)
         self.table = self.kwargs["table"]
+        self.queries = makeQueryTemplates(self.table, self.kwargs["sql_dialect"])
         self.AES_key = False
         if self.kwargs["AES_key_hex"]:
             self.AES_key = bytes.fromhex(self.kwargs["AES_key_hex"])
         self.AES_IV = False
         if self.kwargs["AES_IV_hex"]:
             self.AES_IV = bytes.fromhex(self.kwargs["AES_IV_hex"])
+        self.rowDecoder = None
+        self.decrypt_caches = {}
+        if self.kwargs["decrypt_cache_policy"]:
+            for column, policy in self.kwargs["decrypt_cache_policy"].items():
+                if policy:
+                    self.decrypt_caches[column] = boundedCache(**policy)
+        self.encrypt_cache = None
+        if self.kwargs["encrypt_cache_policy"]:
+            self.encrypt_cache = boundedCache(**self.kwargs["encrypt_cache_policy"])
+        # fingerprint so a directory file built with another key is not reused
+        self.key_fingerprint = ""
+        if self.AES_key:
+            self.key_fingerprint = hashlib.sha256(self.AES_key).hexdigest()[:16]
+        self.jid_directory = jidDirectory(self.kwargs["jid_directory_file"], self.table, self.key_fingerprint)
+        self.connection_pool = None
+        if self.kwargs["pyodbc_connection_factory"]:
+            self.connection_pool = connectionPool(self.kwargs["pyodbc_connection_factory"],
+                                                  health_check_seconds=self.kwargs["pool_health_check_seconds"])
+        self.process_pool = None
+        self.stats = searchStats(self.kwargs["collect_stats"])
+        self.result_cache = None
+        if self.kwargs["result_cache_dir"]:
+            if self.kwargs["result_cache_key_hex"]:
+                cache_key = bytes.fromhex(self.kwargs["result_cache_key_hex"])
+            elif self.AES_key:
+                # not the archive key itself
+                cache_key = hmac.new(self.AES_key, b"jabberArchiveTools result cache", hashlib.sha256).digest()
+            else:
+                raise Exception("result_cache_dir needs result_cache_key_hex (or AES_key_hex) to encrypt the cache with")
+            self.result_cache = resultCache(self.kwargs["result_cache_dir"], cache_key, self.kwargs["result_cache_max_bytes"])
+        # set by cancel() from another thread, searches check it between queries and fetch batches
+        self.cancelled = threading.Event()
+        # clones (see clone) run on a pooled connection and share the caches, directory and pools with the original
+        self.is_clone = False
 
     # -- Encryption stuffs
 
@@ -83,13 +1142,90 @@ class jabberArchiveTools:
         return c_text
 
     def decrypt_string(self, c_text):
-        if isinstance(c_text, bytes) or isinstance(c_text, bytearray):
-            c_text = c_text.encode("utf-8")
-        cipher = AES.new(self.AES_key, AES.MODE_CBC, self.AES_IV)
-        c_text_bytes = base64.b64decode(c_text)
-        p_text = cipher.decrypt(c_text_bytes)
-        p_text = self.unpad(p_text)
-        return p_text.decode("utf-8")
+        return decryptString(self.AES_key, self.AES_IV, c_text)
+
+    def decrypt_batch(self, c_texts):
+        # decrypts a list of base64 values, gives exactly what decrypt_string would for each one
+        # null or empty values are passed through untouched (same as processStringFromResult)
+        return decryptBatch(self.AES_key, self.AES_IV, c_texts)
+
+    def encrypt_cached(self, p_text):
+        # encrypt_string with the encrypt cache in front of it
+        if self.encrypt_cache is None or not isinstance(p_text, str):
+            return self.encrypt_string(p_text)
+        c_text = self.encrypt_cache.get(p_text)
+        if c_text is None:
+            c_text = self.encrypt_string(p_text)
+            self.encrypt_cache.put(p_text, c_text)
+        return c_text
+
+    def decrypt_cached(self, c_text, column=None):
+        # decrypt_string with the cache for this column (if it has one) in front of it
+        started = self.stats.clock()
+        cache = self.decrypt_caches.get(column)
+        p_text = None
+        if cache is not None and isinstance(c_text, str):
+            p_text = cache.get(c_text)
+        if p_text is None:
+            p_text = self.decrypt_string(c_text)
+            if cache is not None and isinstance(c_text, str):
+                cache.put(c_text, p_text)
+            self.stats.add("decrypt", started, values_decrypted=1, bytes_decrypted=len(c_text))
+        else:
+            self.stats.add("decrypt", started)
+        return p_text
+
+    def decrypt_batch_cached(self, c_texts, column=None):
+        # decrypt_batch with the cache for this column in front of it
+        # only distinct values that miss the cache are sent through AES
+        started = self.stats.clock()
+        cache = self.decrypt_caches.get(column)
+        if cache is None:
+            p_texts = self.decrypt_batch(c_texts)
+            if self.stats.enabled:
+                c_texts = [c_text for c_text in c_texts if c_text]
+                self.stats.add("decrypt", started, values_decrypted=len(c_texts), bytes_decrypted=sum(len(c_text) for c_text in c_texts))
+            return p_texts
+        p_texts = list(c_texts)
+        missing = {}
+        for index, c_text in enumerate(c_texts):
+            if c_text in missing:
+                # repeat within this batch, it only goes through AES once
+                missing[c_text].append(index)
+                cache.countHits(1)
+            elif c_text:
+                p_text = cache.get(c_text)
+                if p_text is None:
+                    missing.setdefault(c_text, []).append(index)
+                else:
+                    p_texts[index] = p_text
+        if missing:
+            missing_c_texts = list(missing.keys())
+            for c_text, p_text in zip(missing_c_texts, self.decrypt_batch(missing_c_texts)):
+                cache.put(c_text, p_text)
+                for index in missing[c_text]:
+                    p_texts[index] = p_text
+        if self.stats.enabled:
+            self.stats.add("decrypt", started, values_decrypted=len(missing), bytes_decrypted=sum(len(c_text) for c_text in missing))
+        return p_texts
+
+    def getStats(self):
+        # phase timers and counters since the last resetStats (see searchStats), plus the cache counters
+        stats = self.stats.asDict()
+        stats["caches"] = self.getCacheStats()
+        return stats
+
+    def resetStats(self):
+        self.stats.reset()
+
+    def getCacheStats(self):
+        # hit/miss counters for the decrypt caches (by column) and the encrypt cache
+        stats = {column:cache.stats() for column, cache in self.decrypt_caches.items()}
+        if self.encrypt_cache is not None:
+            stats["encrypt"] = self.encrypt_cache.stats()
+        if self.result_cache is not None:
+            stats["results"] = self.result_cache.stats()
+        return stats
 
     # -- Utility
 
@@ -100,22 +1236,22 @@ class jabberArchiveTools:
             return in_string
         out_string = in_string
         if self.AES_key:
-            out_string = self.encrypt_string(in_string)
+            out_string = self.encrypt_cached(in_string)
         return out_string
 
-    def processStringFromResult(self, in_string):
+    def processStringFromResult(self, in_string, column=None):
         # might be null or none
+        # column picks which decrypt cache to use, if any
         if not in_string:
             return in_string
         out_string = in_string
         if self.AES_key:
-            out_string = self.decrypt_string(in_string)
+            out_string = self.decrypt_cached(in_string, column)
         return out_string
 
     def getHTMLFromMessage(self, message_string):
         # takes a message_string and then returns the HTML only from it
-        regex = re.compile("(<html.+<\/html>)")
-        m = regex.search(message_string)
+        m = html_re.search(message_string)
         if m:
             return m.group()
         else:
@@ -123,6 +1259,75 @@ class jabberArchiveTools:
 
     # DB searches
 
+    def execute(self, query, params=[]):
+        # runs a query on the main cursor
+        # if the connection has dropped and there is a pyodbc_connection_factory, reconnects and runs it once more
+        self.checkCancelled()
+        started = self.stats.clock()
+        try:
+            result = self.cursor.execute(query, *params)
+        except Exception as badnews:
+            # the error a query cancelled from another thread ends with is searchCancelled
+            self.checkCancelled()
+            if not isinstance(badnews, pyodbc.Error) or not isConnectionError(badnews) or not self.kwargs["pyodbc_connection_factory"]:
+                raise
+            logger.warning("Lost the database connection ({}), reconnecting".format(badnews))
+            self.reconnect()
+            result = self.cursor.execute(query, *params)
+        self.stats.add("query", started, queries=1)
+        return result
+
+    def reconnect(self):
+        # replaces the main connection and cursor with a new one from pyodbc_connection_factory
+        try:
+            self.kwargs["pyodbc_connection"].close()
+        except Exception:
+            pass
+        self.kwargs["pyodbc_connection"] = self.kwargs["pyodbc_connection_factory"]()
+        self.cursor = self.kwargs["pyodbc_connection"].cursor()
+        self.rowDecoder = None
+
+    def clone(self, cancelled=None):
+        # another jabberArchiveTools on its own pooled connection, to run a search while this one is busy
+        # (pyodbc only allows one active result per connection).  The caches, jid directory, connection pool and
+        # process pool are shared, the kwargs and stats are its own.  cancelled is an optional threading.Event to use
+        # for cancel(), close() hands the connection back to the pool
+        if self.connection_pool is None:
+            raise Exception("clone needs a pyodbc_connection_factory")
+        if self.kwargs["decrypt_workers"] > 0:
+            self.getProcessPool()
+        other = copy.copy(self)
+        other.kwargs = dict(self.kwargs)
+        other.kwargs["pyodbc_connection"] = self.connection_pool.acquire()
+        other.cursor = other.kwargs["pyodbc_connection"].cursor()
+        other.rowDecoder = None
+        other.stats = searchStats(self.stats.enabled)
+        other.cancelled = cancelled or threading.Event()
+        other.is_clone = True
+        return other
+
+    def cancel(self):
+        # stops whatever search this instance is running, can be called from any thread
+        # the running query is cancelled on the server and the search raises searchCancelled
+        self.cancelled.set()
+        try:
+            self.cursor.cancel()
+        except Exception:
+            pass
+
+    def checkCancelled(self):
+        if self.cancelled.is_set():
+            raise searchCancelled()
+
+    def fetchBatch(self, cursor, batch_size):
+        # cursor.fetchmany, but the error cancel() makes the driver raise in this thread
+        # (pyodbc "Operation canceled", SQLite "interrupted") comes out as searchCancelled
+        try:
+            return cursor.fetchmany(batch_size)
+        except Exception:
+            self.checkCancelled()
+            raise
+
     def checkRowCountForQuery(self):
         # uses the search in the cursor and checks result size
         # assumes the query only has one row return and that is a count
@@ -132,186 +1337,711 @@ class jabberArchiveTools:
             raise ValueError(row[0])
         return True
 
-    def makeTimeSearchString(self, startTime=False, endTime=False, lead=" and "):
-        # returns something similar to:
-        # sent_date > {ts '2019-12-05 20:00:00'} and  sent_date < {ts '2019-12-05 23:59:00'}
-        # since this is user controlled input and this will be directly injectable, we must be strict on format
-        regex = re.compile("^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$")
-        if (startTime and not regex.match(startTime)) or (endTime and not regex.match(endTime)):
-            raise SyntaxError("Times must be like 2021-02-19T17:11:00 (YYYY-MM-DDTHH:MM:SS)")
-
-        startClause = ""
-        endClause = ""
-        join = ""
-
-        if startTime and endTime:
-            join = " and "
+    def guardRowCount(self, rows):
+        # passes rows through, unless there are more than row_count_alert_threshold of them
+        # the first threshold + 1 rows are held back, if they are all there a ValueError is raised with that
+        # count (a lower bound) and the rest of the query is never read
+        limit = self.kwargs["row_count_alert_threshold"]
+        head = list(itertools.islice(rows, limit + 1))
+        if len(head) > limit:
+            rows.close()
+            raise ValueError(len(head))
+        for row in head:
+            yield row
+        for row in rows:
+            yield row
+
+    def checkEstimatedRowCount(self, query, params):
+        # uses SQL Server's estimated row count for the query plan, raises ValueError if it is over the threshold
+        # returns False if the server can't give an estimate
+        if self.kwargs["sql_dialect"] != "mssql":
+            return False
+        estimate = None
+        try:
+            self.execute("SET SHOWPLAN_XML ON")
+            try:
+                self.cursor.execute(query, *params)
+                row = self.cursor.fetchone()
+            finally:
+                self.cursor.execute("SET SHOWPLAN_XML OFF")
+            found = re.search('StatementEstRows="([^"]+)"', str(row[0]))
+            if found:
+                estimate = int(float(found.group(1)))
+        except Exception as badnews:
+            logger.debug("no row estimate: {}".format(badnews))
+        if estimate is None:
+            return False
+        if estimate > self.kwargs["row_count_alert_threshold"]:
+            raise ValueError(estimate)
+        return True
 
+    def makeTimeSearchString(self, startTime=False, endTime=False, lead=" and ", endInclusive=True):
+        # makeTimeCondition with the times written into the SQL, for scripts that still build their own queries
+        # returns something similar to:
+        # " and sent_date >= {ts '2019-12-05 20:00:00'} and sent_date <= {ts '2019-12-05 23:59:00'}"
+        sql, params = self.makeTimeCondition(startTime, endTime, lead, endInclusive)
+        for param in params:
+            # only datetimes get here (see parseSearchTime), so nothing user typed goes into the SQL as is
+            timeFormat = "%Y-%m-%d %H:%M:%S.%f" if param.microsecond else "%Y-%m-%d %H:%M:%S"
+            sql = sql.replace("?", "{{ts '{}'}}".format(param.strftime(timeFormat)), 1)
+        return sql
+
+    def makeTimeCondition(self, startTime=False, endTime=False, lead=" and ", endInclusive=True):
+        # returns (sql, params) for the sent_date window of a query, like
+        # (" and sent_date >= ? and sent_date <= ?", [datetime(2019, 12, 5, 20, 0), datetime(2019, 12, 5, 23, 59)])
+        # the query text is the same for every time window, so the server can reuse its plan
+        # times are strings like 2021-02-19T17:11:00 or datetimes
+        startTime = parseSearchTime(startTime)
+        endTime = parseSearchTime(endTime)
+        clauses = []
+        params = []
         if startTime:
-            startTime = startTime.replace('T', ' ')
-            startClause = "sent_date >= {{ts '{}'}}".format(startTime)
-
+            clauses.append("sent_date >= ?")
+            params.append(startTime)
         if endTime:
-            endTime = endTime.replace('T', ' ')
-            endClause = "sent_date <= {{ts '{}'}}".format(endTime)
-
-        finalClause = startClause + join + endClause
-        if len(finalClause) > 1:
-            finalClause = lead + finalClause
-        return finalClause
-
+            if endInclusive:
+                clauses.append("sent_date <= ?")
+            else:
+                clauses.append("sent_date < ?")
+            params.append(endTime)
+        if not clauses:
+            return "", []
+        return lead + " and ".join(clauses), params
 
 
-    def processRow(self, row):
-        # returns a json of this row, decrypted as needed
-        # cursor info is used implicitly
-        rowDat = {}
-        #colCount = 0
-        columns = [column[0] for column in self.cursor.description]
-        for col in columns:
-            colval = row.__getattribute__(col)
-            if col in self.kwargs["encrypted_columns"]:
-                colval = self.processStringFromResult(colval)
-            if col == "sent_date":
-                orig_tz = pytz.timezone("UTC")
-                colval =colval.replace(tzinfo=orig_tz)
-
-            rowDat[col] = colval
-            # colCount += 1
-        return rowDat
-
-    def getMessagesFromUser(self, username, startTime=False, endTime=False, ignore_row_count=False):
-        # Returns list of dictionary of row ({colname:coldata...})
-        # if ignore_row_Count = True, then user will not be warned of large responses
 
+    def planColumns(self, columns=None, required=[]):
+        """
+        Returns the list of columns a message query should select, None for all of them
+        columns is None (everything), a column_projections name, or a list of column names
+        required are the columns the method itself reads (like the jid it filters on), sent_date is always
+        included since results are ordered and merged on it
+        """
+        if isinstance(columns, str):
+            if columns not in column_projections:
+                raise SyntaxError("Unknown column projection {}".format(columns))
+            columns = column_projections[columns]
+        if columns is None:
+            return None
+        selected = []
+        for column in ["sent_date"] + list(required) + list(columns):
+            # these go straight into the SQL
+            if not re.match(r"^\w+$", column):
+                raise SyntaxError("Bad column name {}".format(column))
+            if column not in selected:
+                selected.append(column)
+        return selected
+
+    def compileRowDecoder(self, description):
+        # builds the rowDecoder for a query, call once after each execute
+        decrypt_function = False
+        batch_decrypt_function = False
+        if self.AES_key:
+            decrypt_function = self.decrypt_cached
+            if self.kwargs["batch_decrypt"]:
+                batch_decrypt_function = self.decrypt_batch_cached
+        return rowDecoder(description, decrypt_function, self.kwargs["encrypted_columns"], batch_decrypt_function,
+                          self.kwargs["lazy_decrypt_columns"])
+
+    def makeTimeShards(self, startTime=False, endTime=False, endInclusive=True):
+        # splits [startTime, endTime] into query_shards (sql, params) time conditions that don't overlap
+        # every shard but the last stops just before the next one starts
+        shards = self.kwargs["query_shards"]
+        if shards <= 1 or not startTime or not endTime:
+            return [self.makeTimeCondition(startTime, endTime, endInclusive=endInclusive)]
+        start = parseSearchTime(startTime)
+        end = parseSearchTime(endTime)
+        seconds = int((end - start).total_seconds())
+        shards = min(shards, seconds)
+        if shards <= 1:
+            return [self.makeTimeCondition(start, end, endInclusive=endInclusive)]
+        boundaries = [start + timedelta(seconds=seconds * shard // shards) for shard in range(shards)]
+        boundaries.append(end)
+        timeConditions = []
+        for shard in range(shards):
+            lastShard = shard == shards - 1
+            timeConditions.append(self.makeTimeCondition(boundaries[shard], boundaries[shard+1], endInclusive=lastShard and endInclusive))
+        return timeConditions
+
+    def makeJidCondition(self, column, username):
+        """
+        Returns (sql, params) for a where clause matching rows where column is this user, with any jabber_XXXX resource
+        Users in the jid directory are matched exactly on their stored jids with IN lists, which the server can seek on
+        Rows newer than the directory watermark can have resources the directory hasn't seen, so they use the prefix LIKE
+        Unknown users, or ones with more stored jids than in_list_max_params, just use the prefix LIKE (see makeJidPrefix)
+        The directory is only used once it has been built (loaded from jid_directory_file, or by getJids and
+        refreshJidDirectory), a search never builds it since that scans the whole table twice
+        """
+        likeClause = "({0} like ? or {0} = ?)".format(column)
+        likeParams = list(self.makeJidPrefix(username))
+        if not self.kwargs["exact_jid_lookup"] or self.jid_directory.watermark is None:
+            return likeClause, likeParams
+
+        # catching up on rows newer than the watermark only reads those
+        directory = self.refreshJidDirectory()
+        stored_jids = directory.findStoredJids(username)
+        if not stored_jids or len(stored_jids) > self.kwargs["in_list_max_params"]:
+            return likeClause, likeParams
+        batch_size = self.kwargs["in_list_batch_size"]
+        inClauses = []
+        inParams = []
+        for start in range(0, len(stored_jids), batch_size):
+            batch = stored_jids[start:start+batch_size]
+            # lists are padded (repeating the last jid) up to a power of two so there are only a few
+            # distinct query texts for the server to plan and cache
+            padded_size = 1
+            while padded_size < len(batch):
+                padded_size *= 2
+            batch = batch + [batch[-1]] * (padded_size - len(batch))
+            inClauses.append("{} in ({})".format(column, ",".join(["?"]*len(batch))))
+            inParams += batch
+        clause = "((({}) and sent_date <= ?) or ({} and sent_date > ?))".format(" or ".join(inClauses), likeClause)
+        return clause, inParams + [directory.watermark] + likeParams + [directory.watermark]
+
+    def makeJidPrefix(self, username):
+        """
+        Returns (LIKE pattern, exact value) matching the stored jids of username with any jabber_XXXX resource
+        A bare jid (an @ and no resource) is matched as "username/", so other users whose jids just start the same are
+        left out.  With the fixed key and IV a CBC block only depends on the plain text up to its end, so every full
+        16 byte block of that is the same in each stored jid.  The pattern is the base64 characters covering only
+        those blocks (21 for one, 42 for two...), the exact value catches jids stored without a resource
+        Shorter than one block, the first 16 characters of the encrypted username are used as before
+        """
         q_username = self.processStringForQuery(username)
-        # this needed because jabber adds a random jabber_XXXX tag after usernames, and it changes
-        # 16 bytes will be reliably the same after encryption because the IV and key don't change
-        q_username = q_username[:16]+'%'
+        prefix = username
+        if "@" in username and "/" not in username:
+            prefix = username + "/"
+        if not self.AES_key:
+            return prefix + "%", q_username
+        blocks = len(prefix.encode("utf-8")) // AES.block_size
+        if not blocks:
+            return q_username[:16] + "%", q_username
+        # 3 bytes to 4 base64 characters, the last partial character also depends on the next block
+        return self.encrypt_cached(prefix)[:blocks * AES.block_size * 4 // 3] + "%", q_username
 
-        # set up the time search
-        timeWhere = self.makeTimeSearchString(startTime, endTime)
+    def processRow(self, row):
+        # returns a messageRecord of this row (reads like a dictionary), lazy_decrypt_columns are decrypted when first read
+        # cursor info is used implicitly, the decoder is only rebuilt when the cursor has run a new query
+        description = self.cursor.description
+        if self.rowDecoder is None or self.rowDecoder.description is not description:
+            self.rowDecoder = self.compileRowDecoder(description)
+        return self.rowDecoder.decodeRow(row)
+
+    def iterProcessedRows(self, batch_size=None, pipeline=False):
+        # generator over the rows of the last query on the cursor, processed one at a time
+        # rows are pulled with fetchmany so only a few batches are held in memory
+        # pipeline = True lets the decrypt_workers process pool do the decoding (see iterDecodedBatches)
+        if not batch_size:
+            batch_size = self.kwargs["fetch_batch_size"]
+        decoder = self.compileRowDecoder(self.cursor.description)
+        for batch in self.iterDecodedBatches(self.cursor, decoder, batch_size, pipeline):
+            for aProcessedRow in batch:
+                yield aProcessedRow
+
+    def iterDecodedBatches(self, cursor, decoder, batch_size, pipeline=False):
+        # yields lists of processed rows, one per fetchmany batch, in order
+        stats = self.stats
+        if not pipeline or self.kwargs["decrypt_workers"] < 1:
+            started = stats.clock()
+            rows = self.fetchBatch(cursor, batch_size)
+            stats.add("fetch", started, rows_fetched=len(rows))
+            while rows:
+                self.checkCancelled()
+                yield decoder.decodeBatch(rows)
+                started = stats.clock()
+                rows = self.fetchBatch(cursor, batch_size)
+                stats.add("fetch", started, rows_fetched=len(rows))
+            # a cancelled cursor can look like the end of the result
+            self.checkCancelled()
+            return
+        # Raw batches are shipped to the process pool so decryption, HTML extraction and the message id regex
+        # use every core.  Up to two batches per worker are in flight while the next ones are fetched,
+        # and results are collected in the order they were sent
+        pool = self.getProcessPool()
+        maxInFlight = 2 * self.kwargs["decrypt_workers"]
+        encrypted_indexes = [index for index, col in decoder.encrypted_indexes]
+        inFlight = deque()
+        try:
+            started = stats.clock()
+            rows = self.fetchBatch(cursor, batch_size)
+            stats.add("fetch", started, rows_fetched=len(rows))
+            while rows or inFlight:
+                self.checkCancelled()
+                while rows and len(inFlight) < maxInFlight:
+                    if stats.enabled:
+                        c_texts = [row[index] for row in rows for index in encrypted_indexes if row[index]]
+                        stats.add("decrypt", stats.clock(), values_decrypted=len(c_texts), bytes_decrypted=sum(len(c_text) for c_text in c_texts))
+                    # pyodbc rows can't be pickled, plain tuples can
+                    inFlight.append(pool.submit(decodeRowsInWorker, decoder.columns, encrypted_indexes, [tuple(row) for row in rows]))
+                    started = stats.clock()
+                    rows = self.fetchBatch(cursor, batch_size)
+                    stats.add("fetch", started, rows_fetched=len(rows))
+                # time spent waiting on the workers
+                started = stats.clock()
+                results = inFlight.popleft().result()
+                stats.add("decrypt", started)
+                yield [decoder.makePipelineRecord(*result) for result in results]
+            self.checkCancelled()
+        finally:
+            for future in inFlight:
+                future.cancel()
+
+    def getProcessPool(self):
+        if self.process_pool is None:
+            self.process_pool = ProcessPoolExecutor(max_workers=self.kwargs["decrypt_workers"],
+                                                    initializer=initDecryptWorker, initargs=(self.AES_key, self.AES_IV))
+        return self.process_pool
+
+    def close(self):
+        # shuts down the process pool and any pooled connections
+        # a clone just gives its connection back, the pools belong to the original
+        if self.is_clone:
+            try:
+                self.cursor.close()
+            except Exception:
+                pass
+            self.connection_pool.release(self.kwargs["pyodbc_connection"], self.cancelled.is_set())
+            return
+        if self.process_pool is not None:
+            self.process_pool.shutdown(cancel_futures=True)
+            self.process_pool = None
+        if self.connection_pool is not None:
+            self.connection_pool.close()
+
+    def iterMessageQuery(self, userWhere, params, startTime=False, endTime=False, ignore_row_count=False, batch_size=None, columns=None, endInclusive=True):
+        # runs the row count check and then the select for this user condition, yields processed rows ordered by sent_date
+        # columns comes from planColumns, None selects everything
+        # with query_shards > 1 and a connection factory the time window is split up and run in parallel
+        selectList = "*"
+        if columns is not None:
+            selectList = ", ".join(columns)
+        timeWhere, timeParams = self.makeTimeCondition(startTime, endTime, endInclusive=endInclusive)
 
         # check the row count
+        guard = False
         if not ignore_row_count:
-            self.cursor.execute("select count(from_jid) from {} where from_jid like ? {}".format(self.table, timeWhere), q_username)
-            self.checkRowCountForQuery()
-
-        self.cursor.execute("select * from {} where from_jid like ? {} order by sent_date".format(self.table, timeWhere), q_username)
-        alldat = []
-        row = self.cursor.fetchone()
-        while row:
-            # need to then filter just incase we pulled the wrong ones
-            aProcessedRow = self.processRow(row)
-            if aProcessedRow["from_jid"].startswith(username):
-                alldat.append(aProcessedRow)
-            row = self.cursor.fetchone()
-
-        return alldat
+            started = self.stats.clock()
+            mode = self.kwargs["row_count_mode"]
+            if mode == "exact":
+                self.execute(self.queries["count"].format(userWhere, timeWhere), params + timeParams)
+                self.checkRowCountForQuery()
+            elif mode == "estimate":
+                if not self.checkEstimatedRowCount(self.queries["messages"].format(selectList, userWhere, timeWhere), params + timeParams):
+                    logger.info("Row estimate not available, counting rows as they are read instead")
+                    guard = True
+            else:
+                guard = True
+            self.stats.add("row_count", started)
+
+        rows = self.iterMessageRows(userWhere, params, startTime, endTime, batch_size, selectList, endInclusive)
+        if guard:
+            rows = self.guardRowCount(rows)
+        for aProcessedRow in rows:
+            yield aProcessedRow
+
+    def iterMessageRows(self, userWhere, params, startTime=False, endTime=False, batch_size=None, selectList="*", endInclusive=True):
+        # runs the message query for this user condition and select list, sharded if configured
+        shardQueries = []
+        for timeWhere, timeParams in self.makeTimeShards(startTime, endTime, endInclusive):
+            shardQueries.append((self.queries["messages"].format(selectList, userWhere, timeWhere), params + timeParams))
+        if len(shardQueries) > 1 and self.connection_pool is not None:
+            for aProcessedRow in self.iterShardedQuery(shardQueries, batch_size):
+                yield aProcessedRow
+            return
+
+        self.execute(*shardQueries[0])
+        finished = False
+        try:
+            for aProcessedRow in self.iterProcessedRows(batch_size, pipeline=True):
+                yield aProcessedRow
+            finished = True
+        finally:
+            if not finished:
+                # stopped early (row count guard or the caller), don't make the server send the rest
+                self.cursor.cancel()
+
+    def iterShardedQuery(self, shardQueries, batch_size=None):
+        """
+        Runs each (query, params) time shard on its own pooled connection in a worker thread
+        Workers fetch and decode their shard into a bounded queue while the merge below is reading the earlier shards
+        Each shard is already ordered by sent_date, so a heap merge on sent_date gives the same order as one big query
+        """
+        if not batch_size:
+            batch_size = self.kwargs["fetch_batch_size"]
+        stop = threading.Event()
+        shardQueues = []
+        for query, params in shardQueries:
+            shardQueue = queue.Queue(maxsize=self.kwargs["shard_prefetch_batches"])
+            worker = threading.Thread(target=self.runShard, args=(query, params, shardQueue, stop, batch_size), daemon=True)
+            worker.start()
+            shardQueues.append(shardQueue)
+        try:
+            streams = [self.iterShardQueue(shardQueue) for shardQueue in shardQueues]
+            for aProcessedRow in heapq.merge(*streams, key=lambda processedRow: processedRow["sent_date"]):
+                yield aProcessedRow
+        finally:
+            # if the caller stopped early this tells the workers to give up
+            stop.set()
+
+    def runShard(self, query, params, shardQueue, stop, batch_size):
+        # worker thread for iterShardedQuery, puts lists of processed rows on the queue
+        # then None when done, or the exception if something went wrong
+        connection = self.connection_pool.acquire()
+        broken = False
+        try:
+            cursor = connection.cursor()
+            started = self.stats.clock()
+            cursor.execute(query, *params)
+            self.stats.add("query", started, queries=1)
+            decoder = self.compileRowDecoder(cursor.description)
+            for batch in self.iterDecodedBatches(cursor, decoder, batch_size, pipeline=True):
+                if stop.is_set():
+                    break
+                self.putUnlessStopped(shardQueue, batch, stop)
+            if stop.is_set():
+                cursor.cancel()
+            cursor.close()
+            self.putUnlessStopped(shardQueue, None, stop)
+        except Exception as badnews:
+            broken = isConnectionError(badnews)
+            self.putUnlessStopped(shardQueue, badnews, stop)
+        finally:
+            self.connection_pool.release(connection, broken)
+
+    def putUnlessStopped(self, shardQueue, item, stop):
+        while not stop.is_set():
+            try:
+                shardQueue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
 
-    def getMessagesToUser(self, username, startTime=False, endTime=False, ignore_row_count=False):
-        # Returns list of dictionary of row ({colname:coldata...})
+    def iterShardQueue(self, shardQueue):
+        while True:
+            item = shardQueue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            for aProcessedRow in item:
+                yield aProcessedRow
+
+    def iterCachedSearch(self, scope, startTime, endTime, fetch, ignore_row_count=False, whole_segments=False):
+        """
+        Runs a message search through the result cache
+        fetch(startTime, endTime, endInclusive, ignore_row_count) runs it on the server
+        The [startTime, endTime] window is answered from the cached segments of this scope it overlaps, and the gaps
+        between them are fetched and kept as new segments.  Anything newer than result_cache_settle_seconds is fetched
+        every time since rows for it may still be arriving.  Rows from the cache are messageRecords like fetched ones
+        The row count check is over the whole window, cached rows included, and nothing is yielded before it passes.
+        With the cache that is always the bounded check (see guardRowCount), whatever row_count_mode is
+        whole_segments is for searches whose rows depend on where they start (the chatroom log's dedup): a segment
+        that starts before the search is fetched again rather than read from the middle
+        Without a result_cache_dir this is just fetch(startTime, endTime, True, ignore_row_count)
+        """
+        if self.result_cache is None:
+            rows = fetch(startTime, endTime, True, ignore_row_count)
+        else:
+            rows = self.iterCacheWindow(scope, startTime, endTime, fetch, whole_segments)
+            if not ignore_row_count:
+                rows = self.guardRowCount(rows)
+        for aProcessedRow in rows:
+            yield aProcessedRow
+
+    def iterCacheWindow(self, scope, startTime, endTime, fetch, whole_segments=False):
+        # the rows of iterCachedSearch, from the cache and the gaps in it
+        cache = self.result_cache
+        start = parseSearchTime(startTime) or result_cache_epoch
+        end = None
+        if endTime:
+            # searches include their end time, segments are half open
+            end = parseSearchTime(endTime) + timedelta(microseconds=1)
+        settled = datetime.now(pytz.utc).replace(tzinfo=None) - timedelta(seconds=self.kwargs["result_cache_settle_seconds"])
+        scope_id = cache.scopeId([self.table] + list(scope))
+        stats = self.stats
+        position = start
+        read = False
+        for segment in cache.segments(scope_id):
+            if segment[1] <= position:
+                continue
+            if end is not None and segment[0] >= end:
+                break
+            if segment[0] > position:
+                for aProcessedRow in self.iterFetchForCache(scope_id, position, segment[0], settled, fetch):
+                    yield aProcessedRow
+                position = segment[0]
+            segmentEnd = segment[1] if end is None else min(segment[1], end)
+            if whole_segments and segment[0] < position:
+                # fetched without caching, it overlaps this segment
+                for aProcessedRow in fetch(position, segmentEnd, False, True):
+                    yield aProcessedRow
+                position = segmentEnd
+                continue
+            started = stats.clock()
+            blocks = cache.readSegment(scope_id, segment)
+            if blocks is None:
+                # lost, the next gap covers it
+                continue
+            rows = []
+            for columns, block in blocks:
+                decoder = self.compileRowDecoder([(column,) for column in columns])
+                index = decoder.sent_date_index
+                # the windows are naive UTC like the archive
+                rows.extend(messageRecord(decoder, values, pending) for pending, values in block
+                            if position <= values[index].replace(tzinfo=None) < segmentEnd)
+            stats.add("cache", started, rows_from_cache=len(rows))
+            read = True
+            for aProcessedRow in rows:
+                yield aProcessedRow
+            position = segmentEnd
+        if end is None or position < end:
+            for aProcessedRow in self.iterFetchForCache(scope_id, position, end, settled, fetch):
+                yield aProcessedRow
+        if read:
+            # keeps the last used times for the LRU
+            cache.touch()
+
+    def iterFetchForCache(self, scope_id, start, end, settled, fetch):
+        # fetches [start, end) (end None has no end), the part before settled is written to a new segment as it arrives
+        # if the caller stops early or there are more than result_cache_max_rows rows nothing is kept
+        if start < settled:
+            cacheEnd = settled if end is None else min(end, settled)
+            writer = self.result_cache.newSegment()
+            try:
+                for aProcessedRow in fetch(start, cacheEnd, False, True):
+                    if writer is not None:
+                        writer.addRow(aProcessedRow)
+                        if writer.rows > self.kwargs["result_cache_max_rows"]:
+                            writer.discard()
+                            writer = None
+                    yield aProcessedRow
+                if writer is not None:
+                    started = self.stats.clock()
+                    self.result_cache.addSegment(scope_id, start, cacheEnd, writer)
+                    self.stats.add("cache", started, rows_cached=writer.rows)
+                    writer = None
+            finally:
+                if writer is not None:
+                    writer.discard()
+            start = cacheEnd
+        if end is None or start < end:
+            for aProcessedRow in fetch(start, end or False, False, True):
+                yield aProcessedRow
+
+    def iterMessagesFromUser(self, username, startTime=False, endTime=False, ignore_row_count=False, batch_size=None, columns=None):
+        # Generator version of getMessagesFromUser, yields dictionary of row ({colname:coldata...}) as they arrive
         # if ignore_row_Count = True, then user will not be warned of large responses
+        # columns limits what is fetched and decrypted, see planColumns
 
-        q_username = self.processStringForQuery(username)
-        # this needed because jabber adds a random jabber_XXXX tag after usernames, and it changes
-        # 16 bytes will be reliably the same after encryption because the IV and key don't change
-        q_username = q_username[:16]+'%'
+        columns = self.planColumns(columns, ["from_jid"])
 
-        # set up the time search
-        timeWhere = self.makeTimeSearchString(startTime, endTime)
+        def fetch(startTime, endTime, endInclusive, ignore_row_count):
+            return self.iterFetchMessagesFromUser(username, startTime, endTime, ignore_row_count, batch_size, columns, endInclusive)
 
-        # check the row count
-        if not ignore_row_count:
-            #self.cursor.execute("select count(from_jid) from {} where from_jid = ?".format(self.table), q_username)
-            self.cursor.execute("select count(to_jid) from {} where to_jid like ? {}".format(self.table, timeWhere), q_username)
-            self.checkRowCountForQuery()
+        for aProcessedRow in self.iterCachedSearch(["messages_from", username, columns], startTime, endTime, fetch, ignore_row_count):
+            yield aProcessedRow
 
-        #self.cursor.execute("select * from {} where from_jid = ?".format(self.table), q_username)
-        self.cursor.execute("select * from {} where to_jid like ? {} order by sent_date".format(self.table, timeWhere), q_username)
-        alldat = []
-        row = self.cursor.fetchone()
-        while row:
+    def iterFetchMessagesFromUser(self, username, startTime=False, endTime=False, ignore_row_count=False, batch_size=None, columns=None, endInclusive=True):
+        # iterMessagesFromUser without the result cache, columns is already planned
+        userWhere, params = self.makeJidCondition("from_jid", username)
+        stats = self.stats
+        for aProcessedRow in self.iterMessageQuery(userWhere, params, startTime, endTime, ignore_row_count, batch_size, columns, endInclusive):
             # need to then filter just incase we pulled the wrong ones
-            aProcessedRow = self.processRow(row)
-            if aProcessedRow["to_jid"].startswith(username):
-                alldat.append(aProcessedRow)
-            row = self.cursor.fetchone()
+            started = stats.clock()
+            keep = aProcessedRow["from_jid"].startswith(username)
+            stats.add("filter", started, rows_jid_checked=1, rows_filtered_out=not keep)
+            if keep:
+                yield aProcessedRow
 
-        return alldat
-
-    def getMessagesBetweenUsers(self, user1name, user2name,  startTime=False, endTime=False, ignore_row_count=False):
-        # returns the conversation between two users
-        q_user1name = self.processStringForQuery(user1name)
-        # this needed because jabber adds a random jabber_XXXX tag after usernames, and it changes
-        # 16 bytes will be reliably the same after encryption because the IV and key don't change
-        q_user1name = q_user1name[:16]+'%'
+    def getMessagesFromUser(self, username, startTime=False, endTime=False, ignore_row_count=False, columns=None):
+        # Returns list of dictionary of row ({colname:coldata...})
+        # if ignore_row_Count = True, then user will not be warned of large responses
+        return list(self.iterMessagesFromUser(username, startTime, endTime, ignore_row_count, columns=columns))
 
-        q_user2name = self.processStringForQuery(user2name)
-        # this needed because jabber adds a random jabber_XXXX tag after usernames, and it changes
-        # 16 bytes will be reliably the same after encryption because the IV and key don't change
-        q_user2name = q_user2name[:16]+'%'
+    def iterMessagesSentByUser(self, username, startTime=False, endTime=False, ignore_row_count=False, batch_size=None, columns=None):
+        """
+        Yields what a user sent: their one to one messages (as iterMessagesFromUser) and what they posted in chatrooms,
+        each post once rather than once per member or again when the history is resent, ordered by sent_date
+        Posts are from room/user@domain/resource, so the chatrooms the user got messages from between startTime and
+        endTime are found first (one grouped query on the still encrypted jids), then their room/user prefixes are
+        searched along with the user's own jid.  A user in more chatrooms than fit in max_query_params gets a query per
+        group of them, one after the other
+        columns limits what is fetched and decrypted (see planColumns), from_jid and message_string are always read
+        """
+        columns = self.planColumns(columns, ["from_jid", "message_string"])
+        timeWhere, timeParams = self.makeTimeCondition(startTime, endTime)
+        userWhere, params = self.makeJidCondition("to_jid", username)
+        pairs = self.getStoredJidPairCounts(userWhere, params, timeWhere, timeParams)
+        from_jids = self.decryptStoredJids([pair[0] for pair in pairs], "from_jid")
+        to_jids = self.decryptStoredJids([pair[1] for pair in pairs], "to_jid")
+        rooms = set()
+        for from_jid, to_jid in pairs:
+            # need to then filter just incase we pulled the wrong ones
+            if "@conference" in from_jids[from_jid] and to_jids[to_jid].startswith(username):
+                rooms.add(from_jids[from_jid].split("/")[0])
+        # a bare jid is followed by its resource, the same as makeJidPrefix
+        posted = username + "/" if "@" in username and "/" not in username else username
+        conditions = [self.makeJidCondition("from_jid", username)]
+        conditions += [self.makeJidCondition("from_jid", "{}/{}".format(room, posted)) for room in sorted(rooms)]
+        stats = self.stats
+        for userWhere, params in self.groupConditions(conditions):
+            dedup = messageDeduplicator(self.kwargs["dedup_window_seconds"])
+            for msg in self.iterMessageQuery(userWhere, params, startTime, endTime, ignore_row_count, batch_size, columns):
+                started = stats.clock()
+                from_jid = msg["from_jid"]
+                room = from_jid.split("/")[0]
+                if "@conference" in from_jid:
+                    keep = room in rooms and from_jid.startswith("{}/{}".format(room, posted))
+                else:
+                    keep = from_jid.startswith(username)
+                stats.add("filter", started, rows_jid_checked=1, rows_filtered_out=not keep)
+                if not keep:
+                    continue
+                if "@conference" in from_jid:
+                    started = stats.clock()
+                    messageId = self.getMessageIdBytes(msg)
+                    # ids are only unique within a room
+                    keep = messageId is not None and dedup.isNew(room.encode("utf-8") + b"/" + messageId, msg["sent_date"])
+                    stats.add("dedup", started, rows_deduped=not keep)
+                if keep:
+                    yield msg
+
+    def getMessagesSentByUser(self, username, startTime=False, endTime=False, ignore_row_count=False, columns=None):
+        # Returns list of iterMessagesSentByUser
+        return list(self.iterMessagesSentByUser(username, startTime, endTime, ignore_row_count, columns=columns))
+
+    def iterMessagesToUser(self, username, startTime=False, endTime=False, ignore_row_count=False, batch_size=None, columns=None):
+        # Generator version of getMessagesToUser, yields dictionary of row ({colname:coldata...}) as they arrive
+        # if ignore_row_Count = True, then user will not be warned of large responses
+        # columns limits what is fetched and decrypted, see planColumns
 
-        # set up the time search
-        timeWhere = self.makeTimeSearchString(startTime, endTime)
-        logger.debug("tw: {}".format(timeWhere))
+        columns = self.planColumns(columns, ["to_jid"])
 
-        # check the row count
-        if not ignore_row_count:
-            totalRows = 0
-            #self.cursor.execute("select count(from_jid) from {} where from_jid = ?".format(self.table), q_username)
-            self.cursor.execute("select count(from_jid) from {} where ((from_jid like ? and to_jid like ?) or (from_jid like ? and to_jid like ?)) {}".format(self.table, timeWhere), q_user1name, q_user2name, q_user2name, q_user1name)
-            self.checkRowCountForQuery()
+        def fetch(startTime, endTime, endInclusive, ignore_row_count):
+            userWhere, params = self.makeJidCondition("to_jid", username)
+            stats = self.stats
+            for aProcessedRow in self.iterMessageQuery(userWhere, params, startTime, endTime, ignore_row_count, batch_size, columns, endInclusive):
+                # need to then filter just incase we pulled the wrong ones
+                started = stats.clock()
+                keep = aProcessedRow["to_jid"].startswith(username)
+                stats.add("filter", started, rows_jid_checked=1, rows_filtered_out=not keep)
+                if keep:
+                    yield aProcessedRow
 
-        self.cursor.execute("select * from {} where ((from_jid like ? and to_jid like ?) or (from_jid like ? and to_jid like ?)) {} order by sent_date".format(self.table, timeWhere), q_user1name, q_user2name, q_user2name, q_user1name)
-        alldat = []
-        row = self.cursor.fetchone()
-        while row:
-            aProcessedRow = self.processRow(row)
-            # verify right combo
-            if aProcessedRow["from_jid"].startswith(user1name) and aProcessedRow["to_jid"].startswith(user2name):
-                alldat.append(aProcessedRow)
-            elif aProcessedRow["to_jid"].startswith(user1name) and aProcessedRow["from_jid"].startswith(user2name):
-                alldat.append(aProcessedRow)
-            row = self.cursor.fetchone()
+        for aProcessedRow in self.iterCachedSearch(["messages_to", username, columns], startTime, endTime, fetch, ignore_row_count):
+            yield aProcessedRow
 
-        return alldat
+    def getMessagesToUser(self, username, startTime=False, endTime=False, ignore_row_count=False, columns=None):
+        # Returns list of dictionary of row ({colname:coldata...})
+        # if ignore_row_Count = True, then user will not be warned of large responses
+        return list(self.iterMessagesToUser(username, startTime, endTime, ignore_row_count, columns=columns))
+
+    def iterMessagesBetweenUsers(self, user1name, user2name, startTime=False, endTime=False, ignore_row_count=False, batch_size=None, columns=None):
+        # Generator version of getMessagesBetweenUsers, yields the conversation between two users as it arrives
+        # columns limits what is fetched and decrypted, see planColumns
+        columns = self.planColumns(columns, ["from_jid", "to_jid"])
+
+        def fetch(startTime, endTime, endInclusive, ignore_row_count):
+            user1From, user1FromParams = self.makeJidCondition("from_jid", user1name)
+            user2To, user2ToParams = self.makeJidCondition("to_jid", user2name)
+            user2From, user2FromParams = self.makeJidCondition("from_jid", user2name)
+            user1To, user1ToParams = self.makeJidCondition("to_jid", user1name)
+            userWhere = "(({} and {}) or ({} and {}))".format(user1From, user2To, user2From, user1To)
+            params = user1FromParams + user2ToParams + user2FromParams + user1ToParams
+            stats = self.stats
+            for aProcessedRow in self.iterMessageQuery(userWhere, params, startTime, endTime, ignore_row_count, batch_size, columns, endInclusive):
+                # verify right combo
+                started = stats.clock()
+                keep = ((aProcessedRow["from_jid"].startswith(user1name) and aProcessedRow["to_jid"].startswith(user2name)) or
+                        (aProcessedRow["to_jid"].startswith(user1name) and aProcessedRow["from_jid"].startswith(user2name)))
+                stats.add("filter", started, rows_jid_checked=1, rows_filtered_out=not keep)
+                if keep:
+                    yield aProcessedRow
+
+        for aProcessedRow in self.iterCachedSearch(["messages_between", user1name, user2name, columns], startTime, endTime, fetch, ignore_row_count):
+            yield aProcessedRow
+
+    def getMessagesBetweenUsers(self, user1name, user2name,  startTime=False, endTime=False, ignore_row_count=False, columns=None):
+        # returns the conversation between two users
+        return list(self.iterMessagesBetweenUsers(user1name, user2name, startTime, endTime, ignore_row_count, columns=columns))
+
+    def iterAllMessages(self, startTime=False, endTime=False, ignore_row_count=False, batch_size=None, columns=None):
+        # yields every message with a body in the archive (or the time frame) as it is read, ordered by sent_date
+        # chatroom messages are only yielded once, not for every member they were copied to or when the history is resent
+        # columns limits what is fetched and decrypted (see planColumns), from_jid and message_string are always read
+        dedup = messageDeduplicator(self.kwargs["dedup_window_seconds"])
+        columns = self.planColumns(columns, ["from_jid", "message_string"])
+        stats = self.stats
+        for msg in self.iterMessageQuery("body_string is not null", [], startTime, endTime, ignore_row_count, batch_size, columns):
+            if "@conference" not in msg["from_jid"]:
+                yield msg
+                continue
+            started = stats.clock()
+            messageId = self.getMessageIdBytes(msg)
+            # ids are only unique within a room
+            keep = messageId is not None and dedup.isNew(msg["from_jid"].split("/")[0].encode("utf-8") + b"/" + messageId, msg["sent_date"])
+            stats.add("dedup", started, rows_deduped=not keep)
+            if keep:
+                yield msg
 
     def getAllto_jid(self):
         # returns list of all to_jids
-        self.cursor.execute("select distinct(to_jid) from {}".format(self.kwargs["table"]))
+        self.execute(self.queries["distinct"].format("to_jid"))
         allto_jid = []
-        row = self.cursor.fetchone()
-        while row:
-            aProcessedRow = self.processRow(row)
+        for aProcessedRow in self.iterProcessedRows():
             # verify right combo
             allto_jid.append(aProcessedRow["to_jid"])
-            row = self.cursor.fetchone()
         return allto_jid
 
     def getAllFrom_jid(self):
         # returns list of all to_jids
-        self.cursor.execute("select distinct(from_jid) from {}".format(self.kwargs["table"]))
+        self.execute(self.queries["distinct"].format("from_jid"))
         all_jid = []
-        row = self.cursor.fetchone()
-        while row:
-            aProcessedRow = self.processRow(row)
+        for aProcessedRow in self.iterProcessedRows():
             # verify right combo
             all_jid.append(aProcessedRow["from_jid"])
-            row = self.cursor.fetchone()
         return all_jid
 
+    def refreshJidDirectory(self, force=False):
+        # brings the jid directory up to date with the archive and returns it
+        # only rows newer than the directory watermark are scanned, and only jids not already known are decrypted
+        directory = self.jid_directory
+        # clones share the directory, one refresh at a time (and the others then find it fresh)
+        with directory.lock:
+            if not force and directory.refreshed and time.time() - directory.refreshed < self.kwargs["jid_directory_refresh_seconds"]:
+                return directory
+            timeWhere = ""
+            params = []
+            if directory.watermark is not None:
+                timeWhere = " where sent_date > ?"
+                params = [directory.watermark]
+            for received, column in enumerate(["from_jid", "to_jid"]):
+                self.execute(self.queries["jid_counts"].format(column, timeWhere), params)
+                rows = self.fetchBatch(self.cursor, self.kwargs["fetch_batch_size"])
+                while rows:
+                    rows = [row for row in rows if row[0]]
+                    new_jids = [row[0] for row in rows if row[0] not in directory.entries]
+                    plain_jids = new_jids
+                    if self.AES_key:
+                        plain_jids = self.decrypt_batch_cached(new_jids, column)
+                    plain_jids = dict(zip(new_jids, plain_jids))
+                    for row in rows:
+                        plain_jid = plain_jids.get(row[0])
+                        if plain_jid is None:
+                            plain_jid = directory.entries[row[0]][0]
+                        directory.addCounts(row[0], plain_jid, row[1], row[2], row[3], received=bool(received))
+                    rows = self.fetchBatch(self.cursor, self.kwargs["fetch_batch_size"])
+            directory.refreshed = time.time()
+            directory.save()
+        return directory
+
     def getJids(self):
         # returns cleaned list of all jid (jabber suffix is removed)
-        all_jid = self.getAllto_jid()
-        all_jid.extend(self.getAllFrom_jid())
-        cleanedJid = []
-        for jid in all_jid:
-            jid = jid.split("/")[0]
-            if not jid in cleanedJid:
-                cleanedJid.append(jid)
-        cleanedJid.sort()
-        return cleanedJid
+        return self.refreshJidDirectory().bareJids()
+
+    def getJidInfo(self, jid):
+        # returns resources, first/last sent_date and message counts for a bare jid, False if it isn't known
+        return self.refreshJidDirectory().getJidInfo(jid.split("/")[0])
 
     def getAllChatRooms(self):
         allJid = self.getJids()
@@ -334,85 +2064,166 @@ class jabberArchiveTools:
     def getChatRoomsForUser(self, username):
         # returns list of all the chat rooms a user has received messages from
 
-        q_username = self.processStringForQuery(username)
-        # this needed because jabber adds a random jabber_XXXX tag after usernames, and it changes
-        # 16 bytes will be reliably the same after encryption because the IV and key don't change
-        q_username = q_username[:16]+'%'
+        userWhere, params = self.makeJidCondition("to_jid", username)
 
-        #self.cursor.execute("select * from {} where from_jid = ?".format(self.table), q_username)
-        self.cursor.execute("select distinct(from_jid) from {} where to_jid like ?".format(self.table), q_username)
+        self.execute(self.queries["distinct_where"].format("from_jid", userWhere), params)
         chatRooms = []
-        row = self.cursor.fetchone()
-        while row:
+        for aProcessedRow in self.iterProcessedRows():
             # need to then filter just incase we pulled the wrong ones
-            aProcessedRow = self.processRow(row)
             if "@conference" in aProcessedRow["from_jid"]:
                 if aProcessedRow["from_jid"].split("/")[0] not in chatRooms:
                     chatRooms.append(aProcessedRow["from_jid"].split("/")[0])
-            row = self.cursor.fetchone()
 
         return chatRooms
 
     def getSharedChatRoomForUsers(self, listOfUsers):
-        # returns list of chatrooms all users in the list used
+        """
+        Returns list of chatrooms all users in the list used
+        One query gets the distinct (from_jid, to_jid) pairs sent to any of the users, instead of one scan per user
+        Room from_jids include the sender, so their ciphertexts can't be intersected on the server.  Instead each
+        distinct ciphertext is decrypted once (not at all if the jid directory knows it) and the rooms are intersected here
+        """
+        if not listOfUsers:
+            return []
+
+        # group the users so no query has more than max_query_params parameters
+        userGroups = [[]]
+        groupParams = 0
+        conditions = {}
+        for user in listOfUsers:
+            conditions[user] = self.makeJidCondition("to_jid", user)
+            userParams = len(conditions[user][1])
+            if userGroups[-1] and groupParams + userParams > self.kwargs["max_query_params"]:
+                userGroups.append([])
+                groupParams = 0
+            userGroups[-1].append(user)
+            groupParams += userParams
+
+        pairs = set()
+        for users in userGroups:
+            userWhere = " or ".join(["({})".format(conditions[user][0]) for user in users])
+            params = []
+            for user in users:
+                params += conditions[user][1]
+            pairs.update(self.getStoredJidPairs(userWhere, params))
+
+        from_jids = self.decryptStoredJids([pair[0] for pair in pairs], "from_jid")
+        to_jids = self.decryptStoredJids([pair[1] for pair in pairs], "to_jid")
+        roomsForUser = dict((user, set()) for user in listOfUsers)
+        for from_jid, to_jid in pairs:
+            from_jid = from_jids[from_jid]
+            if "@conference" not in from_jid:
+                continue
+            to_jid = to_jids[to_jid]
+            # need to then filter just incase we pulled the wrong ones
+            for user in listOfUsers:
+                if to_jid.startswith(user):
+                    roomsForUser[user].add(from_jid.split("/")[0])
 
-        # start with first user
-        foundSetofRooms = set(self.getChatRoomsForUser(listOfUsers[0]))
-        # now do the remaining users
+        foundSetofRooms = roomsForUser[listOfUsers[0]]
         for user in listOfUsers[1:]:
-            thisset = set(self.getChatRoomsForUser(user))
-            foundSetofRooms = foundSetofRooms.intersection(thisset)
+            foundSetofRooms = foundSetofRooms.intersection(roomsForUser[user])
 
         return list(foundSetofRooms)
 
+    def getStoredJidPairs(self, userWhere, params):
+        # returns the set of distinct (from_jid, to_jid) pairs, still encrypted, for rows matching userWhere
+        self.execute(self.queries["distinct_pairs_where"].format("from_jid", "to_jid", userWhere), params)
+        pairs = set()
+        rows = self.fetchBatch(self.cursor, self.kwargs["fetch_batch_size"])
+        while rows:
+            pairs.update((row[0], row[1]) for row in rows if row[0] and row[1])
+            rows = self.fetchBatch(self.cursor, self.kwargs["fetch_batch_size"])
+        return pairs
+
+    def decryptStoredJids(self, stored_jids, column):
+        # returns {stored jid:plain jid}, using the jid directory where it already has the answer
+        stored_jids = set(stored_jids)
+        plain_jids = {}
+        unknown = []
+        for stored_jid in stored_jids:
+            entry = self.jid_directory.entries.get(stored_jid)
+            if entry is not None:
+                plain_jids[stored_jid] = entry[0]
+            else:
+                unknown.append(stored_jid)
+        if self.AES_key:
+            plain_jids.update(zip(unknown, self.decrypt_batch_cached(unknown, column)))
+        else:
+            plain_jids.update(zip(unknown, unknown))
+        return plain_jids
+
     def getSendersToUser(self, username):
         # returns list of all the recipients a user has received messages from
 
-        q_username = self.processStringForQuery(username)
-        # this needed because jabber adds a random jabber_XXXX tag after usernames, and it changes
-        # 16 bytes will be reliably the same after encryption because the IV and key don't change
-        q_username = q_username[:16]+'%'
+        userWhere, params = self.makeJidCondition("to_jid", username)
 
-        #self.cursor.execute("select * from {} where from_jid = ?".format(self.table), q_username)
-        self.cursor.execute("select distinct(from_jid) from {} where to_jid like ?".format(self.table), q_username)
+        self.execute(self.queries["distinct_where"].format("from_jid", userWhere), params)
         chatRooms = []
-        row = self.cursor.fetchone()
-        while row:
+        for aProcessedRow in self.iterProcessedRows():
             # need to then filter just incase we pulled the wrong ones
-            aProcessedRow = self.processRow(row)
             if "@conference" not in aProcessedRow["from_jid"]:
                 if aProcessedRow["from_jid"].split("/")[0] not in chatRooms:
                     chatRooms.append(aProcessedRow["from_jid"].split("/")[0])
-            row = self.cursor.fetchone()
 
         return chatRooms
 
     def getRecipientsOfUser(self,username):
         # Who has this user sent messages to
-        q_username = self.processStringForQuery(username)
-        # this needed because jabber adds a random jabber_XXXX tag after usernames, and it changes
-        # 16 bytes will be reliably the same after encryption because the IV and key don't change
-        q_username = q_username[:16]+'%'
+        userWhere, params = self.makeJidCondition("from_jid", username)
 
-        #self.cursor.execute("select * from {} where from_jid = ?".format(self.table), q_username)
-        self.cursor.execute("select distinct(to_jid) from {} where from_jid like ?".format(self.table), q_username)
+        self.execute(self.queries["distinct_where"].format("to_jid", userWhere), params)
         chatRooms = []
-        row = self.cursor.fetchone()
-        while row:
+        for aProcessedRow in self.iterProcessedRows():
             # need to then filter just incase we pulled the wrong ones
-            aProcessedRow = self.processRow(row)
             if "@conference" not in aProcessedRow["to_jid"]:
                 if aProcessedRow["to_jid"].split("/")[0] not in chatRooms:
                     chatRooms.append(aProcessedRow["to_jid"].split("/")[0])
-            row = self.cursor.fetchone()
 
         return chatRooms
 
+    def getActivity(self, jid, startTime=False, endTime=False, bucket="day", timezone="UTC"):
+        """
+        Message counts over time for a user or chatroom, see rebucketActivity for what is returned
+        sent is messages from the jid, received is messages to it
+        For a chatroom sent is the messages with a body posted in it, each counted once however many members got it
+        or had it resent when they joined (see activity_posted).  That goes by sender and text, so the same text
+        posted twice by someone counts once, and history resent for messages from before startTime counts at the join
+        The server groups the still encrypted rows by jid and 15 minute slot, so only the distinct jids are decrypted
+        (to drop rows the prefix search pulled in for other jids) and no message is read
+        """
+        timeWhere, timeParams = self.makeTimeCondition(startTime, endTime)
+        slotCounts = {}
+        sentQuery = "activity_sent"
+        if "@conference" in jid:
+            sentQuery = "activity_posted"
+        for index, (column, query) in enumerate([("from_jid", sentQuery), ("to_jid", "activity_received")]):
+            userWhere, params = self.makeJidCondition(column, jid)
+            self.execute(self.queries[query].format(userWhere, timeWhere), params + timeParams)
+            rows = []
+            batch = self.fetchBatch(self.cursor, self.kwargs["fetch_batch_size"])
+            while batch:
+                rows += [tuple(row) for row in batch if row[0]]
+                batch = self.fetchBatch(self.cursor, self.kwargs["fetch_batch_size"])
+            plain_jids = self.decryptStoredJids([row[0] for row in rows], column)
+            for stored_jid, slot, count in rows:
+                # need to then filter just incase we pulled the wrong ones
+                if plain_jids[stored_jid].startswith(jid):
+                    slotCounts.setdefault(int(slot), [0, 0])[index] += count
+        return rebucketActivity(slotCounts, bucket, timezone)
+
     def getUsersForChatroom(self, chatroom_jid):
-        allmessages = self.getMessagesFromUser(chatroom_jid, ignore_row_count=True)
+        # membership only needs to_jid, so this gets the distinct (from_jid, to_jid) pairs instead of every message
+        # (from_jid is kept to filter out rows the prefix search pulled in from other rooms)
+        userWhere, params = self.makeJidCondition("from_jid", chatroom_jid)
+        pairs = self.getStoredJidPairs(userWhere, params)
+        from_jids = self.decryptStoredJids([pair[0] for pair in pairs], "from_jid")
+        to_jids = self.decryptStoredJids([pair[1] for pair in pairs], "to_jid")
         users = {}
-        for msg in allmessages:
-            thisuser = msg["to_jid"].split("/")[0]
+        for from_jid, to_jid in pairs:
+            if not from_jids[from_jid].startswith(chatroom_jid):
+                continue
+            thisuser = to_jids[to_jid].split("/")[0]
             if thisuser not in users:
                 users[thisuser] = True
 
@@ -420,8 +2231,183 @@ class jabberArchiveTools:
         finalusers.sort()
         return finalusers
 
+    def getStoredJidPairCounts(self, userWhere, params, timeWhere="", timeParams=[]):
+        # returns {(stored from_jid, stored to_jid):(messages, first sent_date, last sent_date, distinct sent_dates)} for rows matching userWhere
+        self.execute(self.queries["jid_pair_counts"].format(userWhere, timeWhere), params + timeParams)
+        counts = {}
+        rows = self.fetchBatch(self.cursor, self.kwargs["fetch_batch_size"])
+        while rows:
+            for row in rows:
+                if row[0] and row[1]:
+                    counts[(row[0], row[1])] = (row[2], row[3], row[4], row[5])
+            rows = self.fetchBatch(self.cursor, self.kwargs["fetch_batch_size"])
+        return counts
+
+    def getContactGraph(self, jid=False, startTime=False, endTime=False, hops=1):
+        """
+        Who messaged whom, from grouped queries on the still encrypted (from_jid, to_jid) pairs, so no message is read
+        and only the distinct jids are decrypted (none the jid directory already knows)
+        Returns the edges busiest first, resources dropped, times are naive UTC like getJidInfo:
+            [{"source", "target", "kind", "messages", "first", "last"}...]
+        kind is
+            direct  user to user, messages is the one to one messages
+            posted  user to chatroom (the user@domain in the room/user@domain/resource from_jid), about the messages
+                    posted there (the most any one member got, counting history resent to them when they joined once)
+            member  chatroom to user, the chatroom messages the user got
+        Without a jid this is the whole archive in one query.  With one it is the edges to or from it (its direct
+        contacts, its chatrooms and what it posted in them), and each of hops > 1 adds the edges of everything the last
+        hop reached, a query or two (more past max_query_params) per hop
+        """
+        timeWhere, timeParams = self.makeTimeCondition(startTime, endTime)
+        if not jid:
+            return self.makeGraphEdges(self.getStoredJidPairCounts("from_jid is not null", [], timeWhere, timeParams))
+
+        pairs = {}
+        expanded = set()
+        frontier = set([jid.split("/")[0]])
+        for hop in range(hops):
+            conditions = []
+            for node in sorted(frontier):
+                # chatroom rows all have the room in from_jid
+                conditions.append(self.makeJidCondition("from_jid", node))
+                if "@conference" not in node:
+                    conditions.append(self.makeJidCondition("to_jid", node))
+            found = self.getJidPairCountsFor(conditions, timeWhere, timeParams)
+            from_jids = self.decryptStoredJids([pair[0] for pair in found], "from_jid")
+            to_jids = self.decryptStoredJids([pair[1] for pair in found], "to_jid")
+            expanded.update(frontier)
+            reached = set()
+            # (room, user) for the chatrooms a user got messages from, see below
+            posters = set()
+            for pair, counts in found.items():
+                from_bare = from_jids[pair[0]].split("/")[0]
+                to_bare = to_jids[pair[1]].split("/")[0]
+                # need to then filter just incase we pulled the wrong ones
+                if from_bare not in frontier and to_bare not in frontier:
+                    continue
+                pairs[pair] = counts
+                reached.update([from_bare, to_bare])
+                if "@conference" in from_bare and from_bare not in expanded:
+                    posters.add((from_bare, to_bare))
+            # what a user posted in a chatroom is from room/user/resource, which the rows above don't have unless the
+            # room itself was gone out from, so those rooms are searched for just the user's posts
+            conditions = [self.makeJidCondition("from_jid", "{}/{}/".format(room, user)) for room, user in sorted(posters)]
+            found = self.getJidPairCountsFor(conditions, timeWhere, timeParams)
+            from_jids = self.decryptStoredJids([pair[0] for pair in found], "from_jid")
+            for pair, counts in found.items():
+                parts = from_jids[pair[0]].split("/")
+                if len(parts) > 1 and (parts[0], parts[1]) in posters:
+                    pairs[pair] = counts
+            frontier = reached - expanded
+            if not frontier:
+                break
+        # posted edges of chatrooms that weren't gone out from only have the copies sent to the users that were
+        return [edge for edge in self.makeGraphEdges(pairs) if edge["source"] in expanded or edge["target"] in expanded]
+
+    def getJidPairCountsFor(self, conditions, timeWhere="", timeParams=[]):
+        # getStoredJidPairCounts for rows matching any of the (sql, params) conditions
+        found = {}
+        for userWhere, params in self.groupConditions(conditions):
+            found.update(self.getStoredJidPairCounts(userWhere, params, timeWhere, timeParams))
+        return found
+
+    def groupConditions(self, conditions):
+        # ORs the (sql, params) conditions together into as few (sql, params) as keep each under max_query_params parameters
+        groups = []
+        groupParams = 0
+        for condition in conditions:
+            if not groups or groupParams + len(condition[1]) > self.kwargs["max_query_params"]:
+                groups.append([])
+                groupParams = 0
+            groups[-1].append(condition)
+            groupParams += len(condition[1])
+        grouped = []
+        for group in groups:
+            userWhere = " or ".join(["({})".format(condition[0]) for condition in group])
+            params = []
+            for condition in group:
+                params += condition[1]
+            grouped.append(("({})".format(userWhere), params))
+        return grouped
+
+    def makeGraphEdges(self, pairs):
+        # turns getStoredJidPairCounts results into getContactGraph edges
+        from_jids = self.decryptStoredJids([pair[0] for pair in pairs], "from_jid")
+        to_jids = self.decryptStoredJids([pair[1] for pair in pairs], "to_jid")
+        edges = {}
+        def addEdge(source, target, kind, messages, first, last):
+            edge = edges.get((source, target, kind))
+            if edge is None:
+                edges[(source, target, kind)] = {"source":source, "target":target, "kind":kind, "messages":messages, "first":first, "last":last}
+                return
+            edge["messages"] += messages
+            edge["first"] = min(edge["first"], first)
+            edge["last"] = max(edge["last"], last)
+        # (sender, room, stored from_jid): [messages, first, last], every member gets a copy of what was posted
+        posted = {}
+        for pair, (messages, first, last, times) in pairs.items():
+            from_jid = from_jids[pair[0]]
+            to_bare = to_jids[pair[1]].split("/")[0]
+            if "@conference" in from_jid:
+                parts = from_jid.split("/")
+                sender = parts[1] if len(parts) > 1 else parts[0]
+                addEdge(parts[0], to_bare, "member", messages, first, last)
+                post = posted.setdefault((sender, parts[0], pair[0]), [0, first, last])
+                post[0] = max(post[0], times)
+                post[1] = min(post[1], first)
+                post[2] = max(post[2], last)
+            elif "@conference" in to_bare:
+                addEdge(from_jid.split("/")[0], to_bare, "posted", messages, first, last)
+            else:
+                addEdge(from_jid.split("/")[0], to_bare, "direct", messages, first, last)
+        for (sender, room, stored_jid), (messages, first, last) in posted.items():
+            addEdge(sender, room, "posted", messages, first, last)
+        return sorted(edges.values(), key=lambda edge: (-edge["messages"], edge["source"], edge["target"], edge["kind"]))
 
-    def getChatRoomLog(self, chatroom_jid, startTime=False, endTime=False, ignore_row_count=False):
+    def makeGraphFile(self, edges, filename, mode="csv", timezone='America/Los_Angeles', timefmt="%Y-%m-%d %H:%M:%S"):
+        """
+        Writes getContactGraph edges to filename
+        Modes: csv (one edge per row), graphml (nodes and edges, for Gephi, yEd, networkx...)
+        Returns the number of edges written
+        """
+        new_tz = pytz.timezone(timezone)
+        def localTime(utc_time):
+            return pytz.utc.localize(utc_time).astimezone(new_tz).strftime(timefmt)
+        if mode == "csv":
+            with open(filename, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["source", "target", "kind", "messages", "first", "last"])
+                for edge in edges:
+                    writer.writerow([edge["source"], edge["target"], edge["kind"], edge["messages"], localTime(edge["first"]), localTime(edge["last"])])
+            return len(edges)
+        if mode != "graphml":
+            raise Exception("Unknown graph file mode {}".format(mode))
+        nodes = {}
+        for edge in edges:
+            for node in (edge["source"], edge["target"]):
+                nodes[node] = "chatroom" if "@conference" in node else "user"
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+            f.write('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n')
+            f.write('  <key id="type" for="node" attr.name="type" attr.type="string"/>\n')
+            f.write('  <key id="kind" for="edge" attr.name="kind" attr.type="string"/>\n')
+            f.write('  <key id="messages" for="edge" attr.name="messages" attr.type="int"/>\n')
+            f.write('  <key id="first" for="edge" attr.name="first" attr.type="string"/>\n')
+            f.write('  <key id="last" for="edge" attr.name="last" attr.type="string"/>\n')
+            f.write('  <graph id="contacts" edgedefault="directed">\n')
+            for node in sorted(nodes):
+                f.write('    <node id={}><data key="type">{}</data></node>\n'.format(quoteattr(node), nodes[node]))
+            for edge in edges:
+                f.write('    <edge source={} target={}><data key="kind">{}</data><data key="messages">{}</data>'
+                        '<data key="first">{}</data><data key="last">{}</data></edge>\n'.format(
+                            quoteattr(edge["source"]), quoteattr(edge["target"]), edge["kind"], edge["messages"],
+                            localTime(edge["first"]), localTime(edge["last"])))
+            f.write('  </graph>\n')
+            f.write('</graphml>\n')
+        return len(edges)
+
+
+    def iterChatRoomLog(self, chatroom_jid, startTime=False, endTime=False, ignore_row_count=False, columns=None):
         """
         Get all the chats from this jid
         Current UUID = "0"
@@ -431,81 +2417,333 @@ class jabberArchiveTools:
             New UUID?
                 Add to chat log
                 set current UUID to this
+        Yields the unique messages as they are read from the archive
+        columns limits what is fetched and decrypted (see planColumns), message_string is always read for the id
+        The result cache keeps the de-duplicated log, each segment as a search starting at its start would see it
         """
-        allmessages = self.getMessagesFromUser(chatroom_jid, startTime, endTime, ignore_row_count)
-        seenUUID = {}
-        chatlog = []
-        # this re to get the message ID from <message from='chat558881748317483@conference-3-standaloneclusterff6b8.mpiphp.org/xxx@mpiphp.org/jabber_12137' id='f0734db9:6121:408b:a890:1e2987242cb4' to='n ..
-        id_re = re.compile(" id='(.+?)' ")
-        for msg in allmessages:
-            idFound = False
-            try:
-                idFound = id_re.search(msg["message_string"])
-            except:
-                # print("error RE on {}".format(msg))
-                pass
+        columns = self.planColumns(columns, ["from_jid", "message_string"])
+
+        def fetch(startTime, endTime, endInclusive, ignore_row_count):
+            messages = self.iterFetchMessagesFromUser(chatroom_jid, startTime, endTime, ignore_row_count, None, columns, endInclusive)
+            return self.iterUniqueMessages(messages)
+
+        messages = self.iterCachedSearch(["chatroom_log", chatroom_jid, columns], startTime, endTime, fetch, ignore_row_count, whole_segments=True)
+        if self.result_cache is not None:
+            # segments and fetched gaps were each de-duplicated on their own, this drops the repeats between them
+            messages = self.iterUniqueMessages(messages)
+        for msg in messages:
+            yield msg
+
+    def iterUniqueMessages(self, messages):
+        # chatroom messages with the ones already seen (same message id) left out
+        dedup = messageDeduplicator(self.kwargs["dedup_window_seconds"])
+        stats = self.stats
+        for msg in messages:
+            started = stats.clock()
+            messageId = self.getMessageIdBytes(msg)
+            keep = messageId is not None and dedup.isNew(messageId, msg["sent_date"])
+            stats.add("dedup", started, rows_deduped=not keep)
+            if keep:
+                yield msg
+
+    def getMessageIdBytes(self, msg):
+        # returns the message id of a processed row as bytes, None if it doesn't have one
+        if "message_id" in msg:
+            # already parsed by the process pool
+            if msg["message_id"] is None:
+                return None
+            return msg["message_id"].encode("utf-8")
+        c_text = None
+        if isinstance(msg, messageRecord) and self.AES_key:
+            c_text = msg.ciphertext("message_string")
+        if c_text:
+            # still encrypted, the id is near the start so only decrypt that much
+            messageId = self.getPrefixMessageId(c_text)
+            if messageId is not None:
+                return messageId
+        try:
+            idFound = message_id_re.search(msg["message_string"])
             if idFound:
-                if idFound.group() not in seenUUID:
-                    chatlog.append(msg)
-                    seenUUID[idFound.group()] = True
+                return idFound.group(1).encode("utf-8")
+        except:
+            # print("error RE on {}".format(msg))
+            pass
+        return None
+
+    def getPrefixMessageId(self, c_text):
+        # message id (bytes) from the first dedup_prefix_bytes of an encrypted message_string, None if it isn't found there
+        try:
+            prefix = decryptPrefix(self.AES_key, self.AES_IV, c_text, self.kwargs["dedup_prefix_bytes"])
+            idFound = message_id_bytes_re.search(prefix)
+            # only trust it if it is the first id attribute, an earlier one might end past the prefix
+            if idFound and prefix.find(b" id='") == idFound.start():
+                return idFound.group(1)
+        except (ValueError, binascii.Error):
+            pass
+        return None
 
-        return chatlog
+    def getStoredMessageId(self, stored_message_string):
+        # message id (bytes) of a message_string as the archive has it (encrypted or not), None if it has none
+        if not stored_message_string:
+            return None
+        if self.AES_key:
+            messageId = self.getPrefixMessageId(stored_message_string)
+            if messageId is not None:
+                return messageId
+            stored_message_string = self.processStringFromResult(stored_message_string, "message_string")
+        idFound = message_id_re.search(stored_message_string)
+        if idFound:
+            return idFound.group(1).encode("utf-8")
+        return None
+
+    def getChatRoomLog(self, chatroom_jid, startTime=False, endTime=False, ignore_row_count=False, columns=None):
+        # returns the de-duplicated list of messages in this chatroom, see iterChatRoomLog
+        return list(self.iterChatRoomLog(chatroom_jid, startTime, endTime, ignore_row_count, columns))
 
     def makeMessageDump(self, messages, filename=False, timezone='America/Los_Angeles', timefmt="%Y-%m-%d %H:%M:%S", from_jid_index=0, mode="human"):
         """
         Modes: human (readable), delim (pipe delimited )
-
+        messages can be any iterable (like the iter* generators), it is only read once
+        Returns the number of messages written
         """
-        new_tz = pytz.timezone(timezone)
-        f = None
+        converter = localTimeConverter(timezone)
         if filename:
-            f = open(filename, "w")
+            f = open(filename, "w", buffering=self.kwargs["export_buffer_size"])
+            newline = "\n"
+        else:
+            f = bufferedLineWriter(sys.stdout)
+            # print() used to add its own newline on top of the one in to_write
+            newline = "\n\n"
 
-        for msg in messages:
-            msg_time = datetime.fromtimestamp(msg["sent_date"].timestamp(), tz=new_tz)
-            msg_content = msg["body_string"]
-            from_jid = "NOT_FOUND"
-            try:
-                fjs = msg["from_jid"].split("/")
-                if len(fjs) > from_jid_index:
-                    from_jid = fjs[from_jid_index]
+        count = 0
+        stats = self.stats
+        try:
+            for msg in messages:
+                started = stats.clock()
+                msg_time = converter.convert(msg["sent_date"])
+                msg_content = msg["body_string"]
+                from_jid = "NOT_FOUND"
+                try:
+                    fjs = msg["from_jid"].split("/")
+                    if len(fjs) > from_jid_index:
+                        from_jid = fjs[from_jid_index]
+                    else:
+                        from_jid = fjs[0]
+                except Exception as badnews:
+                    # Just pass for now
+                    pass
+                if not msg_content:
+                    msg_content = "NO DATA"
+                time_str = msg_time.strftime(timefmt)
+                if mode == "delim":
+                    line = f"{time_str}|{from_jid}|{msg_content}{newline}"
                 else:
-                    from_jid = fjs[0]
-            except Exception as badnews:
-                # Just pass for now
-                pass
-            if not msg_content:
-                msg_content = "NO DATA"
-            time_str = msg_time.strftime(timefmt)
-            to_write = f"({time_str}) {from_jid}: {msg_content}\n"
-            if mode == "delim":
-                to_write = f"{time_str}|{from_jid}|{msg_content}\n"
-            if f is not None:
-                f.write(to_write)
-            else:
-                print(to_write)
-
-        if f:
+                    line = f"({time_str}) {from_jid}: {msg_content}{newline}"
+                f.write(line)
+                stats.add("render", started, rows_written=1, bytes_written=len(line))
+                count += 1
+        finally:
             f.close()
-
-
+        return count
 
     def makeChatroomDump(self, messages, filename=False, timezone='America/Los_Angeles', timefmt="%Y-%m-%d %H:%M:%S"):
-        self.makeMessageDump(messages, filename=filename, timezone='America/Los_Angeles', timefmt="%Y-%m-%d %H:%M:%S", from_jid_index=1)
+        return self.makeMessageDump(messages, filename=filename, timezone=timezone, timefmt=timefmt, from_jid_index=1)
 
     def makeChatLogFile(self, messages, filename, timezone='America/Los_Angeles', timefmt="%Y-%m-%d %H:%M:%S", from_jid_index=0):
-        new_tz = pytz.timezone(timezone)
-        with open(filename, "wb") as f:
+        # messages can be any iterable, returns the number of messages written
+        converter = localTimeConverter(timezone)
+        count = 0
+        stats = self.stats
+        with open(filename, "wb", buffering=self.kwargs["export_buffer_size"]) as f:
             for msg in messages:
-                htmlpart = self.getHTMLFromMessage(msg["message_string"])
+                started = stats.clock()
+                if "message_html" in msg:
+                    # already extracted by the process pool
+                    htmlpart = msg["message_html"]
+                else:
+                    htmlpart = self.getHTMLFromMessage(msg["message_string"])
                 if htmlpart:
-                    msg_time = datetime.fromtimestamp(msg["sent_date"].timestamp(), tz=new_tz)
+                    msg_time = converter.convert(msg["sent_date"])
                     fromline = "<h5>({}) {}:</h5>\n".format(msg_time.strftime(timefmt), msg["from_jid"].split("/")[from_jid_index])
-                    f.write(fromline.encode('utf-8','ignore'))
+                    fromline = fromline.encode('utf-8','ignore')
+                    f.write(fromline)
                     htmlpart += "\n"
-                    f.write(htmlpart.encode('utf-8','ignore'))
+                    htmlpart = htmlpart.encode('utf-8','ignore')
+                    f.write(htmlpart)
+                    stats.add("render", started, rows_written=1, bytes_written=len(fromline) + len(htmlpart))
+                    count += 1
+        return count
 
     def makeChatroomLogFile(self, messages, filename, timezone='America/Los_Angeles', timefmt="%Y-%m-%d %H:%M:%S"):
         # Only difference here is the from_jid_index.  When we split sa conference chat, the name of the actual sender is in
         # the second slot
-        self.makeChatLogFile(messages, filename, timezone, timefmt, from_jid_index=1)
+        return self.makeChatLogFile(messages, filename, timezone, timefmt, from_jid_index=1)
+
+
+class archiveJob:
+    # one call submitted to asyncArchiveTools, it runs in a worker thread on its own clone of the jabberArchiveTools
+
+    def __init__(self, job_id, description):
+        self.job_id = job_id
+        self.description = description
+        self.future = None
+        self.tools = None           # the clone running it, while it runs
+        self.cancelled = threading.Event()
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def cancel(self):
+        # a queued job never starts, a running one has its query cancelled and ends with searchCancelled
+        self.cancelled.set()
+        if not self.future.cancel():
+            tools = self.tools
+            if tools is not None:
+                tools.cancel()
+
+    def done(self):
+        return self.future.done()
+
+    def status(self):
+        if not self.future.done():
+            if self.started is None:
+                return "queued"
+            if self.cancelled.is_set():
+                return "cancelling"
+            return "running"
+        if self.cancelled.is_set():
+            return "cancelled"
+        if self.future.exception() is not None:
+            return "failed"
+        return "done"
+
+    def elapsed(self):
+        # seconds it has been running (or ran for)
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def result(self, timeout=None):
+        # waits for the job and returns what it returned, or raises what it raised
+        return self.future.result(timeout)
+
+
+class asyncArchiveTools:
+    """
+    Runs jabberArchiveTools searches in worker threads so several can be in flight at once
+    pyodbc calls block, so each call gets a clone of the tools on its own pooled connection (one active result per
+    connection) sharing the caches and jid directory.  Needs a pyodbc_connection_factory on the jabberArchiveTools
+
+    asyncio:
+        tools = asyncArchiveTools(jabs)
+        rooms, log = await asyncio.gather(tools.getAllChatRooms(), tools.getChatRoomLog(room))
+        async for msg in tools.iterMessagesFromUser(user): ...
+    Any jabberArchiveTools method can be awaited like this, iter* methods are async generators
+    Cancelling the awaiting task cancels the query on the server
+
+    Without asyncio, submit() returns an archiveJob that can be listed (jobs), cancelled and waited on
+    """
+
+    def __init__(self, jabs, max_workers=4):
+        if jabs.connection_pool is None:
+            raise Exception("asyncArchiveTools needs a jabberArchiveTools with a pyodbc_connection_factory")
+        self.jabs = jabs
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="jabberArchiveJob")
+        self.jobs = OrderedDict()
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # tools.getJids() -> coroutine, tools.iterChatRoomLog(...) -> async generator
+        if name.startswith("_") or not callable(getattr(jabberArchiveTools, name, None)):
+            raise AttributeError(name)
+        if name.startswith("iter"):
+            return functools.partial(self.iterate, name)
+        return functools.partial(self.call, name)
+
+    def submit(self, function, *args, description=None, **kwargs):
+        # runs function(clone of the tools, *args, **kwargs) in a worker thread and returns its archiveJob
+        # a generator result is read into a list in the worker
+        job = archiveJob(next(self.job_ids), description or getattr(function, "__name__", "job"))
+        with self.lock:
+            self.jobs[job.job_id] = job
+        job.future = self.executor.submit(self.runJob, job, function, args, kwargs)
+        return job
+
+    def runJob(self, job, function, args, kwargs):
+        job.started = time.time()
+        try:
+            if job.cancelled.is_set():
+                raise searchCancelled()
+            tools = self.jabs.clone(job.cancelled)
+            job.tools = tools
+            try:
+                result = function(tools, *args, **kwargs)
+                if inspect.isgenerator(result):
+                    result = list(result)
+                # cancelled after the last fetch, it still counts as cancelled
+                tools.checkCancelled()
+                return result
+            finally:
+                job.tools = None
+                tools.close()
+        finally:
+            job.finished = time.time()
+
+    def getJob(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def listJobs(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def forgetJob(self, job_id):
+        with self.lock:
+            return self.jobs.pop(job_id, None)
+
+    async def call(self, name, *args, **kwargs):
+        # awaits jabberArchiveTools.name(*args, **kwargs) run in a worker thread
+        job = self.submit(getattr(jabberArchiveTools, name), *args, description=name, **kwargs)
+        try:
+            return await asyncio.wrap_future(job.future)
+        except asyncio.CancelledError:
+            job.cancel()
+            raise
+        finally:
+            self.forgetJob(job.job_id)
+
+    async def iterate(self, name, *args, **kwargs):
+        # async generator over jabberArchiveTools.name(*args, **kwargs), fetch_batch_size rows are read at a time in a worker thread
+        loop = asyncio.get_running_loop()
+        batch_size = self.jabs.kwargs["fetch_batch_size"]
+        tools = await loop.run_in_executor(self.executor, self.jabs.clone)
+        rows = None
+        try:
+            # making the generator doesn't run anything yet
+            rows = getattr(tools, name)(*args, **kwargs)
+            while True:
+                batch = await loop.run_in_executor(self.executor, list, itertools.islice(rows, batch_size))
+                if not batch:
+                    return
+                for row in batch:
+                    yield row
+        except asyncio.CancelledError:
+            tools.cancel()
+            raise
+        finally:
+            await loop.run_in_executor(self.executor, self.closeIteration, tools, rows)
+
+    def closeIteration(self, tools, rows):
+        try:
+            if rows is not None:
+                rows.close()
+        finally:
+            tools.close()
+
+    def close(self):
+        # cancels every job that hasn't finished and waits for the worker threads
+        for job in self.listJobs():
+            if not job.done():
+                job.cancel()
+        self.executor.shutdown(wait=True)
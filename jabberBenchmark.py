@@ -0,0 +1,256 @@
+# standard packages
+import logging
+logger = logging.getLogger('jabberBenchmark')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+formatter = logging.Formatter('%(name)s:%(levelname)s:%(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+"""
+Benchmarks the jabberArchiveTools searches and exporters against a synthetic archive from jabberArchiveGenerator
+
+Each benchmark runs in a fresh process so its peak RSS is its own.  Reported for each one:
+    seconds, rows (messages or jids returned/written), rows/s, peak RSS in MB
+    decrypt benchmarks also report MB/s of ciphertext
+
+Baselines:
+    --save_baseline file.json   keeps these results
+    --baseline file.json        compares against kept results, a benchmark fails if rows/s drops (or peak RSS grows)
+                                by more than --tolerance, and the exit code is 1
+
+Example:
+    python jabberArchiveGenerator.py --db synthetic.db --rows 1000000
+    python jabberBenchmark.py --db synthetic.db --save_baseline baseline.json
+    (make changes)
+    python jabberBenchmark.py --db synthetic.db --baseline baseline.json
+"""
+
+
+def makeTools(db, kwargs):
+    import jabberSQLiteBackend
+    from jabberArchiveTools import jabberArchiveTools
+    from jabberArchiveGenerator import readSyntheticInfo
+    info = readSyntheticInfo(db)
+    toolKwargs = {
+                    "pyodbc_connection":jabberSQLiteBackend.connect(db),
+                    "pyodbc_connection_factory":lambda: jabberSQLiteBackend.connect(db),
+                    "AES_key_hex":info["AES_key_hex"],
+                    "AES_IV_hex":info["AES_IV_hex"],
+                    "row_count_alert_threshold":10**12,
+                    "sql_dialect":"sqlite",
+                }
+    toolKwargs.update(kwargs)
+    return jabberArchiveTools(**toolKwargs), info
+
+
+def busiestRoom(info):
+    return max(info["rooms"], key=lambda room: len(info["rooms"][room]))
+
+
+def pickUsers(info, count):
+    # members of the busiest room, so the shared chatroom search finds something
+    return info["rooms"][busiestRoom(info)][:count]
+
+
+# -- Benchmarks
+# each takes (jabs, info, scratch directory) and returns (rows, ciphertext bytes or 0)
+
+def benchMessagesFromUser(jabs, info, scratch):
+    return sum(1 for msg in jabs.iterMessagesFromUser(pickUsers(info, 1)[0])), 0
+
+def benchMessagesToUser(jabs, info, scratch):
+    return sum(1 for msg in jabs.iterMessagesToUser(pickUsers(info, 1)[0])), 0
+
+def benchMessagesBetweenUsers(jabs, info, scratch):
+    user1, user2 = info["busiest_pair"]
+    return sum(1 for msg in jabs.iterMessagesBetweenUsers(user1, user2)), 0
+
+def benchChatRoomLog(jabs, info, scratch):
+    return sum(1 for msg in jabs.iterChatRoomLog(busiestRoom(info))), 0
+
+def benchJids(jabs, info, scratch):
+    return len(jabs.getJids()), 0
+
+def benchChatRoomsForUser(jabs, info, scratch):
+    return len(jabs.getChatRoomsForUser(pickUsers(info, 1)[0])), 0
+
+def benchSharedChatRooms(jabs, info, scratch):
+    return len(jabs.getSharedChatRoomForUsers(pickUsers(info, 3))), 0
+
+def benchSendersToUser(jabs, info, scratch):
+    return len(jabs.getSendersToUser(pickUsers(info, 1)[0])), 0
+
+def benchRecipientsOfUser(jabs, info, scratch):
+    return len(jabs.getRecipientsOfUser(pickUsers(info, 1)[0])), 0
+
+def benchUsersForChatroom(jabs, info, scratch):
+    return len(jabs.getUsersForChatroom(busiestRoom(info))), 0
+
+def benchMessageDump(jabs, info, scratch):
+    messages = jabs.iterChatRoomLog(busiestRoom(info), columns="text")
+    return jabs.makeChatroomDump(messages, filename=os.path.join(scratch, "dump.txt")), 0
+
+def benchDelimDump(jabs, info, scratch):
+    messages = jabs.iterChatRoomLog(busiestRoom(info), columns="text")
+    return jabs.makeMessageDump(messages, filename=os.path.join(scratch, "dump.psv"), from_jid_index=1, mode="delim"), 0
+
+def benchChatLogFile(jabs, info, scratch):
+    messages = jabs.iterChatRoomLog(busiestRoom(info), columns="html")
+    return jabs.makeChatroomLogFile(messages, os.path.join(scratch, "log.html")), 0
+
+def readMessageStrings(jabs, limit=20000):
+    jabs.execute("select message_string from {} where message_string is not null".format(jabs.table))
+    return [row[0] for row in jabs.cursor.fetchmany(limit)]
+
+def benchDecryptBatch(jabs, info, scratch):
+    from jabberArchiveTools import decryptBatch
+    c_texts = readMessageStrings(jabs)
+    decryptBatch(jabs.AES_key, jabs.AES_IV, c_texts)
+    return len(c_texts), sum(len(c_text) for c_text in c_texts)
+
+def benchDecryptString(jabs, info, scratch):
+    from jabberArchiveTools import decryptString
+    c_texts = readMessageStrings(jabs)
+    for c_text in c_texts:
+        decryptString(jabs.AES_key, jabs.AES_IV, c_text)
+    return len(c_texts), sum(len(c_text) for c_text in c_texts)
+
+# name: (function, jabberArchiveTools kwargs)
+benchmarks = {
+    "messages_from_user":(benchMessagesFromUser, {}),
+    "messages_to_user":(benchMessagesToUser, {}),
+    "messages_between_users":(benchMessagesBetweenUsers, {}),
+    "chatroom_log":(benchChatRoomLog, {}),
+    "chatroom_log_sharded":(benchChatRoomLog, {"query_shards":4}),
+    "jids":(benchJids, {}),
+    "chatrooms_for_user":(benchChatRoomsForUser, {}),
+    "shared_chatrooms":(benchSharedChatRooms, {}),
+    "senders_to_user":(benchSendersToUser, {}),
+    "recipients_of_user":(benchRecipientsOfUser, {}),
+    "users_for_chatroom":(benchUsersForChatroom, {}),
+    "export_text":(benchMessageDump, {}),
+    "export_delim":(benchDelimDump, {}),
+    "export_html":(benchChatLogFile, {}),
+    "decrypt_batch":(benchDecryptBatch, {}),
+    "decrypt_string":(benchDecryptString, {}),
+}
+
+
+def peakRSSMB():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == "darwin":
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def runBenchmark(name, db, results):
+    # runs in its own process, puts the result dictionary on results
+    function, kwargs = benchmarks[name]
+    try:
+        scratch = tempfile.mkdtemp(prefix="jabberBenchmark")
+        jabs, info = makeTools(db, kwargs)
+        started = time.perf_counter()
+        rows, c_bytes = function(jabs, info, scratch)
+        seconds = time.perf_counter() - started
+        jabs.close()
+        result = {"seconds":seconds, "rows":rows, "rows_per_second":rows / seconds if seconds else 0.0, "peak_rss_mb":peakRSSMB()}
+        if c_bytes:
+            result["decrypt_mb_per_second"] = c_bytes / (1024 * 1024) / seconds
+        for filename in os.listdir(scratch):
+            os.remove(os.path.join(scratch, filename))
+        os.rmdir(scratch)
+        results.put(result)
+    except Exception as badnews:
+        results.put({"error":repr(badnews)})
+
+
+def runBenchmarks(db, names, repeat=1):
+    # returns {name: result}, the fastest of repeat runs is kept
+    context = multiprocessing.get_context("spawn")
+    allResults = {}
+    for name in names:
+        best = None
+        for attempt in range(repeat):
+            results = context.Queue()
+            process = context.Process(target=runBenchmark, args=(name, db, results))
+            process.start()
+            result = results.get()
+            process.join()
+            if "error" in result:
+                best = result
+                break
+            if best is None or result["seconds"] < best["seconds"]:
+                best = result
+        allResults[name] = best
+        logger.info("{}: {}".format(name, formatResult(best)))
+    return allResults
+
+
+def formatResult(result):
+    if "error" in result:
+        return "ERROR {}".format(result["error"])
+    text = "{rows} rows in {seconds:.3f}s, {rows_per_second:.0f} rows/s, peak RSS {peak_rss_mb:.0f}MB".format(**result)
+    if "decrypt_mb_per_second" in result:
+        text += ", {:.1f}MB/s decrypted".format(result["decrypt_mb_per_second"])
+    return text
+
+
+def compareToBaseline(results, baseline, tolerance):
+    # returns a list of (name, problem) for benchmarks that got worse than the baseline by more than tolerance
+    problems = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if "error" in result:
+            problems.append((name, result["error"]))
+            continue
+        before = baseline[name]
+        if before.get("rows") != result["rows"]:
+            problems.append((name, "returned {} rows, baseline had {}".format(result["rows"], before.get("rows"))))
+        if result["rows_per_second"] < before["rows_per_second"] * (1 - tolerance):
+            problems.append((name, "{:.0f} rows/s, baseline {:.0f} rows/s".format(result["rows_per_second"], before["rows_per_second"])))
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+            problems.append((name, "peak RSS {:.0f}MB, baseline {:.0f}MB".format(result["peak_rss_mb"], before["peak_rss_mb"])))
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks jabberArchiveTools against a synthetic archive (see jabberArchiveGenerator)")
+    parser.add_argument("--db", type=str, default="synthetic.db", help="SQLite archive made by jabberArchiveGenerator")
+    parser.add_argument("--only", type=str, nargs="+", choices=list(benchmarks), help="Just run these benchmarks")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each benchmark, the fastest is reported")
+    parser.add_argument("--save_baseline", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare the results to this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How much worse than the baseline is allowed (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        parser.error("{} not found, make it with jabberArchiveGenerator.py first".format(args.db))
+    names = args.only or list(benchmarks)
+    results = runBenchmarks(args.db, names, args.repeat)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Baseline saved to {}".format(args.save_baseline))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        problems = compareToBaseline(results, baseline, args.tolerance)
+        for name, problem in problems:
+            print("FAIL {}: {}".format(name, problem))
+        if problems:
+            sys.exit(1)
+        print("All benchmarks within {:.0%} of the baseline".format(args.tolerance))
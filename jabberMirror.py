@@ -0,0 +1,135 @@
+# standard packages
+import logging
+logger = logging.getLogger('jabberMirror')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+formatter = logging.Formatter('%(name)s:%(levelname)s:%(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+# registers the datetime format the backend reads back
+import jabberSQLiteBackend
+
+"""
+Keeps a local SQLite mirror of the Jabber archive table, so repeated investigations run at disk speed without loading
+the archive server.  Rows are copied as they are (still encrypted), so the same key, IV and table name work on it
+
+    mirror = archiveMirror("mirror.db", pyodbc.connect(ODBC))
+    mirror.sync()                                   # copies what is new since the last sync
+    jabs = jabberArchiveTools(pyodbc_connection=jabberSQLiteBackend.connect("mirror.db"), sql_dialect="sqlite", ...)
+
+Each sync reads the rows from the watermark (newest sent_date copied) less overlap_seconds onward, in fetchmany
+batches, and replaces that stretch of the mirror, so rows sharing the watermark's sent_date or written a little late
+aren't lost or doubled.  Rows written to the archive much later with an older sent_date aren't picked up
+The watermark is committed with each group of batches, an interrupted sync carries on from there next time
+The mirror holds the same encrypted data as the archive, treat it like the archive itself
+"""
+
+
+class archiveMirror:
+
+    def __init__(self, filename, source_connection=None, **kwargs):
+        dictionaryOfDefaultKwargs = {
+                                        "table":"jm",           # table on the archive server, the mirror uses the same name
+                                        "batch_size":5000,      # rows per fetchmany and insert
+                                        "commit_batches":20,    # batches per commit (and watermark update)
+                                        "overlap_seconds":60,   # re-read this much before the watermark on each sync
+                                    }
+        for arg in dictionaryOfDefaultKwargs:
+            if arg not in kwargs:
+                kwargs[arg] = dictionaryOfDefaultKwargs[arg]
+        self.kwargs = kwargs
+        self.filename = filename
+        # only needed to sync
+        self.source_connection = source_connection
+        self.table = kwargs["table"]
+        self.meta_table = "{}_mirror".format(self.table)
+
+    def connect(self):
+        return sqlite3.connect(self.filename)
+
+    def readMeta(self, sqlite):
+        try:
+            return dict((name, json.loads(value)) for name, value in sqlite.execute("select name, value from {}".format(self.meta_table)))
+        except sqlite3.OperationalError:
+            # never synced
+            return {}
+
+    def writeMeta(self, sqlite, **values):
+        sqlite.executemany("insert or replace into {} values (?,?)".format(self.meta_table),
+                           [(name, json.dumps(value)) for name, value in values.items()])
+
+    def status(self):
+        # watermark, rows and last sync time, or an empty dictionary if it has never been synced
+        if not os.path.exists(self.filename):
+            return {}
+        sqlite = self.connect()
+        try:
+            return self.readMeta(sqlite)
+        finally:
+            sqlite.close()
+
+    def createTables(self, sqlite, columns):
+        # the mirror table takes its columns from the source query, SQLite doesn't need types
+        sqlite.execute("create table if not exists {} ({})".format(self.table, ", ".join(columns)))
+        sqlite.execute("create table if not exists {} (name text primary key, value text)".format(self.meta_table))
+
+    def createIndexes(self, sqlite):
+        # same indexes as the archive server, made after the first load since that is quicker than keeping them up as it goes
+        sqlite.execute("create index if not exists {0}_to_jid on {0} (to_jid, sent_date)".format(self.table))
+        sqlite.execute("create index if not exists {0}_from_jid on {0} (from_jid, sent_date)".format(self.table))
+        sqlite.execute("create index if not exists {0}_sent_date on {0} (sent_date)".format(self.table))
+
+    def sync(self):
+        # copies everything new on the archive server into the mirror, returns the number of rows copied
+        if self.source_connection is None:
+            raise Exception("archiveMirror needs a source_connection to sync")
+        started = time.time()
+        sqlite = self.connect()
+        try:
+            meta = self.readMeta(sqlite)
+            where = ""
+            params = []
+            since = None
+            if meta.get("watermark"):
+                since = datetime.strptime(meta["watermark"], "%Y-%m-%dT%H:%M:%S.%f") - timedelta(seconds=self.kwargs["overlap_seconds"])
+                where = " where sent_date >= ?"
+                params = [since]
+            cursor = self.source_connection.cursor()
+            cursor.execute("select * from {}{} order by sent_date".format(self.table, where), *params)
+            columns = [column[0] for column in cursor.description]
+            sent_date_index = columns.index("sent_date")
+            self.createTables(sqlite, columns)
+            if since is not None:
+                # these are all read again
+                sqlite.execute("delete from {} where sent_date >= ?".format(self.table), [since])
+            insert = "insert into {} ({}) values ({})".format(self.table, ", ".join(columns), ", ".join("?" * len(columns)))
+            copied = 0
+            batches = 0
+            watermark = meta.get("watermark")
+            rows = cursor.fetchmany(self.kwargs["batch_size"])
+            while rows:
+                sqlite.executemany(insert, [tuple(row) for row in rows])
+                copied += len(rows)
+                batches += 1
+                watermark = rows[-1][sent_date_index].strftime("%Y-%m-%dT%H:%M:%S.%f")
+                if batches % self.kwargs["commit_batches"] == 0:
+                    self.writeMeta(sqlite, watermark=watermark)
+                    sqlite.commit()
+                    logger.info("{} rows copied, {:.0f} rows/s".format(copied, copied / (time.time() - started)))
+                rows = cursor.fetchmany(self.kwargs["batch_size"])
+            cursor.close()
+            self.createIndexes(sqlite)
+            total = sqlite.execute("select count(*) from {}".format(self.table)).fetchone()[0]
+            self.writeMeta(sqlite, watermark=watermark, rows=total, synced=datetime.now().strftime("%Y-%m-%dT%H:%M:%S"))
+            sqlite.commit()
+        finally:
+            sqlite.close()
+        logger.info("{} rows copied to {} in {:.1f}s".format(copied, self.filename, time.time() - started))
+        return copied
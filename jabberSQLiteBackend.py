@@ -0,0 +1,129 @@
+"""
+Lets jabberArchiveTools run against a local SQLite copy of the jm table instead of SQL Server
+connect() returns an object that looks enough like a pyodbc connection for jabberArchiveTools:
+    cursor().execute(sql, *params), fetchone/fetchmany/fetchall, description, cancel, close
+    rows can be read by index or by column name (row.to_jid) like pyodbc rows
+    sent_date (and min/max of it) comes back as a datetime, like it does from SQL Server
+
+Used by jabberArchiveGenerator/jabberBenchmark and for the jabberMirror copy, and works for any jm table copied into SQLite
+"""
+
+import sqlite3
+import re
+import threading
+from datetime import datetime
+
+# SQLite keeps datetimes as text, anything that looks like one comes back as a datetime
+datetime_re = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d+)?$")
+
+
+def adaptDatetime(value):
+    # same text format the generator stores sent_date in, so comparisons on it work as text
+    # fractions of a second are kept when there are some (the result cache asks for sent_date < end + 1 microsecond)
+    if value.microsecond:
+        return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+sqlite3.register_adapter(datetime, adaptDatetime)
+
+
+def convertValue(value):
+    if isinstance(value, str) and datetime_re.match(value):
+        if "." in value:
+            return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+    return value
+
+
+class sqliteRow(tuple):
+    # tuple with pyodbc style attribute access to the columns
+    __slots__ = ()
+    columns = {}
+
+    def __getattr__(self, name):
+        try:
+            return self[self.columns[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class sqliteCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.sqlite.cursor()
+        self.description = None
+        self.rowClass = sqliteRow
+        self.convertIndexes = ()
+        # thread that ran the last query, see cancel
+        self.thread = None
+
+    def execute(self, sql, *params):
+        # pyodbc takes the parameters either spread out or as one list
+        if len(params) == 1 and isinstance(params[0], (list, tuple)):
+            params = params[0]
+        self.thread = threading.get_ident()
+        self.cursor.execute(sql, params)
+        self.description = self.cursor.description
+        if self.description is not None:
+            names = [column[0] for column in self.description]
+            # a row class per query, so the column name lookup is shared by every row
+            self.rowClass = type("sqliteRow", (sqliteRow,), {"__slots__":(), "columns":dict((name, index) for index, name in enumerate(names))})
+            self.convertIndexes = tuple(index for index, name in enumerate(names) if "date" in name.lower())
+        return self
+
+    def makeRow(self, row):
+        if self.convertIndexes:
+            row = list(row)
+            for index in self.convertIndexes:
+                row[index] = convertValue(row[index])
+        return self.rowClass(row)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return self.makeRow(row)
+
+    def fetchmany(self, size=1):
+        return [self.makeRow(row) for row in self.cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [self.makeRow(row) for row in self.cursor.fetchall()]
+
+    def cancel(self):
+        # Like pyodbc's cancel this can come from another thread while the query's thread is in execute or fetchmany
+        # (jabberArchiveTools.cancel), and closing the sqlite3 cursor under it would crash that thread.  So the running
+        # statement is interrupted instead: its thread gets OperationalError("interrupted") from the next step, which
+        # jabberArchiveTools raises as searchCancelled.  From the query's own thread it just drops the rest of the result
+        if self.thread is not None and self.thread != threading.get_ident():
+            self.connection.sqlite.interrupt()
+            return
+        self.cursor.close()
+        self.cursor = self.connection.sqlite.cursor()
+
+    def close(self):
+        self.cursor.close()
+
+
+class sqliteConnection:
+
+    def __init__(self, filename):
+        # shards and the connection pool use connections from other threads
+        self.sqlite = sqlite3.connect(filename, check_same_thread=False)
+        # LIKE has to be case sensitive for base64 prefixes, SQLite's default isn't
+        self.sqlite.execute("PRAGMA case_sensitive_like = ON")
+
+    def cursor(self):
+        return sqliteCursor(self)
+
+    def commit(self):
+        self.sqlite.commit()
+
+    def close(self):
+        self.sqlite.close()
+
+
+def connect(filename):
+    return sqliteConnection(filename)
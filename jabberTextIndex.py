@@ -0,0 +1,312 @@
+# standard packages
+import logging
+logger = logging.getLogger('jabberTextIndex')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+formatter = logging.Formatter('%(name)s:%(levelname)s:%(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+import array
+import hashlib
+import json
+import math
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import pytz
+
+from jabberArchiveTools import parseSearchTime
+
+"""
+Local inverted index of the decrypted message bodies, so text can be searched without dumping whole conversations
+(the archive server can't search body_string, it is encrypted)
+
+    index = textIndex("jabberTextIndex.db", jabs.table, jabs.key_fingerprint)
+    index.update(jabs)                              # indexes messages newer than the last update
+    index.search(jabs, ["lunch meeting", "vault*"], startTime, endTime, jid="bob@example.org")
+
+Query parts are a word, a prefix (vault*) or a phrase ("lunch meeting", the words next to each other in that order),
+a message has to match every part.  Matches are ranked with BM25 and only the bodies of the results are decrypted
+Each chatroom message is indexed once (on its message id), not once per member it was copied to, with the room as its to_jid
+so a jid narrows the search to a chatroom's discussion, or to a user's one to one messages and chatroom posts
+(the chatroom messages a user only got aren't included, the index doesn't keep which members got them)
+
+The index is a SQLite file with the words and jids in plain text (the bodies stay encrypted as they are in the archive),
+treat it like the archive itself
+"""
+
+token_re = re.compile(r"\w+")
+
+
+def matchesJid(stored_jid, jid):
+    # stored_jid is jid with any resource, a bare jid doesn't match other users whose jids just start the same
+    if "@" in jid and "/" not in jid:
+        return stored_jid == jid or stored_jid.startswith(jid + "/")
+    return stored_jid.startswith(jid)
+
+
+def isMessageOf(from_jid, to_jid, jid):
+    # the message is from or to jid (like getMessagesFromUser and getMessagesToUser), or jid posted it in a chatroom
+    from_jid = from_jid or ""
+    if matchesJid(from_jid, jid) or matchesJid(to_jid or "", jid):
+        return True
+    if "@conference" in from_jid:
+        # room/user@domain/resource
+        parts = from_jid.split("/", 1)
+        return len(parts) > 1 and matchesJid(parts[1], jid)
+    return False
+
+
+def tokenize(text):
+    # lower case words, their place in the list is the position phrase queries check
+    return [token.lower() for token in token_re.findall(text or "")]
+
+
+def parseQuery(parts):
+    # returns a list of phrases, each a list of (word, is prefix), for textIndex.search
+    phrases = []
+    for part in parts:
+        words = []
+        for word in part.split():
+            tokens = tokenize(word)
+            for index, token in enumerate(tokens):
+                # punctuation splits a word the same way it does in the messages, only the last piece can be a prefix
+                words.append((token, word.endswith("*") and index == len(tokens) - 1))
+        if words:
+            phrases.append(words)
+    return phrases
+
+
+class textIndex:
+
+    VERSION = 1
+    TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    def __init__(self, filename, table="jm", key_fingerprint="", batch_size=2000):
+        self.filename = filename
+        self.table = table
+        self.key_fingerprint = key_fingerprint
+        self.batch_size = batch_size
+        # time.time() of the last update in this session
+        self.refreshed = None
+        # background jobs share the index
+        self.lock = threading.RLock()
+        self.sqlite = sqlite3.connect(filename, check_same_thread=False)
+        self.createTables()
+        meta = self.readMeta()
+        if meta and (meta.get("version") != self.VERSION or meta.get("table") != self.table or meta.get("key") != self.key_fingerprint):
+            # built against something else, start over
+            logger.info("Text index {} does not match this archive, rebuilding it".format(self.filename))
+            self.sqlite.execute("drop table text_postings")
+            self.sqlite.execute("drop table text_docs")
+            self.sqlite.execute("drop table text_meta")
+            self.createTables()
+            meta = {}
+        if not meta:
+            self.writeMeta(version=self.VERSION, table=self.table, key=self.key_fingerprint, watermark=None, docs=0, total_length=0)
+            self.sqlite.commit()
+
+    def createTables(self):
+        self.sqlite.execute("create table if not exists text_meta (name text primary key, value text)")
+        # body is the body_string as the archive has it (encrypted)
+        self.sqlite.execute("create table if not exists text_docs (doc_id integer primary key, doc_key blob unique, sent_date text, "
+                            "from_jid text, to_jid text, body text, length integer)")
+        # positions are an array of unsigned ints
+        self.sqlite.execute("create table if not exists text_postings (term text, doc_id integer, positions blob, "
+                            "primary key (term, doc_id)) without rowid")
+        self.sqlite.execute("create index if not exists text_docs_sent_date on text_docs (sent_date)")
+
+    def readMeta(self):
+        return dict((name, json.loads(value)) for name, value in self.sqlite.execute("select name, value from text_meta"))
+
+    def writeMeta(self, **values):
+        self.sqlite.executemany("insert or replace into text_meta values (?,?)", [(name, json.dumps(value)) for name, value in values.items()])
+
+    def status(self):
+        # watermark (newest sent_date indexed, UTC) and the number of messages in the index
+        with self.lock:
+            meta = self.readMeta()
+        return {"watermark":meta["watermark"], "docs":meta["docs"]}
+
+    def update(self, jabs, force=False, refresh_seconds=300):
+        # indexes the archive messages with a body that are newer than the watermark, returns how many were added
+        # rows from the watermark's own sent_date are read again, the doc keys keep them from being added twice
+        with self.lock:
+            if not force and self.refreshed and time.time() - self.refreshed < refresh_seconds:
+                return 0
+            meta = self.readMeta()
+            where = " where body_string is not null"
+            params = []
+            if meta["watermark"]:
+                where += " and sent_date >= ?"
+                params = [datetime.strptime(meta["watermark"], self.TIME_FORMAT)]
+            jabs.execute("select sent_date, from_jid, to_jid, body_string, message_string from {}{} order by sent_date".format(jabs.table, where), params)
+            added = 0
+            rows = jabs.fetchBatch(jabs.cursor, self.batch_size)
+            while rows:
+                docs, length = self.addRows(jabs, rows)
+                added += docs
+                meta["docs"] += docs
+                meta["total_length"] += length
+                meta["watermark"] = rows[-1][0].replace(tzinfo=None).strftime(self.TIME_FORMAT)
+                self.writeMeta(watermark=meta["watermark"], docs=meta["docs"], total_length=meta["total_length"])
+                self.sqlite.commit()
+                rows = jabs.fetchBatch(jabs.cursor, self.batch_size)
+            self.refreshed = time.time()
+        return added
+
+    def decryptColumn(self, jabs, c_texts, column):
+        if not jabs.AES_key:
+            return c_texts
+        if column == "body_string":
+            # bodies rarely repeat, they would just push the jids out of the cache
+            return jabs.decrypt_batch(c_texts)
+        return jabs.decrypt_batch_cached(c_texts, column)
+
+    def docKey(self, jabs, row, from_jid):
+        # chatroom messages are copied to every member and resent when someone joins, they are one message per id
+        if "@conference" in from_jid:
+            messageId = jabs.getStoredMessageId(row[4])
+            if messageId is not None:
+                return hashlib.blake2b(from_jid.split("/")[0].encode("utf-8") + b"\0" + messageId, digest_size=16).digest()
+        key = "\0".join([row[0].strftime(self.TIME_FORMAT), row[1] or "", row[2] or "", row[3] or ""])
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+    def addRows(self, jabs, rows):
+        # returns (messages added, words added)
+        from_jids = self.decryptColumn(jabs, [row[1] for row in rows], "from_jid")
+        to_jids = self.decryptColumn(jabs, [row[2] for row in rows], "to_jid")
+        bodies = self.decryptColumn(jabs, [row[3] for row in rows], "body_string")
+        added = 0
+        total_length = 0
+        for row, from_jid, to_jid, body in zip(rows, from_jids, to_jids, bodies):
+            if "@conference" in (from_jid or ""):
+                # sent to the room, to_jid is just the member this copy went to
+                to_jid = from_jid.split("/")[0]
+            tokens = tokenize(body)
+            cursor = self.sqlite.execute("insert or ignore into text_docs (doc_key, sent_date, from_jid, to_jid, body, length) values (?,?,?,?,?,?)",
+                                         (self.docKey(jabs, row, from_jid or ""), row[0].replace(tzinfo=None).strftime(self.TIME_FORMAT),
+                                          from_jid, to_jid, row[3], len(tokens)))
+            if cursor.rowcount == 0:
+                # already indexed
+                continue
+            positions = {}
+            for position, token in enumerate(tokens):
+                positions.setdefault(token, []).append(position)
+            self.sqlite.executemany("insert into text_postings values (?,?,?)",
+                                    [(token, cursor.lastrowid, array.array("I", places).tobytes()) for token, places in positions.items()])
+            added += 1
+            total_length += len(tokens)
+        return added, total_length
+
+    def findWord(self, word, prefix, timeWhere, timeParams):
+        # doc id -> sorted positions of the word (or of every word starting with it)
+        query = "select p.doc_id, p.positions from text_postings p join text_docs d on d.doc_id = p.doc_id where "
+        if prefix:
+            # every term sorting from word up to word followed by the highest character
+            query += "p.term >= ? and p.term < ?"
+            params = [word, word + "\U0010ffff"]
+        else:
+            query += "p.term = ?"
+            params = [word]
+        found = {}
+        for doc_id, positions in self.sqlite.execute(query + timeWhere, params + timeParams):
+            places = array.array("I")
+            places.frombytes(positions)
+            found.setdefault(doc_id, []).extend(places)
+        if prefix:
+            for places in found.values():
+                places.sort()
+        return found
+
+    def findPhrase(self, phrase, candidates, timeWhere, timeParams):
+        # doc id -> times the phrase is in it, only for docs in candidates (None for any)
+        words = []
+        for word, prefix in phrase:
+            found = self.findWord(word, prefix, timeWhere, timeParams)
+            if candidates is not None:
+                found = dict((doc_id, places) for doc_id, places in found.items() if doc_id in candidates)
+            words.append(found)
+            candidates = set(found)
+        counts = {}
+        for doc_id in candidates:
+            if len(words) == 1:
+                counts[doc_id] = len(words[0][doc_id])
+                continue
+            later = [set(found[doc_id]) for found in words[1:]]
+            count = sum(1 for start in words[0][doc_id] if all(start + offset + 1 in places for offset, places in enumerate(later)))
+            if count:
+                counts[doc_id] = count
+        return counts
+
+    def search(self, jabs, parts, startTime=False, endTime=False, jid=False, limit=50, order="time"):
+        """
+        Messages matching every query part (see parseQuery) between startTime and endTime (UTC), of jid if given
+        (a chatroom's messages, or a user's one to one messages and chatroom posts, see isMessageOf)
+        The best limit of them by BM25 score are returned, in time order (order="time") or best first (order="rank"):
+            [{"sent_date", "from_jid", "to_jid", "body_string", "score"}...]
+        Only the bodies of these are decrypted
+        """
+        phrases = parseQuery(parts)
+        if not phrases:
+            return []
+        clauses = []
+        timeParams = []
+        startTime = parseSearchTime(startTime)
+        endTime = parseSearchTime(endTime)
+        if startTime:
+            clauses.append("d.sent_date >= ?")
+            timeParams.append(startTime.strftime(self.TIME_FORMAT))
+        if endTime:
+            clauses.append("d.sent_date <= ?")
+            timeParams.append(endTime.strftime(self.TIME_FORMAT))
+        timeWhere = "".join(" and " + clause for clause in clauses)
+        with self.lock:
+            meta = self.readMeta()
+            if not meta["docs"]:
+                return []
+            average_length = meta["total_length"] / meta["docs"]
+            candidates = None
+            phraseCounts = []
+            for phrase in phrases:
+                counts = self.findPhrase(phrase, candidates, timeWhere, timeParams)
+                phraseCounts.append(counts)
+                candidates = set(counts)
+                if not candidates:
+                    return []
+            docs = {}
+            candidates = list(candidates)
+            for offset in range(0, len(candidates), 500):
+                chunk = candidates[offset:offset + 500]
+                query = "select doc_id, sent_date, from_jid, to_jid, body, length from text_docs where doc_id in ({})".format(",".join("?" * len(chunk)))
+                for row in self.sqlite.execute(query, chunk):
+                    docs[row[0]] = row
+        if jid:
+            docs = dict((doc_id, row) for doc_id, row in docs.items() if isMessageOf(row[2], row[3], jid))
+        scores = dict.fromkeys(docs, 0.0)
+        for counts in phraseCounts:
+            # how rare the part is (among the messages in the time frame)
+            idf = math.log(1 + (meta["docs"] - len(counts) + 0.5) / (len(counts) + 0.5))
+            for doc_id in docs:
+                tf = counts[doc_id]
+                norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * docs[doc_id][5] / average_length)
+                scores[doc_id] += idf * tf * (self.BM25_K1 + 1) / (tf + norm)
+        best = sorted(docs, key=lambda doc_id: (-scores[doc_id], docs[doc_id][1]))[:limit]
+        bodies = self.decryptColumn(jabs, [docs[doc_id][4] for doc_id in best], "body_string")
+        results = []
+        for doc_id, body in zip(best, bodies):
+            row = docs[doc_id]
+            results.append({"sent_date":datetime.strptime(row[1], self.TIME_FORMAT).replace(tzinfo=pytz.utc),
+                            "from_jid":row[2], "to_jid":row[3], "body_string":body, "score":scores[doc_id]})
+        if order == "time":
+            results.sort(key=lambda result: result["sent_date"])
+        return results
+
+    def close(self):
+        with self.lock:
+            self.sqlite.close()
@@ -0,0 +1,192 @@
+# standard packages
+import logging
+logger = logging.getLogger('jabberWatchlist')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+formatter = logging.Formatter('%(name)s:%(levelname)s:%(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
+
+import re
+from collections import deque
+
+# pyahocorasick is optional, it just runs the same automaton in C
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+"""
+Scans message bodies for a watchlist of terms in one pass, instead of one search (or grep) per term
+
+    matcher = watchlistMatcher(readWatchlist("terms.txt"))
+    for hit in scanMessages(jabs.iterAllMessages(columns="text"), matcher):
+        print(hit["sent_date"], hit["sender"], hit["room"], hit["term"], hit["context"])
+
+All the terms go into one Aho-Corasick automaton, so each body is read once however many terms there are
+Terms match whole words, case and runs of whitespace are ignored ("Project  Falcon" finds "project falcon")
+A * at the end of a term lets the last word carry on (merger* finds mergers), one at the start lets the first word
+start mid-word (*coin finds bitcoin)
+"""
+
+space_re = re.compile(r"\s+")
+
+
+def readWatchlist(filename):
+    # one term per line, blank lines and lines starting with # are skipped
+    terms = []
+    with open(filename, encoding="utf-8") as f:
+        for line in f:
+            term = line.strip()
+            if term and not term.startswith("#"):
+                terms.append(term)
+    return terms
+
+
+def isWordCharacter(character):
+    # same as \w
+    return character.isalnum() or character == "_"
+
+
+def normalizeText(text):
+    # returns (text with whitespace collapsed, the same lower cased), hits are found in the second and shown from the first
+    clean = space_re.sub(" ", text)
+    lower = clean.lower()
+    if len(lower) != len(clean):
+        # a few characters lower case to two, positions would be off
+        clean = lower
+    return clean, lower
+
+
+class watchlistMatcher:
+
+    def __init__(self, terms, use_library=True):
+        # (term as given, pattern, has to start a word, has to end a word) for each term
+        self.terms = []
+        # pattern: indexes in self.terms, terms that only differ in their * share a pattern
+        self.patterns = {}
+        for term in terms:
+            pattern = space_re.sub(" ", term.strip()).lower()
+            start_word = not pattern.startswith("*")
+            end_word = not pattern.endswith("*")
+            pattern = pattern.strip("*").strip()
+            if not pattern:
+                continue
+            self.terms.append((term, pattern, start_word, end_word))
+            self.patterns.setdefault(pattern, []).append(len(self.terms) - 1)
+        self.automaton = None
+        if ahocorasick is not None and use_library:
+            self.automaton = ahocorasick.Automaton()
+            for pattern, indexes in self.patterns.items():
+                self.automaton.add_word(pattern, (len(pattern), indexes))
+            if self.patterns:
+                self.automaton.make_automaton()
+        else:
+            self.build()
+
+    def build(self):
+        # goto[state] is {character: next state}, fail[state] the state of its longest proper suffix that is also a prefix
+        # out[state] has (length, term indexes) of every pattern ending at that state
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for pattern, indexes in self.patterns.items():
+            state = 0
+            for character in pattern:
+                following = self.goto[state].get(character)
+                if following is None:
+                    following = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[state][character] = following
+                state = following
+            self.out[state].append((len(pattern), indexes))
+        # breadth first, so the fail state of each state is done before it
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, following in self.goto[state].items():
+                queue.append(following)
+                fail = self.fail[state]
+                while fail and character not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[following] = self.goto[fail].get(character, 0)
+                self.out[following] = self.out[following] + self.out[self.fail[following]]
+
+    def iterPatternEnds(self, text):
+        # yields (index of the last character, (length, term indexes)) for every pattern found in text
+        if self.automaton is not None:
+            if self.patterns:
+                for item in self.automaton.iter(text):
+                    yield item
+            return
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        state = 0
+        for end, character in enumerate(text):
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            for found in out[state]:
+                yield end, found
+
+    def findall(self, text):
+        # yields (start, end, term index) for each term in text, which has to be lower case with whitespace collapsed
+        # (see normalizeText), end is one past the last character
+        for last, (length, indexes) in self.iterPatternEnds(text):
+            start = last - length + 1
+            end = last + 1
+            for index in indexes:
+                term, pattern, start_word, end_word = self.terms[index]
+                # a word boundary only matters where the pattern starts or ends with a word character
+                if start_word and start > 0 and isWordCharacter(text[start - 1]) and isWordCharacter(pattern[0]):
+                    continue
+                if end_word and end < len(text) and isWordCharacter(text[end]) and isWordCharacter(pattern[-1]):
+                    continue
+                yield start, end, index
+
+
+def scanMessages(messages, matcher, context_characters=40):
+    """
+    Runs the body of each message (processed rows from any of the jabberArchiveTools searches) through the matcher
+    Yields a dictionary for each term found in a message, in message order:
+        {"sent_date", "term", "count", "sender", "recipient", "room", "context", "from_jid", "to_jid"}
+    count is how many times the term is in the message and context the first of them with up to context_characters
+    either side.  For a chatroom message room is the chatroom, sender who posted it and recipient False,
+    otherwise room is False and sender/recipient are the bare jids
+    """
+    for msg in messages:
+        body = msg["body_string"]
+        if not body:
+            continue
+        clean, lower = normalizeText(body)
+        found = {}
+        for start, end, index in matcher.findall(lower):
+            if index in found:
+                found[index][2] += 1
+            else:
+                found[index] = [start, end, 1]
+        if not found:
+            continue
+        from_jid = msg["from_jid"] or ""
+        to_jid = msg["to_jid"] or ""
+        if "@conference" in from_jid:
+            parts = from_jid.split("/")
+            room = parts[0]
+            sender = parts[1] if len(parts) > 1 else parts[0]
+            recipient = False
+        else:
+            room = False
+            sender = from_jid.split("/")[0]
+            recipient = to_jid.split("/")[0]
+        for index in sorted(found, key=lambda index: found[index][0]):
+            start, end, count = found[index]
+            context = clean[max(0, start - context_characters):end + context_characters]
+            if start > context_characters:
+                context = "..." + context
+            if end + context_characters < len(clean):
+                context += "..."
+            yield {"sent_date":msg["sent_date"], "term":matcher.terms[index][0], "count":count, "sender":sender,
+                   "recipient":recipient, "room":room, "context":context, "from_jid":from_jid, "to_jid":to_jid}
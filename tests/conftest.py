@@ -0,0 +1,50 @@
+# the modules live at the top of the repository, not in a package
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def syntheticArchive(tmp_path_factory):
+    # a small generated jm table in SQLite, returns (filename, its jm_synthetic details)
+    pytest.importorskip("Crypto")
+    from jabberArchiveGenerator import archiveGenerator, readSyntheticInfo
+    filename = str(tmp_path_factory.mktemp("archive") / "synthetic.db")
+    archiveGenerator(users=30, rooms=4, seed=7).generate(filename, 20000)
+    return filename, readSyntheticInfo(filename)
+
+
+@pytest.fixture
+def makeTools(syntheticArchive):
+    # makeTools(**kwargs) gives a jabberArchiveTools on the synthetic archive, closed after the test
+    pytest.importorskip("pyodbc")
+    import jabberSQLiteBackend
+    from jabberArchiveTools import jabberArchiveTools
+    filename, info = syntheticArchive
+    made = []
+
+    def make(**kwargs):
+        jabs = jabberArchiveTools(pyodbc_connection=jabberSQLiteBackend.connect(filename),
+                                  pyodbc_connection_factory=lambda: jabberSQLiteBackend.connect(filename),
+                                  AES_key_hex=info["AES_key_hex"], AES_IV_hex=info["AES_IV_hex"],
+                                  sql_dialect="sqlite", row_count_alert_threshold=10**9, **kwargs)
+        made.append(jabs)
+        return jabs
+
+    yield make
+    for jabs in made:
+        jabs.close()
+
+
+@pytest.fixture(params=["numpy", "python"])
+def withNumpy(request, monkeypatch):
+    # runs the test with NumPy and again with the pure Python code jabberArchiveTools uses without it
+    pytest.importorskip("pyodbc")
+    import jabberArchiveTools
+    if request.param == "numpy":
+        pytest.importorskip("numpy")
+        assert jabberArchiveTools.numpy is not None
+    else:
+        monkeypatch.setattr(jabberArchiveTools, "numpy", None)
@@ -0,0 +1,84 @@
+import calendar
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+pytest.importorskip("pyodbc")
+import jabberArchiveTools
+from jabberArchiveTools import rebucketActivity
+
+
+def slot(*when):
+    # 15 minute slot of a UTC time
+    return calendar.timegm(datetime(*when).timetuple()) // 900
+
+
+def test_day_utc(withNumpy):
+    counts = {slot(2020, 1, 1, 0, 0):[1, 0], slot(2020, 1, 1, 23, 45):[2, 1], slot(2020, 1, 2, 0, 0):[0, 3]}
+    assert rebucketActivity(counts) == [{"start":datetime(2020, 1, 1), "sent":3, "received":1},
+                                        {"start":datetime(2020, 1, 2), "sent":0, "received":3}]
+
+
+def test_hour_across_dst(withNumpy):
+    # 10:00 UTC on 2020-03-08 is when Los Angeles went from 02:00 PST to 03:00 PDT
+    counts = {slot(2020, 3, 8, 9, 45):[1, 0], slot(2020, 3, 8, 10, 0):[0, 1], slot(2020, 3, 8, 10, 45):[1, 1]}
+    assert rebucketActivity(counts, "hour", "America/Los_Angeles") == [
+        {"start":datetime(2020, 3, 8, 1), "sent":1, "received":0}, {"start":datetime(2020, 3, 8, 3), "sent":1, "received":2}]
+
+
+def test_fixed_offset(withNumpy):
+    # Etc/GMT-5 is UTC+5 all year
+    counts = {slot(2020, 1, 1, 18, 45):[1, 0], slot(2020, 1, 1, 19, 0):[0, 1]}
+    assert rebucketActivity(counts, "day", "Etc/GMT-5") == [
+        {"start":datetime(2020, 1, 1), "sent":1, "received":0}, {"start":datetime(2020, 1, 2), "sent":0, "received":1}]
+
+
+def test_week_starts_monday(withNumpy):
+    # 2020-01-01 was a Wednesday, the 5th a Sunday
+    counts = {slot(2020, 1, 1, 12, 0):[1, 0], slot(2020, 1, 5, 23, 45):[1, 0], slot(2020, 1, 6, 0, 0):[0, 1]}
+    assert rebucketActivity(counts, "week") == [{"start":datetime(2019, 12, 30), "sent":2, "received":0},
+                                                {"start":datetime(2020, 1, 6), "sent":0, "received":1}]
+
+
+def test_empty_and_bad_bucket(withNumpy):
+    assert rebucketActivity({}, "hour") == []
+    with pytest.raises(SyntaxError):
+        rebucketActivity({slot(2020, 1, 1):[1, 0]}, "month")
+
+
+def test_sent_in_the_same_second(tmp_path):
+    # one to one messages sent in the same second are each counted
+    import jabberSQLiteBackend
+    from jabberArchiveTools import jabberArchiveTools
+    filename = str(tmp_path / "archive.db")
+    connection = sqlite3.connect(filename)
+    connection.execute("create table jm (sent_date text, from_jid text, to_jid text, body_string text, message_string text)")
+    connection.executemany("insert into jm values (?,?,?,?,?)",
+                           [("2020-01-01 09:00:00", "amy@example.org/home", "bob@example.org", "one", None),
+                            ("2020-01-01 09:00:00", "amy@example.org/home", "bob@example.org", "two", None),
+                            ("2020-01-01 09:00:00", "bob@example.org/work", "amy@example.org/home", "three", None)])
+    connection.commit()
+    connection.close()
+    jabs = jabberArchiveTools(pyodbc_connection=jabberSQLiteBackend.connect(filename), sql_dialect="sqlite")
+    try:
+        assert jabs.getActivity("amy@example.org") == [{"start":datetime(2020, 1, 1), "sent":2, "received":1}]
+    finally:
+        jabs.close()
+
+
+@pytest.mark.parametrize("timezone", ["America/Los_Angeles", "Australia/Lord_Howe", "Asia/Kathmandu"])
+def test_numpy_matches_python(timezone, monkeypatch):
+    pytest.importorskip("numpy")
+    # every 7 hours and 15 minutes through two years, so each DST change has slots either side of it
+    start = slot(2019, 1, 1)
+    counts = dict((start + step * 29, [step % 3, step % 5]) for step in range(2500))
+    expected = rebucketActivity(counts, "hour", timezone)
+    monkeypatch.setattr(jabberArchiveTools, "numpy", None)
+    assert rebucketActivity(counts, "hour", timezone) == expected
+    # and each slot's bucket is the hour of its local time
+    tz = pytz.timezone(timezone)
+    local = dict((slot, pytz.utc.localize(datetime(1970, 1, 1) + timedelta(seconds=slot * 900)).astimezone(tz).replace(tzinfo=None))
+                 for slot in counts)
+    assert [bucket["start"] for bucket in expected] == sorted(set(when.replace(minute=0) for when in local.values()))
@@ -0,0 +1,12 @@
+def test_one_hop_has_own_chatroom_posts(makeTools, syntheticArchive):
+    filename, info = syntheticArchive
+    jabs = makeTools()
+    whole = jabs.getContactGraph()
+    for user in info["users"][:5]:
+        expected = [edge for edge in whole if user in (edge["source"], edge["target"])]
+        assert jabs.getContactGraph(user, hops=1) == expected
+        rooms = [room for room, members in info["rooms"].items() if user in members]
+        posted = [edge["target"] for edge in expected if edge["kind"] == "posted" and edge["source"] == user]
+        # everyone in a room of the synthetic archive posts at some point, except in very quiet ones
+        assert set(posted) <= set(rooms)
+        assert posted or not rooms
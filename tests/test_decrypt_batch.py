@@ -0,0 +1,44 @@
+import base64
+
+import pytest
+
+pytest.importorskip("pyodbc")
+pytest.importorskip("Crypto")
+from Crypto.Cipher import AES
+
+from jabberArchiveTools import decryptBatch, decryptString
+
+AES_KEY = bytes(range(32))
+AES_IV = bytes(range(16, 32))
+# short, exactly one block (a whole block of padding), several blocks and multi-byte characters
+PLAIN = ["bob@example.org", "0123456789abcdef", "meet me by the vault at noon, bring the codes " * 3, "café ☕ 会议", "x"]
+
+
+def encrypt(p_text):
+    p_bytes = p_text.encode("utf-8")
+    pad = 16 - len(p_bytes) % 16
+    return base64.b64encode(AES.new(AES_KEY, AES.MODE_CBC, AES_IV).encrypt(p_bytes + bytes([pad]) * pad)).decode("utf-8")
+
+
+def test_matches_decrypt_string(withNumpy):
+    c_texts = [encrypt(p_text) for p_text in PLAIN]
+    assert [decryptString(AES_KEY, AES_IV, c_text) for c_text in c_texts] == PLAIN
+    assert decryptBatch(AES_KEY, AES_IV, c_texts) == PLAIN
+    # the same value twice in a row still starts from the IV
+    assert decryptBatch(AES_KEY, AES_IV, c_texts[:1] * 3) == PLAIN[:1] * 3
+
+
+def test_nulls_pass_through(withNumpy):
+    c_texts = [None, encrypt("hello"), "", None, encrypt("world")]
+    assert decryptBatch(AES_KEY, AES_IV, c_texts) == [None, "hello", "", None, "world"]
+    assert decryptBatch(AES_KEY, AES_IV, [None, ""]) == [None, ""]
+    assert decryptBatch(AES_KEY, AES_IV, []) == []
+
+
+def test_not_whole_blocks(withNumpy):
+    # falls back to decryptString for each value, which raises on the bad one the same way
+    c_texts = [encrypt("hello"), base64.b64encode(b"not sixteen").decode("utf-8")]
+    with pytest.raises(ValueError):
+        decryptString(AES_KEY, AES_IV, c_texts[1])
+    with pytest.raises(ValueError):
+        decryptBatch(AES_KEY, AES_IV, c_texts)
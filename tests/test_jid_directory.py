@@ -0,0 +1,31 @@
+from datetime import datetime
+
+import pytest
+
+
+def test_find_stored_jids_bare_jid():
+    pytest.importorskip("pyodbc")
+    from jabberArchiveTools import jidDirectory
+    directory = jidDirectory()
+    when = datetime(2020, 1, 1)
+    for stored_jid, plain_jid in [("a", "alex1@example.org"), ("b", "alex1@example.org/jabber_1"),
+                                  ("c", "alex10@example.org/jabber_2"), ("d", "alex1@example.org.evil/jabber_3")]:
+        directory.addCounts(stored_jid, plain_jid, 1, when, when)
+    assert sorted(directory.findStoredJids("alex1@example.org")) == ["a", "b"]
+    assert sorted(directory.findStoredJids("alex1@example.org/jabber_1")) == ["b"]
+    # not a jid, a prefix like makeJidPrefix
+    assert sorted(directory.findStoredJids("alex1")) == ["a", "b", "c", "d"]
+
+
+def test_search_does_not_build_directory(makeTools, syntheticArchive):
+    filename, info = syntheticArchive
+    jabs = makeTools()
+    queries = []
+    execute = jabs.execute
+    jabs.execute = lambda query, params=[]: (queries.append(query), execute(query, params))[1]
+    before = jabs.getMessagesFromUser(info["users"][1])
+    assert len(queries) == 1 and jabs.jid_directory.watermark is None
+    # once it has been built searches use it, with the same results
+    jabs.getJids()
+    assert [msg["sent_date"] for msg in jabs.getMessagesFromUser(info["users"][1])] == [msg["sent_date"] for msg in before]
+    assert " in (" in queries[-1]
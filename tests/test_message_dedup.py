@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("pyodbc")
+from jabberArchiveTools import messageDeduplicator
+
+
+def test_exact():
+    dedup = messageDeduplicator()
+    ids = [b"m1", b"m2", b"m1", b"m3", b"m2", b"m1"]
+    assert [dedup.isNew(message_id) for message_id in ids] == [True, True, False, True, False, False]
+    # only the digests are kept
+    assert len(dedup.seen) == 3 and all(len(digest) == 16 for digest in dedup.seen)
+
+
+def test_digest_size():
+    dedup = messageDeduplicator(digest_size=8)
+    assert dedup.isNew(b"m1") and not dedup.isNew(b"m1")
+    assert [len(digest) for digest in dedup.seen] == [8]
+
+
+def test_window():
+    start = datetime(2020, 1, 1)
+    dedup = messageDeduplicator(window_seconds=60)
+    messages = [(b"m1", 0), (b"m2", 10), (b"m1", 50), (b"m2", 69), (b"m1", 61), (b"m1", 130)]
+    assert [dedup.isNew(message_id, start + timedelta(seconds=offset)) for message_id, offset in messages] == [
+        True, True, False, False, True, True]
+    # m2 at 10 was forgotten once a message 60 seconds newer came in, m1 is the one from 130
+    assert len(dedup.order) == 1 and len(dedup.seen) == 1
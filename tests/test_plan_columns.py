@@ -0,0 +1,12 @@
+import pytest
+
+
+def test_plan_columns(makeTools):
+    jabs = makeTools()
+    assert jabs.planColumns() is None
+    assert jabs.planColumns(["body_string", "sent_date"], required=["from_jid"]) == ["sent_date", "from_jid", "body_string"]
+    # bad names are a SyntaxError like a bad column, not the ValueError of the row count guard
+    with pytest.raises(SyntaxError):
+        jabs.planColumns("no_such_projection")
+    with pytest.raises(SyntaxError):
+        jabs.planColumns(["body_string; drop table jm"])
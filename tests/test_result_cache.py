@@ -0,0 +1,48 @@
+import pytest
+
+
+def rowsOf(messages, columns=("sent_date", "from_jid", "body_string")):
+    return [tuple(msg[column] for column in columns) for msg in messages]
+
+
+@pytest.fixture
+def room(syntheticArchive):
+    filename, info = syntheticArchive
+    return max(info["rooms"], key=lambda room: len(info["rooms"][room]))
+
+
+def test_cached_room_log_matches(makeTools, room, tmp_path):
+    plain = makeTools()
+    cached = makeTools(result_cache_dir=str(tmp_path / "cache"))
+    windows = [("2020-01-01T06:00:00", "2020-01-01T18:00:00"), ("2020-01-01T00:00:00", "2020-01-02T00:00:00"),
+               ("2020-01-01T12:00:00", "2020-01-03T00:00:00"), (False, False), ("2020-01-01T09:30:00", False)]
+    for startTime, endTime in windows * 2:
+        expected = plain.getChatRoomLog(room, startTime, endTime, columns="text")
+        assert rowsOf(cached.getChatRoomLog(room, startTime, endTime, columns="text")) == rowsOf(expected)
+    assert cached.getCacheStats()["results"]["segments"] > 0
+
+
+def test_cached_rows_stay_encrypted(makeTools, syntheticArchive, tmp_path):
+    filename, info = syntheticArchive
+    user = info["users"][0]
+    cached = makeTools(result_cache_dir=str(tmp_path / "cache"), collect_stats=True)
+    fresh = cached.getMessagesFromUser(user, "2020-01-01T00:00:00", "2020-01-02T00:00:00")
+    again = cached.getMessagesFromUser(user, "2020-01-01T00:00:00", "2020-01-02T00:00:00")
+    assert cached.getStats()["counts"]["rows_from_cache"] == len(again) > 0
+    # lazy columns come back still encrypted and decrypt when read
+    assert all(msg.ciphertext("message_string") for msg in again if msg["body_string"])
+    assert rowsOf(again, ("sent_date", "from_jid", "to_jid", "body_string", "message_string")) == \
+        rowsOf(fresh, ("sent_date", "from_jid", "to_jid", "body_string", "message_string"))
+
+
+def test_row_count_checked_before_cached_rows(makeTools, room, tmp_path):
+    cached = makeTools(result_cache_dir=str(tmp_path / "cache"))
+    everything = cached.getChatRoomLog(room, "2020-01-01T00:00:00", "2020-01-02T00:00:00", columns="text")
+    assert len(everything) > 20
+    cached.kwargs["row_count_alert_threshold"] = len(everything) - 1
+    yielded = []
+    with pytest.raises(ValueError):
+        # the earlier part of this window is cached, the rest isn't
+        for msg in cached.iterChatRoomLog(room, "2020-01-01T00:00:00", "2020-01-03T00:00:00", columns="text"):
+            yielded.append(msg)
+    assert yielded == []
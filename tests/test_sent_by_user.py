@@ -0,0 +1,27 @@
+import pytest
+
+
+def sentBy(messages, user):
+    # what user sent, going through every message
+    found = []
+    for msg in messages:
+        parts = msg["from_jid"].split("/")
+        if parts[0] == user or ("@conference" in parts[0] and len(parts) > 1 and parts[1] == user):
+            found.append((msg["sent_date"], msg["from_jid"], msg["body_string"]))
+    return sorted(found)
+
+
+@pytest.mark.parametrize("max_query_params", [2000, 4])
+def test_sent_by_user_includes_chatroom_posts(makeTools, syntheticArchive, max_query_params):
+    filename, info = syntheticArchive
+    jabs = makeTools(max_query_params=max_query_params)
+    everything = list(jabs.iterAllMessages(columns="text"))
+    posts = 0
+    for user in info["users"][:6]:
+        sent = [(msg["sent_date"], msg["from_jid"], msg["body_string"]) for msg in jabs.iterMessagesSentByUser(user, columns="text")]
+        if max_query_params > 100:
+            assert sent == sorted(sent, key=lambda message: message[0])
+        # iterAllMessages leaves out rows without a body
+        assert sorted(message for message in sent if message[2]) == sentBy(everything, user)
+        posts += sum(1 for message in sent if "@conference" in message[1])
+    assert posts
@@ -0,0 +1,87 @@
+import threading
+import time
+
+
+def runInThread(target):
+    # runs target() in a thread, returns (thread, dictionary that gets "result" or "error")
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = target()
+        except Exception as badnews:
+            outcome["error"] = badnews
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread, outcome
+
+
+def test_cancel_running_query(makeTools):
+    from jabberArchiveTools import searchCancelled
+    jabs = makeTools()
+    tools = jabs.clone()
+
+    def slowQuery():
+        # a join the size of the table squared, long enough to still be running when cancelled
+        tools.execute("select count(*) from jm a, jm b where a.body_len < b.body_len")
+        return tools.cursor.fetchone()
+
+    thread, outcome = runInThread(slowQuery)
+    time.sleep(0.3)
+    tools.cancel()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert isinstance(outcome.get("error"), searchCancelled)
+    tools.close()
+
+
+def test_cancel_between_batches(syntheticArchive, makeTools):
+    from jabberArchiveTools import searchCancelled
+    filename, info = syntheticArchive
+    room = max(info["rooms"], key=lambda room: len(info["rooms"][room]))
+    jabs = makeTools(fetch_batch_size=50)
+    tools = jabs.clone()
+    started = threading.Event()
+    carryOn = threading.Event()
+
+    def readLog():
+        rows = 0
+        # without the row count guard, which holds rows back until it has seen them all
+        for msg in tools.iterChatRoomLog(room, ignore_row_count=True):
+            rows += 1
+            if rows == 1:
+                started.set()
+                carryOn.wait(10)
+        return rows
+
+    thread, outcome = runInThread(readLog)
+    assert started.wait(10)
+    tools.cancel()
+    carryOn.set()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert isinstance(outcome.get("error"), searchCancelled)
+    tools.close()
+
+
+def test_cancel_at_any_time(syntheticArchive, makeTools):
+    # wherever the cancel lands (row count, execute, fetchmany, decoding) the search either finished or was cancelled
+    from jabberArchiveTools import searchCancelled
+    filename, info = syntheticArchive
+    jabs = makeTools(fetch_batch_size=20)
+    expected = len(jabs.getMessagesToUser(info["users"][0]))
+    for delay in (0, 0.001, 0.003, 0.01, 0.03):
+        tools = jabs.clone()
+        thread, outcome = runInThread(lambda: tools.getMessagesToUser(info["users"][0]))
+        time.sleep(delay)
+        tools.cancel()
+        thread.join(10)
+        assert not thread.is_alive()
+        if "error" in outcome:
+            assert isinstance(outcome["error"], searchCancelled)
+        else:
+            assert len(outcome["result"]) == expected
+        tools.close()
+    # the connections the cancelled clones had are thrown away, the original still works
+    assert len(jabs.getMessagesToUser(info["users"][0])) == expected
@@ -0,0 +1,99 @@
+import math
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from jabberTextIndex import isMessageOf, parseQuery, textIndex, tokenize
+
+ROOM = "room@conference.example.org"
+# (sent_date, from_jid, to_jid, body_string, message_string), the room message is copied to two members
+ROWS = [("2020-01-01 09:00:00", "amy@example.org/home", "bob@example.org", "Lunch meeting today?", None),
+        ("2020-01-01 09:01:00", "bob@example.org/work", "amy@example.org/home", "no lunch, meeting later about lunch", None),
+        ("2020-01-02 10:00:00", "amy@example.org/home", "carl@example.org", "vault codes vaulting", None),
+        ("2020-01-03 11:00:00", ROOM + "/carl@example.org/work", "bob@example.org", "lunch in the vault",
+         "<message id='m1' type='groupchat'>"),
+        ("2020-01-03 11:00:00", ROOM + "/carl@example.org/work", "amy@example.org", "lunch in the vault",
+         "<message id='m1' type='groupchat'>")]
+
+
+@pytest.fixture
+def indexed(tmp_path):
+    # a plain text jm table and a text index of it, returns (jabs, index)
+    pytest.importorskip("pyodbc")
+    import jabberSQLiteBackend
+    from jabberArchiveTools import jabberArchiveTools
+    filename = str(tmp_path / "archive.db")
+    connection = sqlite3.connect(filename)
+    connection.execute("create table jm (sent_date text, from_jid text, to_jid text, body_string text, message_string text)")
+    connection.executemany("insert into jm values (?,?,?,?,?)", ROWS)
+    connection.commit()
+    connection.close()
+    jabs = jabberArchiveTools(pyodbc_connection=jabberSQLiteBackend.connect(filename), sql_dialect="sqlite")
+    index = textIndex(str(tmp_path / "text.db"))
+    assert index.update(jabs) == 4
+    yield jabs, index
+    index.close()
+    jabs.close()
+
+
+def bm25(tf, length, average_length, docs, matching):
+    idf = math.log(1 + (docs - matching + 0.5) / (matching + 0.5))
+    norm = textIndex.BM25_K1 * (1 - textIndex.BM25_B + textIndex.BM25_B * length / average_length)
+    return idf * tf * (textIndex.BM25_K1 + 1) / (tf + norm)
+
+
+def test_tokenize_and_parse_query():
+    assert tokenize("No lunch, meeting-later!") == ["no", "lunch", "meeting", "later"]
+    assert tokenize(None) == []
+    assert parseQuery(["Lunch  meeting", "vault*", "e-mail*", "!!"]) == [
+        [("lunch", False), ("meeting", False)], [("vault", True)], [("e", False), ("mail", True)]]
+
+
+def test_is_message_of():
+    assert isMessageOf("amy@example.org/home", "bob@example.org", "bob@example.org")
+    assert not isMessageOf("amy10@example.org/home", "bob@example.org", "amy1@example.org")
+    assert isMessageOf(ROOM + "/carl@example.org/work", ROOM, "carl@example.org")
+    assert isMessageOf(ROOM + "/carl@example.org/work", ROOM, ROOM)
+    assert not isMessageOf(ROOM + "/carl@example.org/work", ROOM, "bob@example.org")
+
+
+def test_status_and_update(indexed):
+    jabs, index = indexed
+    # 16 words in 4 messages, the second copy of the room message isn't indexed again
+    assert index.status() == {"watermark":"2020-01-03 11:00:00.000000", "docs":4}
+    assert index.readMeta()["total_length"] == 16
+    assert index.update(jabs) == 0
+    assert index.update(jabs, force=True) == 0
+
+
+def test_phrase_ranking(indexed):
+    jabs, index = indexed
+    results = index.search(jabs, ['"lunch meeting"'], order="rank")
+    assert [result["body_string"] for result in results] == ["Lunch meeting today?", "no lunch, meeting later about lunch"]
+    # both have the phrase once, the shorter message ranks first
+    assert results[0]["score"] == pytest.approx(bm25(1, 3, 4, 4, 2))
+    assert results[1]["score"] == pytest.approx(bm25(1, 6, 4, 4, 2))
+    # the words in the other order aren't the phrase
+    assert index.search(jabs, ["meeting lunch"]) == []
+
+
+def test_prefix_and_parts(indexed):
+    jabs, index = indexed
+    results = index.search(jabs, ["vault*"], order="rank")
+    assert [(result["body_string"], result["score"]) for result in results] == [
+        ("vault codes vaulting", pytest.approx(bm25(2, 3, 4, 4, 2))), ("lunch in the vault", pytest.approx(bm25(1, 4, 4, 4, 2)))]
+    # every part has to match
+    results = index.search(jabs, ["lunch", "vault"])
+    assert [result["body_string"] for result in results] == ["lunch in the vault"]
+    assert results[0]["to_jid"] == ROOM
+
+
+def test_filters(indexed):
+    jabs, index = indexed
+    assert [result["body_string"] for result in index.search(jabs, ["lunch"], jid="carl@example.org")] == ["lunch in the vault"]
+    assert [result["body_string"] for result in index.search(jabs, ["lunch"], jid="bob@example.org")] == [
+        "Lunch meeting today?", "no lunch, meeting later about lunch"]
+    results = index.search(jabs, ["lunch"], startTime=datetime(2020, 1, 1, 9, 0, 30), endTime=datetime(2020, 1, 2))
+    assert [result["body_string"] for result in results] == ["no lunch, meeting later about lunch"]
+    assert [result["sent_date"].day for result in index.search(jabs, ["lunch"], limit=2)] == [1, 1]
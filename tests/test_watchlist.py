@@ -0,0 +1,58 @@
+import pytest
+
+from jabberWatchlist import normalizeText, scanMessages, watchlistMatcher
+
+TERMS = ["merger*", "*coin", "Project  Falcon", "ACME", "c++"]
+
+
+def found(matcher, text):
+    clean, lower = normalizeText(text)
+    return sorted((start, end, matcher.terms[index][0]) for start, end, index in matcher.findall(lower))
+
+
+@pytest.fixture(params=[False, True], ids=["python", "library"])
+def matcher(request):
+    if request.param:
+        pytest.importorskip("ahocorasick")
+    return watchlistMatcher(TERMS, use_library=request.param)
+
+
+def test_normalize_text():
+    assert normalizeText("Project \t\n Falcon") == ("Project Falcon", "project falcon")
+
+
+def test_whole_words(matcher):
+    assert found(matcher, "ACME and acmeco, not subacme") == [(0, 4, "ACME")]
+    # the pattern ends with punctuation, so only its start is a word boundary
+    assert found(matcher, "c++11 but not abc++") == [(0, 3, "c++")]
+
+
+def test_wildcards(matcher):
+    assert found(matcher, "the mergers, a merger and emerger") == [(4, 10, "merger*"), (15, 21, "merger*")]
+    assert found(matcher, "bitcoin, coin and coins") == [(3, 7, "*coin"), (9, 13, "*coin")]
+
+
+def test_whitespace_and_case(matcher):
+    assert found(matcher, "about PROJECT\n\nfalcon today") == [(6, 20, "Project  Falcon")]
+
+
+def test_overlapping_terms():
+    terms = ["he", "she", "hers", "his"]
+    python = watchlistMatcher(terms, use_library=False)
+    text = "ushers he his she"
+    assert found(python, text) == [(7, 9, "he"), (10, 13, "his"), (14, 17, "she")]
+    # without word boundaries every overlap is there
+    ends = sorted((last, python.terms[indexes[0]][1]) for last, (length, indexes) in python.iterPatternEnds(text))
+    assert ends == [(3, "he"), (3, "she"), (5, "hers"), (8, "he"), (12, "his"), (16, "he"), (16, "she")]
+
+
+def test_scan_messages(matcher):
+    messages = [{"sent_date":1, "body_string":"Coin toss on the merger", "from_jid":"bob@example.org/home", "to_jid":"amy@example.org"},
+                {"sent_date":2, "body_string":None, "from_jid":"bob@example.org", "to_jid":"amy@example.org"},
+                {"sent_date":3, "body_string":"acme acme", "from_jid":"room@conference.example.org/amy@example.org/work",
+                 "to_jid":"bob@example.org"}]
+    hits = list(scanMessages(messages, matcher, context_characters=5))
+    assert [(hit["sent_date"], hit["term"], hit["count"], hit["context"]) for hit in hits] == [
+        (1, "*coin", 1, "Coin toss..."), (1, "merger*", 1, "... the merger"), (3, "ACME", 2, "acme acme")]
+    assert (hits[0]["sender"], hits[0]["recipient"], hits[0]["room"]) == ("bob@example.org", "amy@example.org", False)
+    assert (hits[2]["sender"], hits[2]["recipient"], hits[2]["room"]) == ("amy@example.org", False, "room@conference.example.org")